@@ -0,0 +1,150 @@
+"""
+Attribute providers used by the policy decision point to retrieve the attributes that are not in the access request.
+
+The providers hold no state of a request, the subject and resource come from the evaluation context and the
+attributes of the current user come from the attribute context of the request, so one instance of each provider is
+shared by all cached PDPs.
+"""
+import re
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context
+from flask_login import current_user
+from py_abac.provider.base import AttributeProvider
+
+from .auth import AuthAttribute
+from .geofence import geofence_index
+from .models import ThingFrequency
+
+
+def get_auth_attributes():
+    if current_user.is_anonymous:
+        return "Please Login", 400
+    user_id = current_user.get_user_id()
+    auth_attribute = AuthAttribute.query.filter_by(id=user_id).first()
+    auth_user_attributes = auth_attribute.get_user_attributes()
+    auth_server_attributes = auth_attribute.get_server_attributes()
+    # return a list of two dictionaries
+    return [auth_user_attributes, auth_server_attributes]
+
+
+class AttributeContext(object):
+    """Attributes of the current user for one request, shared by all providers and all decisions of the request
+
+    The user and server attributes are loaded on the first use, and every attribute resolved from them is memoized.
+    """
+
+    def __init__(self):
+        self._auth_attributes = None
+        # attribute name => value from the user or server attributes
+        self._values = {}
+        # position of the user and containment of the geofences checked so far, loaded by the first geo attribute
+        self.geo = {}
+        # geofence attribute paths used by the policies being evaluated, their containment is checked together
+        self.geofence_paths = []
+
+    @property
+    def auth_attributes(self) -> list:
+        """[user attributes, server attributes] of the current user, two empty dicts if no user is logged in
+        """
+        if self._auth_attributes is None:
+            auth_attributes = get_auth_attributes() if has_request_context() else None
+            self._auth_attributes = auth_attributes if isinstance(auth_attributes, list) else [{}, {}]
+        return self._auth_attributes
+
+    def set_auth_attributes(self, auth_attributes: list):
+        """Use the [user attributes, server attributes] resolved by another directory, for a request it forwarded on
+        behalf of its user
+        """
+        self._auth_attributes = auth_attributes
+        self._values = {}
+        self.geo = {}
+
+    def get_value(self, attr_name: str):
+        """Get an attribute of the current user, from the user attributes first and then the server attributes
+        """
+        if attr_name not in self._values:
+            auth_user_attributes, auth_server_attributes = self.auth_attributes
+            self._values[attr_name] = auth_user_attributes.get(attr_name, None) or \
+                auth_server_attributes.get(attr_name, None)
+        return self._values[attr_name]
+
+
+def get_attribute_context() -> AttributeContext:
+    """Get the attribute context of the current request, kept in `flask.g`
+    """
+    if not has_request_context():
+        return AttributeContext()
+    if 'attribute_context' not in g:
+        g.attribute_context = AttributeContext()
+    return g.attribute_context
+
+
+def reset_attribute_context():
+    """Forget the attributes loaded by the current request, after the attributes of the user are changed
+    """
+    if has_request_context():
+        g.pop('attribute_context', None)
+
+
+class TimestampAttributeProvider(AttributeProvider):
+    def get_attribute_value(self, ace, attribute_path, ctx):
+        if attribute_path == "$.timestamp":
+            return datetime.now().timestamp()
+        return None
+
+
+class GeoAttributeProvider(AttributeProvider):
+    """Check the position of the user against the geofences, the position is loaded once per request in the
+    attribute context and the containment of each geofence is checked at most once per request
+    """
+
+    def get_attribute_value(self, ace: str, attribute_path: str, ctx: 'EvaluationContext'):
+        if ace == "subject" and attribute_path[:5] == "$.geo":
+            attribute_context = get_attribute_context()
+            geo = attribute_context.geo
+            if 'containment' not in geo:
+                geo['position'] = attribute_context.auth_attributes[0].get('position', None)
+                geo['containment'] = {}
+            if geo['position'] is None:
+                return 0
+            # check the geofences used by the policies being evaluated against the position in one batched call,
+            # the other known geofences are not checked
+            if attribute_path not in geo['containment']:
+                paths = [path for path in attribute_context.geofence_paths if path not in geo['containment']]
+                if attribute_path not in paths:
+                    paths.append(attribute_path)
+                geo['containment'].update(geofence_index.containing(geo['position'], paths))
+            return int(geo['containment'][attribute_path])
+
+        return None
+
+
+class TimespanAttributeProvider(AttributeProvider):
+    def get_attribute_value(self, ace: str, attribute_path: str, ctx: 'EvaluationContext'):
+        if ace == 'resource' and attribute_path[:10] == '$.timespan':
+            timespan = int(attribute_path.partition(': ')[2])
+            start = datetime.utcnow() - timedelta(seconds=timespan)
+            thing_obj = ThingFrequency.objects(thing_id=ctx.resource_id).first()
+            cnt = 0
+            if thing_obj is not None and ctx.subject_id in thing_obj.timestamps:
+                for timestamp in thing_obj.timestamps[ctx.subject_id][::-1]:
+                    if timestamp < start:
+                        break
+                    cnt += 1
+                return cnt
+            else:
+                return 0
+        return None
+
+
+class OtherAttributeProvider(AttributeProvider):
+    def get_attribute_value(self, ace: str, attribute_path: str, ctx):
+        # Assume attribute_path is in the form "$.attribute_name"
+        attr_name = re.search("[a-zA-Z_]+", attribute_path).group().lower()
+        return get_attribute_context().get_value(attr_name)
+
+
+# providers are asked in this order, the first one returning a value wins
+ATTRIBUTE_PROVIDERS = [TimestampAttributeProvider(), TimespanAttributeProvider(), GeoAttributeProvider(),
+                       OtherAttributeProvider()]
@@ -0,0 +1,154 @@
+"""
+Audit trail of the policy decisions.
+
+A decision appends its record to an in-memory ring buffer and returns at once. A background writer takes the records
+in batches and inserts them into the capped `audit_log` collection, so a decision never waits for the database.
+When the writer falls behind and the buffer is full, the oldest records are dropped to make room and counted. The
+records of a batch that cannot be written are put back in the buffer as far as there is room, and the others are
+counted as dropped too. The buffer is flushed once more when the process exits.
+
+The writer is not a singleton task, see `Droit.tasks`: every instance of a directory buffers the records of its own
+decisions and runs its own writer. The writers insert distinct records, so they do not conflict.
+"""
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+from mongoengine.errors import InvalidCollectionError
+from pymongo.errors import BulkWriteError
+
+from .models import AuditRecord
+from .tasks import start_periodic_task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIT_BUFFER_SIZE = 10000
+DEFAULT_AUDIT_BATCH_SIZE = 500
+
+
+class AuditLog(object):
+    """Ring buffer of audit records, flushed to MongoDB in batches
+    """
+
+    def __init__(self, max_size: int = DEFAULT_AUDIT_BUFFER_SIZE, batch_size: int = DEFAULT_AUDIT_BATCH_SIZE):
+        self._lock = threading.Lock()
+        # only one flush runs at a time, so the records are written in order
+        self._flush_lock = threading.Lock()
+        self._buffer = deque(maxlen=max_size)
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, subject_id: str, resource_id: str, action: str, policy_uid: str, allowed: bool,
+               evaluation_time: float):
+        """Append the record of a decision, dropping the oldest record if the buffer is full
+
+        Args:
+            subject_id (str): id of the user, empty if anonymous
+            resource_id (str): id of the thing
+            action (str): the requested action
+            policy_uid (str): uid of the deciding policy, None if no policy applied
+            allowed (bool): True if the access was allowed
+            evaluation_time (float): seconds spent deciding
+        """
+        entry = {
+            "subject": str(subject_id),
+            "resource": str(resource_id),
+            "action": action,
+            "policy_uid": policy_uid,
+            "allowed": bool(allowed),
+            "evaluation_time": evaluation_time,
+            "timestamp": datetime.utcnow()
+        }
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(entry)
+
+    def _take_batch(self) -> list:
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+
+    def _requeue_batch(self, batch: list):
+        """Put a batch that could not be written back at the front of the buffer, as far as there is room
+
+        The records of the batch are older than the buffered ones, so its oldest records are dropped first.
+        """
+        with self._lock:
+            room = self._buffer.maxlen - len(self._buffer)
+            kept = batch[len(batch) - room:] if room < len(batch) else batch
+            self.dropped += len(batch) - len(kept)
+            self._buffer.extendleft(reversed(kept))
+
+    def flush(self) -> int:
+        """Write the buffered records in batches until the buffer is empty or a batch fails
+
+        Returns:
+            int: the number of records written
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return written
+                # the records keep the _id given by the first attempt, a record written before is a duplicate
+                try:
+                    AuditRecord._get_collection().insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    failed = [batch[error['index']] for error in e.details.get('writeErrors', [])
+                              if error.get('code') != 11000]
+                    written += len(batch) - len(failed)
+                    with self._lock:
+                        self.written += len(batch) - len(failed)
+                    if failed:
+                        logger.warning("Failed to write %d audit records: %s", len(failed), e)
+                        self._requeue_batch(failed)
+                        return written
+                    continue
+                except Exception as e:
+                    logger.warning("Failed to write %d audit records: %s", len(batch), e)
+                    self._requeue_batch(batch)
+                    return written
+                written += len(batch)
+                with self._lock:
+                    self.written += len(batch)
+
+    def get_status(self) -> dict:
+        """Get the number of buffered, written and dropped records
+        """
+        with self._lock:
+            return {"buffered": len(self._buffer), "capacity": self._buffer.maxlen, "written": self.written,
+                    "dropped": self.dropped}
+
+
+audit_log = AuditLog()
+
+
+def ensure_audit_collection():
+    """Create the capped audit collection, or check that the existing one is capped with the configured bounds
+
+    An existing collection that is not capped, or capped with other bounds, is renamed with a timestamp suffix to keep
+    its records, and a new capped collection is created.
+    """
+    try:
+        AuditRecord._get_collection()
+    except InvalidCollectionError:
+        collection_name = AuditRecord._get_collection_name()
+        backup_name = f"{collection_name}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+        logger.warning("Collection %s is not capped as configured, renamed to %s", collection_name, backup_name)
+        AuditRecord._get_db()[collection_name].rename(backup_name)
+        AuditRecord._collection = None
+        AuditRecord._get_collection()
+
+
+def start_audit_writer(app):
+    """Check the capped audit collection, then flush the audit records in the background every
+    `AUDIT_FLUSH_INTERVAL` seconds (1 by default) and once more at exit
+    """
+    with app.app_context():
+        ensure_audit_collection()
+    atexit.register(audit_log.flush)
+    return start_periodic_task(app, "audit_writer", app.config.get('AUDIT_FLUSH_INTERVAL', 1), audit_log.flush)
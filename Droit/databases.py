@@ -1,5 +1,7 @@
-from .models import ThingDescription, DirectoryNameToURL, TargetToChildName, TypeToChildrenNames
+from .models import ThingDescription, DirectoryNameToURL, TargetToChildName, TypeToChildrenNames, SpatialSummary, \
+    RelocationJob, TypeCounter, DirectoryPath
 from flask_pymongo import PyMongo
+from .routing import routing_table
 
 mongo = PyMongo()
 
@@ -11,6 +13,11 @@ def clear_database() -> None:
     DirectoryNameToURL.drop_collection()
     TypeToChildrenNames.drop_collection()
     TargetToChildName.drop_collection()
+    SpatialSummary.drop_collection()
+    RelocationJob.drop_collection()
+    TypeCounter.drop_collection()
+    DirectoryPath.drop_collection()
+    routing_table.refresh()
 
 
 def init_dir_to_url(level: str) -> None:
@@ -80,6 +87,7 @@ def init_dir_to_url(level: str) -> None:
                            url=f'http://localhost:5001', relationship='master').save()
         DirectoryNameToURL(directory_name='level4abb',
                            url=f'http://localhost:5007', relationship='parent').save()
+    routing_table.refresh()
 
 
 def init_target_to_child_name(level: str) -> None:
@@ -103,5 +111,4 @@ def init_target_to_child_name(level: str) -> None:
     elif level == 'level3ab':
         TargetToChildName(target_name='level5abba', child_name='level4abb').save()
         TargetToChildName(target_name='level5abbb', child_name='level4abb').save()
-    else:
-        pass
+    routing_table.refresh()
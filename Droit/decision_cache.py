@@ -0,0 +1,194 @@
+"""
+Cache of policy decisions, keyed by the location and version of the policy set, the fingerprint of the subject and
+its attributes, the resource and the action.
+
+The version of a policy set changes whenever any instance of the directory changes the policies, see
+`policy_helper`. The fingerprint covers the user and server attributes, including the position checked against the
+geofences of the policies.
+
+Decisions depending on time are only kept while they cannot change:
+
+- if the policies of the location use `$.timestamp`, a decision expires when the time crosses the next threshold
+  compared with the timestamp in these policies;
+- if they use `$.timespan`, the key also holds the number of recorded accesses of the subject to the thing, so an
+  access recorded by any instance misses the cached decision, and a decision expires when the oldest access counted
+  in a time window leaves the window.
+
+All decisions of a location are dropped when a policy is added or deleted there, and no decision is kept longer
+than `DECISION_CACHE_TTL` seconds.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import current_app as app
+from flask import has_app_context
+
+from .models import ThingFrequency
+
+DEFAULT_DECISION_CACHE_SIZE = 10000
+DEFAULT_DECISION_CACHE_TTL = 60
+
+
+def get_subject_fingerprint(subject: dict, auth_attributes) -> str:
+    """Get a digest of the subject of an access request and of the attributes the providers may read for it
+
+    Args:
+        subject (dict): the subject returned by `get_access_subject`
+        auth_attributes: the user and server attributes of the current user from the attribute context
+    """
+    return hashlib.sha1(json.dumps([subject, auth_attributes], sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+def get_access_counts(subject_id: str, thing_ids: list) -> dict:
+    """Get the number of recorded accesses of a subject to each thing, with one query
+
+    Returns:
+        dict: mapping from thing id to the number of accesses, things without accesses are omitted
+    """
+    if not subject_id or not thing_ids:
+        return {}
+    documents = ThingFrequency._get_collection().find(
+        {'thing_id': {'$in': thing_ids}}, {'thing_id': 1, f'timestamps.{subject_id}': 1})
+    return {document['thing_id']: len(document.get('timestamps', {}).get(subject_id, [])) for document in documents}
+
+
+def _collect_time_dependencies(rules, dependencies: dict):
+    if isinstance(rules, list):
+        for rule in rules:
+            _collect_time_dependencies(rule, dependencies)
+        return
+    if not isinstance(rules, dict):
+        return
+    for attribute_path, condition in rules.items():
+        if attribute_path == "$.timestamp":
+            _collect_thresholds(condition, dependencies["timestamps"])
+        elif attribute_path[:10] == "$.timespan":
+            dependencies["timespans"].add(int(attribute_path.partition(': ')[2]))
+
+
+def _collect_thresholds(condition, thresholds: set):
+    if not isinstance(condition, dict):
+        return
+    for nested in condition.get("values", []):
+        _collect_thresholds(nested, thresholds)
+    value = condition.get("value")
+    if isinstance(value, dict):
+        _collect_thresholds(value, thresholds)
+    elif isinstance(value, (int, float)):
+        thresholds.add(value)
+
+
+def get_time_dependencies(policies: list) -> dict:
+    """Find the timestamp thresholds and the time windows used by the rules of the policies
+
+    Returns:
+        dict: {"timestamps": sorted list of thresholds, "timespans": sorted list of window lengths in seconds}
+    """
+    dependencies = {"timestamps": set(), "timespans": set()}
+    for policy in policies:
+        for rules in policy.to_json()["rules"].values():
+            _collect_time_dependencies(rules, dependencies)
+    return {"timestamps": sorted(dependencies["timestamps"]), "timespans": sorted(dependencies["timespans"])}
+
+
+def get_expiration(dependencies: dict, subject_id: str, thing_id: str) -> float:
+    """Get the time after which a decision may change, as a UNIX timestamp
+
+    Args:
+        dependencies (dict): returned by `get_time_dependencies`
+        subject_id (str): id of the subject
+        thing_id (str): id of the thing
+    """
+    now = time.time()
+    ttl = app.config.get('DECISION_CACHE_TTL', DEFAULT_DECISION_CACHE_TTL) if has_app_context() \
+        else DEFAULT_DECISION_CACHE_TTL
+    expires = now + ttl
+    for threshold in dependencies["timestamps"]:
+        if threshold > now:
+            expires = min(expires, threshold)
+            break
+    if dependencies["timespans"]:
+        thing_obj = ThingFrequency.objects(thing_id=thing_id).first()
+        timestamps = thing_obj.timestamps.get(subject_id, []) if thing_obj is not None else []
+        utc_now = datetime.utcnow()
+        for timespan in dependencies["timespans"]:
+            in_window = [timestamp for timestamp in timestamps if (utc_now - timestamp).total_seconds() <= timespan]
+            if in_window:
+                expires = min(expires, now + timespan - (utc_now - min(in_window)).total_seconds())
+    return expires
+
+
+class DecisionCache(object):
+    """Least recently used cache of decisions with an expiration time per entry
+    """
+
+    def __init__(self, max_size: int = DEFAULT_DECISION_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        # key => (decision, expires_at, access)
+        self._entries = OrderedDict()
+        # (subject id, thing id) => keys of the decisions depending on the accesses of the subject to the thing
+        self._by_access = {}
+
+    def get(self, key: tuple):
+        """Get a cached decision, or None if there is none or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                self._forget_access(key, entry[2])
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, decision, expires_at: float, access: tuple = None):
+        """Cache a decision until `expires_at`
+
+        Args:
+            key (tuple): the key of the decision
+            decision: the decision, it must not be None
+            expires_at (float): UNIX timestamp after which the decision may change
+            access (tuple): (subject id, thing id) if the decision depends on the accesses of the subject to the thing
+        """
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (decision, expires_at, access)
+            self._entries.move_to_end(key)
+            if access is not None:
+                self._by_access.setdefault(access, set()).add(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, (_, _, evicted_access) = self._entries.popitem(last=False)
+                self._forget_access(evicted_key, evicted_access)
+
+    def _forget_access(self, key: tuple, access: tuple):
+        keys = self._by_access.get(access)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_access[access]
+
+    def invalidate_access(self, subject_id: str, thing_id: str):
+        """Drop the decisions depending on the accesses of a subject to a thing, when it accesses the thing again
+        """
+        with self._lock:
+            for key in self._by_access.pop((subject_id, thing_id), ()):
+                self._entries.pop(key, None)
+
+    def invalidate_location(self, location: str):
+        """Drop all decisions made with the policies of `location`
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == location]:
+                self._forget_access(key, self._entries.pop(key)[2])
+
+
+decision_cache = DecisionCache()
@@ -0,0 +1,146 @@
+"""
+Geofences referenced by policies through attribute paths such as "$.geo(0,0 0,10 10,10 10,0)".
+
+Parsing the polygon and building a shapely geometry is done once per attribute path, and the prepared geometry is
+kept in memory. When many geofences are known, an STRtree is used so that a containment check only tests polygons
+whose bounding box contains the point, and `containing` answers many geofences for one position in one call. The
+geofences checked for a request are only those used by the policies being evaluated, see `get_geofence_paths`.
+"""
+import threading
+from numbers import Integral
+
+import shapely
+from shapely.geometry import Point
+from shapely.geometry.polygon import Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+# Build the STRtree only when at least this number of geofences is known
+STRTREE_THRESHOLD = 16
+# shapely>=2.0 provides a vectorized point-in-polygon predicate
+_contains_xy = getattr(shapely, "contains_xy", None)
+
+
+def parse_geofence(attribute_path: str) -> Polygon:
+    """Parse the polygon encoded in a geo attribute path
+
+    Args:
+        attribute_path (str): attribute path in the form "$.geo(x1,y1 x2,y2 ...)"
+
+    Returns:
+        Polygon: the polygon with the listed points as its exterior
+    """
+    point_list = attribute_path[6:-1].split(' ')
+    polygon_list = []
+    for point in point_list:
+        tmp = point.split(',')
+        polygon_list.append((int(tmp[0]), int(tmp[1])))
+    return Polygon(polygon_list)
+
+
+def _collect_geofence_paths(rules, paths: dict):
+    if isinstance(rules, list):
+        for rule in rules:
+            _collect_geofence_paths(rule, paths)
+        return
+    if not isinstance(rules, dict):
+        return
+    for attribute_path in rules:
+        if attribute_path[:5] == "$.geo":
+            paths[attribute_path] = None
+
+
+def get_geofence_paths(policies: list) -> dict:
+    """Find the geofence attribute paths used by the subject rules of each policy
+
+    Args:
+        policies (list): the policies of one location
+
+    Returns:
+        dict: mapping from policy uid to the list of its geofence attribute paths
+    """
+    geofence_paths = {}
+    for policy in policies:
+        paths = {}
+        _collect_geofence_paths(policy.to_json()["rules"].get("subject", {}), paths)
+        geofence_paths[policy.uid] = list(paths)
+    return geofence_paths
+
+
+class GeofenceIndex(object):
+    """In-memory cache of parsed and prepared geofences, keyed by attribute path
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._polygons = {}
+        self._prepared = {}
+        # STRtree over all known geofences, rebuilt lazily when new geofences are added
+        self._tree = None
+        self._tree_paths = []
+        self._tree_path_by_geom_id = {}
+
+    def get(self, attribute_path: str):
+        """Get the prepared geometry of a geofence, parsing it on the first use
+        """
+        prepared = self._prepared.get(attribute_path)
+        if prepared is None:
+            polygon = parse_geofence(attribute_path)
+            prepared = prep(polygon)
+            with self._lock:
+                self._polygons[attribute_path] = polygon
+                self._prepared[attribute_path] = prepared
+                self._tree = None
+        return prepared
+
+    def contains(self, attribute_path: str, position) -> bool:
+        """Check whether the geofence of `attribute_path` contains `position`
+        """
+        return self.get(attribute_path).contains(Point(position))
+
+    def containing(self, position, attribute_paths: list = None) -> dict:
+        """Check the containment of one position against many geofences at once
+
+        Args:
+            position (list): the (x, y) position to check
+            attribute_paths (list): geofence attribute paths. By default all known geofences are checked.
+
+        Returns:
+            dict: mapping from attribute path to whether its geofence contains the position
+        """
+        if attribute_paths is not None:
+            for attribute_path in attribute_paths:
+                self.get(attribute_path)
+        with self._lock:
+            paths = list(self._polygons) if attribute_paths is None else list(attribute_paths)
+            polygons = [self._polygons[path] for path in paths]
+        if not paths:
+            return {}
+
+        point = Point(position)
+        if len(paths) >= STRTREE_THRESHOLD:
+            # only the geofences whose bounding box contains the point need the exact check
+            result = dict.fromkeys(paths, False)
+            for path in self._query_tree(point):
+                if path in result:
+                    result[path] = self._prepared[path].contains(point)
+            return result
+
+        if _contains_xy is not None:
+            return dict(zip(paths, map(bool, _contains_xy(polygons, point.x, point.y))))
+        return {path: self._prepared[path].contains(point) for path in paths}
+
+    def _query_tree(self, point: Point) -> list:
+        with self._lock:
+            if self._tree is None:
+                self._tree_paths = list(self._polygons)
+                geometries = [self._polygons[path] for path in self._tree_paths]
+                self._tree_path_by_geom_id = {id(geom): path for geom, path in zip(geometries, self._tree_paths)}
+                self._tree = STRtree(geometries)
+            tree, tree_paths, path_by_geom_id = self._tree, self._tree_paths, self._tree_path_by_geom_id
+        # shapely>=2.0 returns indices, while older versions return the geometries themselves
+        return [tree_paths[hit] if isinstance(hit, Integral) else path_by_geom_id[id(hit)]
+                for hit in tree.query(point)]
+
+
+geofence_index = GeofenceIndex()
@@ -3,7 +3,11 @@ Classes defined in this file are used with Mongodb ORM library mongoengine
 For more information, Please refer to its website: http://mongoengine.org/
 """
 from mongoengine import DynamicDocument
-from mongoengine import StringField, IntField, ListField, DateTimeField, DictField
+from mongoengine import StringField, IntField, ListField, DateTimeField, DictField, FloatField, BooleanField
+
+# bounds of the capped audit collection, the oldest records are overwritten beyond them
+AUDIT_LOG_MAX_SIZE = 64 * 1024 * 1024
+AUDIT_LOG_MAX_DOCUMENTS = 500000
 
 
 class ThingDescription(DynamicDocument):
@@ -14,12 +18,19 @@ class ThingDescription(DynamicDocument):
     thing_id = StringField(db_field='thing_id',
                            required=True, unique=True, max_length=160)
     publicity = IntField(db_field='publicity', default=0)
+    # name of the child directory this copy was pushed up from, None if the thing is registered here
+    pushed_from = StringField(db_field='pushed_from')
+    # optional lease, the thing is deleted after this time unless the lease is renewed
+    lease_expires = DateTimeField(db_field='lease_expires')
 
     meta = {
         'collection': 'td',
         'indexes': [
             "thing_type",
-            [("properties.geo.coordinates", "2dsphere")]
+            [("properties.geo.coordinates", "2dsphere")],
+            # expired leases are only deleted by the lease reaper, which also updates the counters and cleans up
+            # upstream, so this index has no TTL
+            'lease_expires'
         ]
     }
 
@@ -43,13 +54,35 @@ class DirectoryNameToURL(DynamicDocument):
 
 class TypeToChildrenNames(DynamicDocument):
     """Class Contains the list of child locaions that has a certain type of devices
+
+    `children_counts` maps each descendant directory name to the number of things of this type registered there
+    (pushed-up copies excluded), maintained by the deltas reported with the aggregation updates.
     """
     thing_type = StringField(db_field='type')
     children_names = ListField(StringField(), db_field='childLocs')
+    children_counts = DictField(IntField(), db_field='childCounts')
 
     meta = {'collection': 'type_to_childLocs'}
 
 
+class TypeCounter(DynamicDocument):
+    """ORM class of the number of things of a type stored in the current directory
+
+    Things registered here are counted under the current directory name, while pushed-up copies are counted under
+    the name of the child directory they are pushed from. Counters are maintained with atomic `$inc` updates.
+    """
+    thing_type = StringField(db_field='type')
+    directory_name = StringField(db_field='loc')
+    count = IntField(db_field='count', default=0)
+
+    meta = {
+        'collection': 'type_counter',
+        'indexes': [
+            {'fields': ['thing_type', 'directory_name'], 'unique': True}
+        ]
+    }
+
+
 class TargetToChildName(DynamicDocument):
     """ORM class that represents tha mapping `target_name` => `child_name`
 
@@ -61,7 +94,117 @@ class TargetToChildName(DynamicDocument):
     meta = {'collection': 'targetLoc_to_childLoc'}
 
 
+class DirectoryPath(DynamicDocument):
+    """ORM class that represents the path of a directory in the tree
+
+    The path lists the directory names from the root to the directory itself, for example "level3aa" ->
+    ["level1", "level2a", "level3aa"]. It is used to find the lowest common ancestor of the current directory and a
+    directory in another branch.
+    """
+    directory_name = StringField(db_field='loc', unique=True)
+    path = ListField(StringField(), db_field='path')
+
+    meta = {'collection': 'loc_to_path'}
+
+
+class SpatialSummary(DynamicDocument):
+    """ORM class that represents the bounding box of all geo-located things under a directory
+
+    The record named after the current directory covers the things stored locally and in all descendants,
+    while records named after direct children are the summaries reported by those children.
+    The bounding box is stored as [min_lng, min_lat, max_lng, max_lat]
+    """
+    directory_name = StringField(db_field='loc', unique=True)
+    bbox = ListField(FloatField(), db_field='bbox')
+
+    meta = {'collection': 'loc_to_bbox'}
+
+
+class RelocationJob(DynamicDocument):
+    """ORM class of the journal of a bulk relocation
+
+    The ids still to be moved are recorded when the job is created, and each batch is removed from `pending_ids` only
+    after the destination acknowledged it and the local copies are deleted, so an interrupted job can be resumed.
+    """
+    job_id = StringField(db_field='job_id', required=True, unique=True)
+    from_location = StringField(db_field='from')
+    to_location = StringField(db_field='to')
+    batch_size = IntField(db_field='batch_size', default=100)
+    pending_ids = ListField(StringField(), db_field='pending_ids')
+    failed_ids = ListField(StringField(), db_field='failed_ids')
+    moved_count = IntField(db_field='moved_count', default=0)
+    # accumulated running time in seconds, used to report the throughput
+    elapsed = FloatField(db_field='elapsed', default=0)
+    state = StringField(db_field='state', default='running')
+
+    meta = {'collection': 'relocation_job'}
+
+    def to_report(self):
+        return {
+            "job_id": self.job_id,
+            "from": self.from_location,
+            "to": self.to_location,
+            "state": self.state,
+            "moved": self.moved_count,
+            "pending": len(self.pending_ids),
+            "failed": self.failed_ids,
+            "elapsed": self.elapsed,
+            "throughput": self.moved_count / self.elapsed if self.elapsed > 0 else 0
+        }
+
+
 class ThingFrequency(DynamicDocument):
     thing_id = StringField(db_field='thing_id',
                            required=True, unique=True, max_length=160)
     timestamps = DictField(ListField(DateTimeField()))
+
+
+class InheritedPolicySet(DynamicDocument):
+    """ORM class of the merged policy set a directory last pulled from its parent directory
+
+    It is shared by the instances of the directory and read at startup, so the inherited policies are known before
+    the parent answers. The policies are stored as a JSON string, since their attribute paths are not valid keys.
+    """
+    directory_name = StringField(db_field='loc', unique=True)
+    # name of the parent directory the policies were pulled from
+    parent_name = StringField(db_field='parent')
+    version = StringField(db_field='version')
+    policies = StringField(db_field='policies')
+    updated_at = DateTimeField(db_field='updated_at')
+
+    meta = {'collection': 'inherited_policy_set'}
+
+
+class AuditRecord(DynamicDocument):
+    """ORM class of one audited policy decision, stored in a capped collection
+
+    Records are written in batches by the audit writer, see `Droit.audit`.
+    """
+    subject = StringField(db_field='subject')
+    resource = StringField(db_field='resource')
+    action = StringField(db_field='action')
+    # uid of the policy that decided, None if no policy applied and the access was denied
+    policy_uid = StringField(db_field='policy_uid')
+    allowed = BooleanField(db_field='allowed')
+    # seconds spent deciding, including the lookup in the decision cache
+    evaluation_time = FloatField(db_field='evaluation_time')
+    timestamp = DateTimeField(db_field='timestamp')
+
+    meta = {
+        'collection': 'audit_log',
+        'max_size': AUDIT_LOG_MAX_SIZE,
+        'max_documents': AUDIT_LOG_MAX_DOCUMENTS
+    }
+
+
+class TaskLock(DynamicDocument):
+    """ORM class of the lease on a background task that only one instance of a directory runs at a time
+
+    The instance holding the lease renews it at each run, and another instance takes it over once it has expired.
+    """
+    name = StringField(db_field='name', required=True, unique=True)
+    # id of the process holding the lease
+    owner = StringField(db_field='owner')
+    expires = DateTimeField(db_field='expires')
+
+    meta = {'collection': 'task_lock'}
@@ -0,0 +1,137 @@
+"""
+Authentication of the requests the directories of a tree send to each other.
+
+A directory forwarding a request on behalf of its user, e.g. the subject of an enforced search, signs the claims it
+sends with the secret shared by all directories of the tree (`TREE_SECRET`), using HMAC-SHA256. The requests changing
+the topology of the tree carry the signature of their body in the `X-Peer-Token` header instead. The receiver only
+trusts claims whose signature matches and which were signed at most `PEER_TOKEN_TTL` seconds ago, so a client calling
+a directory directly cannot forge them, whatever its address.
+
+A token is `<claims>.<signature>`, both base64url encoded, and the claims hold the signing time in `iat`.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+from flask import current_app as app
+from flask import has_app_context
+
+# seconds a signed token is accepted after it was signed
+DEFAULT_PEER_TOKEN_TTL = 60
+# header carrying the signature of the body of a request sent to a peer directory
+PEER_TOKEN_HEADER = 'X-Peer-Token'
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def get_tree_secret():
+    """Get the secret shared by the directories of the tree, None if it is not configured
+    """
+    return app.config.get('TREE_SECRET') if has_app_context() else None
+
+
+def get_token_ttl() -> float:
+    return app.config.get('PEER_TOKEN_TTL', DEFAULT_PEER_TOKEN_TTL) if has_app_context() else DEFAULT_PEER_TOKEN_TTL
+
+
+def _sign(payload: str, secret: str) -> str:
+    return _encode(hmac.new(secret.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest())
+
+
+def sign_claims(claims: dict, secret: str = None):
+    """Sign claims with the tree secret
+
+    Args:
+        claims (dict): JSON serializable claims
+        secret (str): optional, the tree secret, by default the one of the current app
+
+    Returns:
+        str: the signed token, None if no tree secret is configured
+    """
+    secret = secret or get_tree_secret()
+    if not secret:
+        return None
+    payload = _encode(json.dumps(dict(claims, iat=time.time())).encode('utf-8'))
+    return f"{payload}.{_sign(payload, secret)}"
+
+
+def verify_claims(token, secret: str = None, ttl: float = None):
+    """Get the claims of a token signed with the tree secret
+
+    Args:
+        token (str): the signed token
+        secret (str): optional, the tree secret, by default the one of the current app
+        ttl (float): optional, seconds the token is accepted after it was signed, by default `PEER_TOKEN_TTL`
+
+    Returns:
+        dict: the claims, None if the token is malformed, not signed with the tree secret or expired. The clocks of
+            the directories may differ by up to the ttl
+    """
+    secret = secret or get_tree_secret()
+    if not secret or not isinstance(token, str) or token.count('.') != 1:
+        return None
+    payload, signature = token.split('.')
+    if not hmac.compare_digest(_sign(payload, secret), signature):
+        return None
+    try:
+        claims = json.loads(_decode(payload))
+    except ValueError:
+        return None
+    ttl = get_token_ttl() if ttl is None else ttl
+    if type(claims) != dict or not isinstance(claims.get('iat'), (int, float)) or \
+            abs(time.time() - claims['iat']) > ttl:
+        return None
+    return claims
+
+
+def get_forwarded_subject(token, secret: str = None):
+    """Get the subject and the [user attributes, server attributes] forwarded by another directory of the tree
+
+    Args:
+        token (str): the `_subject` argument of the request
+        secret (str): optional, the tree secret, by default the one of the current app
+
+    Returns:
+        tuple: (subject, auth_attributes), None if the token is not validly signed or its claims are malformed, in
+            which case the caller is evaluated as itself
+    """
+    claims = verify_claims(token, secret)
+    if claims is None:
+        return None
+    subject, auth_attributes = claims.get('subject'), claims.get('auth_attributes')
+    if type(subject) != dict or type(subject.get('id')) != str or type(subject.get('attributes')) != dict:
+        return None
+    if type(auth_attributes) != list or len(auth_attributes) != 2 or \
+            any(type(attributes) != dict for attributes in auth_attributes):
+        return None
+    return subject, auth_attributes
+
+
+
+def get_signed_headers(body: str, headers: dict, secret: str = None) -> dict:
+    """Add the signature of a request body to the headers of the request, sent to another directory of the tree
+
+    The body is signed together with the signing time, so the signature cannot be reused for another body and
+    expires after `PEER_TOKEN_TTL` seconds. No signature is added if no tree secret is configured.
+    """
+    token = sign_claims({'body': hashlib.sha256(body.encode('utf-8')).hexdigest()}, secret)
+    return dict(headers, **{PEER_TOKEN_HEADER: token}) if token is not None else dict(headers)
+
+
+def is_signed_request(request, secret: str = None) -> bool:
+    """Check that the body of a request was signed by another directory of the tree with `get_signed_headers`
+
+    Args:
+        request (flask.Request): the received request
+        secret (str): optional, the tree secret, by default the one of the current app
+    """
+    claims = verify_claims(request.headers.get(PEER_TOKEN_HEADER), secret)
+    return claims is not None and claims.get('body') == hashlib.sha256(request.get_data()).hexdigest()
@@ -0,0 +1,378 @@
+"""
+Health of the peer directories (parent, ancestors, children and master) of the current directory.
+
+Every request to a peer goes through a per-peer circuit breaker. After `CIRCUIT_FAILURE_THRESHOLD` consecutive
+failures the circuit opens and requests to the peer fail immediately, without waiting for a timeout. After
+`CIRCUIT_RESET_TIMEOUT` seconds, or as soon as a background health probe succeeds, the circuit becomes half-open and
+a single trial request decides whether it closes again.
+
+A directory may have several instances sharing its database. Requests go to a healthy instance with the fewest
+outstanding requests, and reads slower than a latency percentile are hedged with a duplicate request to another
+instance.
+
+When a peer is skipped or fails during a read, the response of the current directory is marked as partial with
+the `X-Partial-Result` header, and the mark of a partial child response is propagated to the ancestors.
+"""
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+
+import requests
+from flask import current_app as app
+from flask import g, has_app_context, has_request_context, url_for
+
+from .routing import routing_table, get_base_url
+from .tasks import start_periodic_task
+
+PARTIAL_RESULT_HEADER = 'X-Partial-Result'
+# headers of the JSON requests sent to peer directories
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept-Charset': 'UTF-8'
+}
+# seconds to wait for a peer to connect and to answer
+DEFAULT_PEER_TIMEOUT = 10
+# seconds to wait for a peer running a long operation, such as a bulk operation or a query fanned out to its subtree
+DEFAULT_PEER_LONG_TIMEOUT = 300
+DEFAULT_HEALTH_CHECK_TIMEOUT = 2
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 30
+# hedge a read when it is slower than this percentile of the recent latencies of the instance
+DEFAULT_HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# worker threads of the hedged reads
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='peer-request')
+
+
+class PeerUnavailable(requests.RequestException):
+    """Raised instead of sending a request to a peer whose circuit is open
+    """
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of one peer, with the closed, open and half-open states
+    """
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self._lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failure_count = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def allow_request(self) -> bool:
+        """Check whether a request may be sent to the peer now
+
+        In the half-open state only one trial request is allowed at a time.
+        """
+        with self._lock:
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failure_count = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or self.failure_count >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def record_probe_success(self):
+        """A successful health probe lets the next request try the peer again
+        """
+        with self._lock:
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            elif self.state == CLOSED:
+                self.failure_count = 0
+
+    def to_report(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failure_count,
+                "opened_at": self.opened_at
+            }
+
+
+class PeerRegistry(object):
+    """Circuit breakers, outstanding requests and recent latencies of all peers, keyed by the base URL (scheme and
+    host) of the peer instance
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._outstanding = {}
+        self._latencies = {}
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        peer = get_base_url(url)
+        breaker = self._breakers.get(peer)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(peer)
+                if breaker is None:
+                    breaker = CircuitBreaker(get_config('CIRCUIT_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD),
+                                             get_config('CIRCUIT_RESET_TIMEOUT', DEFAULT_RESET_TIMEOUT))
+                    self._breakers[peer] = breaker
+        return breaker
+
+    def is_available(self, url: str) -> bool:
+        """Check whether the circuit of the peer at `url` is not open, without taking a half-open trial
+        """
+        return self.get_breaker(url).state != OPEN
+
+    def begin_request(self, url: str):
+        peer = get_base_url(url)
+        with self._lock:
+            self._outstanding[peer] = self._outstanding.get(peer, 0) + 1
+
+    def end_request(self, url: str, latency: float = None):
+        peer = get_base_url(url)
+        with self._lock:
+            self._outstanding[peer] = self._outstanding.get(peer, 1) - 1
+            if latency is not None:
+                self._latencies.setdefault(peer, deque(maxlen=LATENCY_SAMPLES)).append(latency)
+
+    def get_latency_percentile(self, url: str, percentile: float):
+        """Get the `percentile`-th percentile of the recent latencies of the peer in seconds, or None if there are
+        not enough samples
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get(get_base_url(url), []))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, max(0, math.ceil(percentile / 100 * len(samples)) - 1))]
+
+    def choose_instance(self, urls: list) -> str:
+        """Choose the healthy instance with the fewest outstanding requests, ties are broken randomly
+        """
+        healthy_urls = [url for url in urls if self.is_available(url)] or urls
+        with self._lock:
+            return min(healthy_urls, key=lambda url: (self._outstanding.get(get_base_url(url), 0), random.random()))
+
+    def get_status(self) -> dict:
+        with self._lock:
+            breakers = dict(self._breakers)
+            outstanding = dict(self._outstanding)
+        status = {}
+        for peer, breaker in breakers.items():
+            status[peer] = breaker.to_report()
+            status[peer]["outstanding"] = outstanding.get(peer, 0)
+            status[peer]["p95_latency"] = self.get_latency_percentile(peer, 95)
+        return status
+
+
+peer_registry = PeerRegistry()
+routing_table.set_instance_selector(peer_registry.choose_instance)
+
+
+def get_config(key: str, default):
+    return app.config.get(key, default) if has_app_context() else default
+
+
+def get_long_timeout() -> float:
+    """Get the timeout of the requests to peers running long operations, to pass as `timeout` to `peer_request`
+    """
+    return get_config('PEER_LONG_TIMEOUT', DEFAULT_PEER_LONG_TIMEOUT)
+
+
+def mark_partial_result():
+    """Mark the response of the current request as partial, since some peers were skipped or failed
+    """
+    if has_request_context():
+        g.partial_result = True
+
+
+def is_partial_result() -> bool:
+    return has_request_context() and g.get('partial_result', False)
+
+
+def replace_base_url(url: str, base_url: str) -> str:
+    """Send the same request to another instance, by replacing the scheme and host part of `url`
+    """
+    return get_base_url(base_url) + url[len(get_base_url(url)):]
+
+
+def get_healthy_url(url: str) -> str:
+    """Redirect a request to a healthy instance of the same directory if the circuit of `url` is open
+    """
+    if peer_registry.is_available(url):
+        return url
+    alternates = [alternate for alternate in routing_table.get_alternate_urls(url)
+                  if peer_registry.is_available(alternate)]
+    return replace_base_url(url, peer_registry.choose_instance(alternates)) if alternates else url
+
+
+def send_to_peer(method: str, url: str, kwargs: dict) -> requests.Response:
+    """Send one request through the circuit breaker of the peer, and record its outcome and latency
+
+    It does not use the flask context, so it can run in a worker thread.
+    """
+    breaker = peer_registry.get_breaker(url)
+    if not breaker.allow_request():
+        raise PeerUnavailable(f"Circuit of {get_base_url(url)} is open")
+    peer_registry.begin_request(url)
+    start = time.perf_counter()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except requests.RequestException:
+        peer_registry.end_request(url)
+        breaker.record_failure()
+        raise
+    peer_registry.end_request(url, time.perf_counter() - start)
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+def _is_failed(future) -> bool:
+    """Check whether a finished request failed, with a request error or a 5xx response
+    """
+    try:
+        return future.result().status_code >= 500
+    except requests.RequestException:
+        return True
+
+
+def send_hedged(method: str, url: str, kwargs: dict, percentile: float) -> requests.Response:
+    """Send a read request, and send a duplicate to another instance if no answer came within the latency percentile
+
+    A request failing within the latency percentile goes to another instance at once. The first successful response
+    wins, the slower request is left to finish in the background. If both fail, a 5xx response is returned rather
+    than a request error.
+    """
+    alternates = [alternate for alternate in routing_table.get_alternate_urls(url)
+                  if peer_registry.is_available(alternate)]
+    threshold = peer_registry.get_latency_percentile(url, percentile) if alternates else None
+    if threshold is None:
+        return send_to_peer(method, url, kwargs)
+
+    primary = _executor.submit(send_to_peer, method, url, kwargs)
+    done, _ = wait([primary], timeout=threshold)
+    if done and not _is_failed(primary):
+        return primary.result()
+    hedge_url = replace_base_url(url, peer_registry.choose_instance(alternates))
+    pending = {primary, _executor.submit(send_to_peer, method, hedge_url, kwargs)} - done
+    fallback = None
+    while True:
+        for future in done:
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                fallback = fallback if isinstance(fallback, requests.Response) else e
+                continue
+            if response.status_code < 500:
+                return response
+            fallback = response
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    if isinstance(fallback, requests.Response):
+        return fallback
+    raise fallback
+
+
+def peer_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request to a peer directory through its circuit breaker, with a timeout
+
+    When the directory has several instances, a request whose instance has an open circuit goes to a healthy
+    instance, and a GET request is hedged to another instance when it is slower than the `HEDGE_PERCENTILE`-th
+    percentile of the recent latencies of its instance, or fails before. A GET request that fails or returns a
+    partial result marks the response of the current request as partial.
+
+    Args:
+        method (str): the HTTP method
+        url (str): the request URL
+        kwargs: other arguments of `requests.request`
+
+    Returns:
+        requests.Response: the response of the peer
+
+    Raises:
+        PeerUnavailable: if the circuit of the peer is open
+        requests.RequestException: if the request failed or timed out
+    """
+    kwargs.setdefault('timeout', get_config('PEER_TIMEOUT', DEFAULT_PEER_TIMEOUT))
+    percentile = get_config('HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE)
+    url = get_healthy_url(url)
+    try:
+        if method == 'GET' and percentile:
+            response = send_hedged(method, url, kwargs, percentile)
+        else:
+            response = send_to_peer(method, url, kwargs)
+    except requests.RequestException:
+        if method == 'GET':
+            mark_partial_result()
+        raise
+    # only a read returns a partial result, the callers of other requests handle their failures
+    if method == 'GET' and (response.status_code >= 500 or response.headers.get(PARTIAL_RESULT_HEADER) == 'true'):
+        mark_partial_result()
+    return response
+
+
+def peer_get(url: str, **kwargs) -> requests.Response:
+    return peer_request('GET', url, **kwargs)
+
+
+def peer_post(url: str, **kwargs) -> requests.Response:
+    return peer_request('POST', url, **kwargs)
+
+
+def peer_delete(url: str, **kwargs) -> requests.Response:
+    return peer_request('DELETE', url, **kwargs)
+
+
+def probe_peers():
+    """Check the health endpoint of every known peer once, and update its circuit breaker
+    """
+    timeout = get_config('HEALTH_CHECK_TIMEOUT', DEFAULT_HEALTH_CHECK_TIMEOUT)
+    peer_urls = {get_base_url(url): url for directory in routing_table.get_directories() for url in directory.instances}
+    for peer_url in peer_urls.values():
+        breaker = peer_registry.get_breaker(peer_url)
+        try:
+            response = requests.get(urljoin(peer_url, url_for('api.health')), timeout=timeout)
+        except requests.RequestException:
+            breaker.record_failure()
+            continue
+        if response.status_code == 200:
+            breaker.record_probe_success()
+        else:
+            breaker.record_failure()
+
+
+def start_health_prober(app):
+    """Periodically probe all peers in the background, every `HEALTH_CHECK_INTERVAL` seconds (10 by default)
+    """
+    return start_periodic_task(app, "health-prober", app.config.get('HEALTH_CHECK_INTERVAL', 10), probe_peers)
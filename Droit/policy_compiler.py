@@ -0,0 +1,317 @@
+"""
+Compilation of policies into closures, so a decision does not interpret the rule trees of py_abac.
+
+Each policy in JSON format is compiled once per policy set: the targets become precompiled fnmatch patterns, every
+condition becomes a function of the attribute value with its regular expression, number or member set prepared, and
+every attribute path becomes a function reading the attributes of the access request. Attribute values are resolved
+at most once per decision, from the access request first and then from the attribute providers in order, like the
+evaluation context of py_abac.
+
+With the highest priority algorithm the policies are evaluated in the order of decreasing priority, denies before
+allows of the same priority, so the first policy that fits the request decides. Policies with conditions that are not
+compiled, such as the conditions comparing two attributes, are evaluated by py_abac in the same order.
+"""
+import fnmatch
+import ipaddress
+import operator
+import re
+
+from objectpath import Tree
+from py_abac import AccessRequest
+from py_abac.context import EvaluationContext
+
+from .attribute_providers import ATTRIBUTE_PROVIDERS
+
+ACCESS_CONTROL_ELEMENTS = ("subject", "resource", "action", "context")
+# attribute paths reading one attribute, they are read from the attributes without ObjectPath
+SIMPLE_PATH = re.compile(r"\$\.([A-Za-z_]\w*)")
+# a bare name such as `id` is an ObjectPath string literal, a rule on it does not depend on the request
+LITERAL_PATH = re.compile(r"[A-Za-z_]\w*")
+OBJECTPATH_KEYWORDS = {"true", "false", "null", "and", "or", "not", "in", "is"}
+
+STRING_CONDITIONS = {
+    "Equals": operator.eq,
+    "NotEquals": operator.ne,
+    "Contains": lambda what, value: value in what,
+    "NotContains": lambda what, value: value not in what,
+    "StartsWith": str.startswith,
+    "EndsWith": str.endswith
+}
+NUMERIC_CONDITIONS = {
+    "Eq": operator.eq,
+    "Neq": operator.ne,
+    "Gt": operator.gt,
+    "Gte": operator.ge,
+    "Lt": operator.lt,
+    "Lte": operator.le
+}
+COLLECTION_CONDITIONS = {
+    "AllIn": lambda what, members: set(what).issubset(members),
+    "AllNotIn": lambda what, members: not set(what).issubset(members),
+    "AnyIn": lambda what, members: bool(set(what).intersection(members)),
+    "AnyNotIn": lambda what, members: not set(what).intersection(members),
+    "IsEmpty": lambda what, members: len(what) == 0,
+    "IsNotEmpty": lambda what, members: len(what) != 0
+}
+
+
+class UncompilableCondition(Exception):
+    """Raised when a condition has no compiled equivalent
+    """
+
+
+def get_literal_value(attribute_path: str):
+    """Get the string an attribute path evaluates to if it is a literal, or None if it reads an attribute
+    """
+    if LITERAL_PATH.fullmatch(attribute_path) and attribute_path not in OBJECTPATH_KEYWORDS:
+        return attribute_path
+    return None
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float))
+
+
+def _is_collection(value) -> bool:
+    return isinstance(value, (list, set, tuple))
+
+
+def _membership(values: list):
+    try:
+        members = frozenset(values)
+    except TypeError:
+        return lambda what: what in values
+
+    def contains(what):
+        try:
+            return what in members
+        except TypeError:
+            return what in values
+    return contains
+
+
+def _cidr(value: str):
+    try:
+        network = ipaddress.ip_network(value)
+    except ValueError:
+        return lambda what: False
+
+    def contains(what):
+        if not isinstance(what, str):
+            return False
+        try:
+            return ipaddress.ip_address(what) in network
+        except ValueError:
+            return False
+    return contains
+
+
+def compile_condition(condition: dict):
+    """Compile a py_abac condition in JSON format into a function of the attribute value
+
+    The functions check the type of the value like the conditions of py_abac: string conditions are only satisfied
+    by strings, numeric conditions by numbers and collection conditions by lists, sets or tuples.
+
+    Raises:
+        UncompilableCondition: if the condition compares with other attributes or is unknown
+    """
+    name = condition.get("condition")
+    value = condition.get("value")
+    if name == "RegexMatch":
+        search = re.compile(value).search
+        return lambda what: isinstance(what, str) and search(what) is not None
+    if name in STRING_CONDITIONS:
+        test = STRING_CONDITIONS[name]
+        if condition.get("case_insensitive"):
+            lowered = value.lower()
+            return lambda what: isinstance(what, str) and test(what.lower(), lowered)
+        return lambda what: isinstance(what, str) and test(what, value)
+    if name in NUMERIC_CONDITIONS:
+        test = NUMERIC_CONDITIONS[name]
+        return lambda what: _is_number(what) and test(what, value)
+    if name in COLLECTION_CONDITIONS:
+        test = COLLECTION_CONDITIONS[name]
+        members = condition.get("values", [])
+        try:
+            members = frozenset(members)
+        except TypeError:
+            pass
+        return lambda what: _is_collection(what) and test(what, members)
+    if name == "IsIn":
+        return _membership(condition.get("values", []))
+    if name == "IsNotIn":
+        contains = _membership(condition.get("values", []))
+        return lambda what: not contains(what)
+    if name in ("AllOf", "AnyOf"):
+        checks = [compile_condition(nested) for nested in condition.get("values", [])]
+        combine = all if name == "AllOf" else any
+        return lambda what: combine(check(what) for check in checks)
+    if name == "Not":
+        check = compile_condition(value)
+        return lambda what: not check(what)
+    if name == "Any":
+        return lambda what: True
+    if name == "Exists":
+        return lambda what: what is not None
+    if name == "NotExists":
+        return lambda what: what is None
+    if name == "CIDR":
+        return _cidr(value)
+    raise UncompilableCondition(f"condition {name}")
+
+
+def compile_path(attribute_path: str):
+    """Compile an attribute path into a function reading the attributes of an access control element
+    """
+    literal = get_literal_value(attribute_path)
+    if literal is not None:
+        return lambda attributes: literal
+    match = SIMPLE_PATH.fullmatch(attribute_path)
+    if match is not None:
+        name = match.group(1)
+        return lambda attributes: attributes.get(name)
+    return lambda attributes: Tree(attributes).execute(attribute_path)
+
+
+class AccessContext(object):
+    """Attributes of one access request, each attribute path is resolved at most once
+
+    It exposes the ids of the request to the attribute providers like the evaluation context of py_abac.
+    """
+
+    def __init__(self, request_json: dict, providers: list = ATTRIBUTE_PROVIDERS):
+        self._request_json = request_json
+        self._providers = providers
+        self._values = {}
+        self._evaluation_context = None
+        self.subject_id = request_json["subject"]["id"]
+        self.resource_id = request_json["resource"]["id"]
+        self.action_id = request_json["action"]["id"]
+
+    def get_attribute_value(self, ace: str, attribute_path: str, read=None):
+        """Get the value of an attribute from the access request, or from the first provider returning one
+
+        Args:
+            ace (str): subject, resource, action or context
+            attribute_path (str): the attribute path in ObjectPath notation
+            read: the compiled attribute path, compiled here if it is not given
+        """
+        key = (ace, attribute_path)
+        if key in self._values:
+            return self._values[key]
+        read = read or compile_path(attribute_path)
+        attributes = self._request_json[ace] if ace == "context" else self._request_json[ace]["attributes"]
+        value = read(attributes)
+        if value is None:
+            for provider in self._providers:
+                value = provider.get_attribute_value(ace, attribute_path, self)
+                if value is not None:
+                    break
+        self._values[key] = value
+        return value
+
+    def get_evaluation_context(self) -> EvaluationContext:
+        """Get the py_abac evaluation context of the request, for the policies that are not compiled
+        """
+        if self._evaluation_context is None:
+            self._evaluation_context = EvaluationContext(AccessRequest.from_json(self._request_json),
+                                                         self._providers)
+        return self._evaluation_context
+
+
+def compile_targets(ids):
+    """Compile a target, an id or a list of ids with fnmatch wildcards, into a function of the request id
+
+    Returns:
+        the function, or None if the target matches all ids
+    """
+    ids = ids if isinstance(ids, list) else [ids]
+    if "*" in ids:
+        return None
+    match = re.compile("|".join(f"(?:{fnmatch.translate(target)})" for target in ids)).match
+    return lambda ace_id: match(ace_id) is not None
+
+
+def compile_rules(ace: str, rules):
+    """Compile the rules of an access control element, a dict of attribute paths is a conjunction and a list of
+    such dicts is a disjunction
+    """
+    if isinstance(rules, list):
+        alternatives = [compile_rules(ace, alternative) for alternative in rules]
+        return lambda context: any(fits(context) for fits in alternatives)
+    # a rule with the Any condition is always satisfied, its attribute is not resolved
+    checks = [(attribute_path, compile_path(attribute_path), compile_condition(condition))
+              for attribute_path, condition in rules.items() if condition.get("condition") != "Any"]
+
+    def fits(context: AccessContext) -> bool:
+        for attribute_path, read, check in checks:
+            if not check(context.get_attribute_value(ace, attribute_path, read)):
+                return False
+        return True
+    return fits
+
+
+def compile_policy(policy):
+    """Compile a policy into a function telling whether it fits an access context
+
+    The targets are checked before the rules, so the attributes are only resolved for the policies targeting the
+    request.
+    """
+    policy_json = policy.to_json()
+    targets = policy_json.get("targets") or {}
+    try:
+        rules = [compile_rules(ace, policy_json["rules"].get(ace, {})) for ace in ACCESS_CONTROL_ELEMENTS]
+    except UncompilableCondition:
+        return lambda context: policy.fits(context.get_evaluation_context())
+    matchers = []
+    for ace in ("subject", "resource", "action"):
+        matcher = compile_targets(targets.get(f"{ace}_id", "*"))
+        if matcher is not None:
+            matchers.append((f"{ace}_id", matcher))
+
+    def fits(context: AccessContext) -> bool:
+        for attribute, matcher in matchers:
+            if not matcher(getattr(context, attribute)):
+                return False
+        for fits_rules in rules:
+            if not fits_rules(context):
+                return False
+        return True
+    return fits
+
+
+class CompiledPolicies(object):
+    """Compiled policies of a policy set, evaluated with the highest priority algorithm
+
+    The policies must be ordered by decreasing priority with the denies before the allows of the same priority,
+    as in `PolicySet`.
+    """
+
+    def __init__(self, policies: list, providers: list = ATTRIBUTE_PROVIDERS):
+        self._policies = policies
+        self._providers = providers
+        # id of the policy => (True if it allows the access, function telling whether it fits)
+        self._compiled = {id(policy): (policy.is_allowed, compile_policy(policy)) for policy in policies}
+
+    def get_deciding_policy(self, request_json: dict, policies: list = None):
+        """Get the policy deciding an access request, the first fitting one
+
+        Args:
+            request_json (dict): the access request in the JSON format of py_abac
+            policies (list): the candidate policies of the request in the same order, by default all policies
+
+        Returns:
+            Policy: the deciding policy, or None if no policy fits and the access is denied
+        """
+        context = AccessContext(request_json, self._providers)
+        for policy in self._policies if policies is None else policies:
+            fits = self._compiled[id(policy)][1]
+            if fits(context):
+                return policy
+        return None
+
+    def is_allowed(self, request_json: dict, policies: list = None) -> bool:
+        """Decide an access request, the first fitting policy decides and the access is denied if none fits
+        """
+        policy = self.get_deciding_policy(request_json, policies)
+        return policy is not None and self._compiled[id(policy)][0]
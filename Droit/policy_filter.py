@@ -0,0 +1,209 @@
+"""
+Partial evaluation of policies into a MongoDB filter over thing descriptions.
+
+For a fixed subject and action, the subject, action and context rules of each policy are evaluated once, and the
+resource rules and the resource target of the applicable policies are translated into query predicates on the thing
+descriptions. Combined with the highest priority algorithm, where a deny wins over an allow of the same priority,
+the filter selects exactly the permitted thing descriptions, so the database returns only those.
+
+Resource rules that depend on attributes resolved by the attribute providers, such as `$.timespan`, or on conditions
+without a query equivalent cannot be translated, and `get_permitted_filter` returns None so the caller falls back to
+evaluating each thing description.
+"""
+import fnmatch
+import re
+
+from py_abac import Policy
+
+from .policy_compiler import CompiledPolicies, UncompilableCondition, compile_condition, get_literal_value
+from .policy_helper import policy_cache
+
+# resource attribute paths stored as fields of the thing descriptions, the thing id is only in the access request
+# id and can only be constrained by the resource target
+RESOURCE_FIELDS = {
+    "$.thing_type": "thing_type"
+}
+# a filter that matches no thing description
+MATCH_NOTHING = {"thing_id": {"$in": []}}
+
+COMPARISONS = {"Gt": "$gt", "Gte": "$gte", "Lt": "$lt", "Lte": "$lte"}
+
+
+class UntranslatableRule(Exception):
+    """Raised when a resource rule has no MongoDB query equivalent
+    """
+
+
+def translate_literal_rule(attribute_path: str, condition: dict) -> dict:
+    """Evaluate a condition on a literal attribute path once, it matches all or no thing descriptions
+
+    Raises:
+        UntranslatableRule: if the condition compares with other attributes
+    """
+    try:
+        satisfied = compile_condition(condition)(get_literal_value(attribute_path))
+    except UncompilableCondition:
+        raise UntranslatableRule(f"condition {condition.get('condition')} on {attribute_path}")
+    return {} if satisfied else MATCH_NOTHING
+
+
+def _regex(pattern: str, condition: dict) -> dict:
+    query = {"$regex": pattern}
+    if condition.get("case_insensitive"):
+        query["$options"] = "i"
+    return query
+
+
+def translate_condition(field: str, condition: dict) -> dict:
+    """Translate a py_abac condition in JSON format on `field` into a MongoDB query predicate
+
+    Raises:
+        UntranslatableRule: if the condition has no query equivalent
+    """
+    name = condition.get("condition")
+    value = condition.get("value")
+    if name == "AllOf":
+        return {"$and": [translate_condition(field, c) for c in condition.get("values", [])]} \
+            if condition.get("values") else {}
+    if name == "AnyOf":
+        return {"$or": [translate_condition(field, c) for c in condition.get("values", [])]} \
+            if condition.get("values") else MATCH_NOTHING
+    if name == "Not":
+        return {"$nor": [translate_condition(field, value)]}
+    if name in ("Equals", "Eq"):
+        if condition.get("case_insensitive") and isinstance(value, str):
+            return {field: _regex(f"^{re.escape(value)}$", condition)}
+        return {field: value}
+    if name in COMPARISONS and not condition.get("case_insensitive"):
+        return {field: {COMPARISONS[name]: value}}
+    # like py_abac, a negated comparison is not satisfied by a value of another type or a missing value
+    if name == "Neq":
+        return {field: {"$ne": value, "$type": "number"}}
+    if name == "NotEquals" and not condition.get("case_insensitive"):
+        return {field: {"$ne": value, "$type": "string"}}
+    if name == "RegexMatch":
+        return {field: _regex(value, condition)}
+    if name == "StartsWith":
+        return {field: _regex(f"^{re.escape(value)}", condition)}
+    if name == "EndsWith":
+        return {field: _regex(f"{re.escape(value)}$", condition)}
+    if name == "Contains" and isinstance(value, str):
+        return {field: _regex(re.escape(value), condition)}
+    if name == "NotContains" and isinstance(value, str):
+        return {field: {"$not": _regex(re.escape(value), condition), "$type": "string"}}
+    if name == "IsIn":
+        return {field: {"$in": condition.get("values", [])}}
+    if name == "IsNotIn":
+        return {field: {"$nin": condition.get("values", [])}}
+    if name == "Exists":
+        return {field: {"$ne": None}}
+    if name == "NotExists":
+        return {field: None}
+    if name == "Any":
+        return {}
+    raise UntranslatableRule(f"condition {name} on {field}")
+
+
+def translate_resource_rules(rules) -> dict:
+    """Translate the resource rules of a policy in JSON format, a dict of attribute paths is a conjunction and a
+    list of such dicts is a disjunction
+    """
+    if isinstance(rules, list):
+        return {"$or": [translate_resource_rules(r) for r in rules]} if rules else MATCH_NOTHING
+    predicates = []
+    for attribute_path, condition in rules.items():
+        if get_literal_value(attribute_path) is not None:
+            predicates.append(translate_literal_rule(attribute_path, condition))
+        elif attribute_path in RESOURCE_FIELDS:
+            predicates.append(translate_condition(RESOURCE_FIELDS[attribute_path], condition))
+        else:
+            raise UntranslatableRule(f"attribute {attribute_path}")
+    return _and(*predicates)
+
+
+def translate_resource_target(resource_id) -> dict:
+    """Translate the resource target of a policy, with '*', '?' or '[' wildcards, into a predicate on the thing id
+    """
+    if resource_id is None or resource_id == "*":
+        return {}
+    if isinstance(resource_id, list):
+        return {"$or": [translate_resource_target(r) for r in resource_id]} if resource_id else MATCH_NOTHING
+    if set("*?[") & set(resource_id):
+        return {"thing_id": {"$regex": fnmatch.translate(resource_id)}}
+    return {"thing_id": resource_id}
+
+
+def _and(*predicates) -> dict:
+    predicates = [predicate for predicate in predicates if predicate]
+    if not predicates:
+        return {}
+    return predicates[0] if len(predicates) == 1 else {"$and": list(predicates)}
+
+
+def build_partial_policies(policies: list) -> list:
+    """Split each policy into its resource predicate and a policy without resource constraints
+
+    Returns:
+        list: (policy, resource predicate or None if untranslatable, compiled policy deciding whether the rest of
+            the policy applies), in the order of decreasing priority
+    """
+    partial_policies = []
+    for policy in policies:
+        policy_json = policy.to_json()
+        targets = dict(policy_json.get("targets") or {})
+        try:
+            predicate = _and(translate_resource_target(targets.get("resource_id")),
+                             translate_resource_rules(policy_json["rules"].get("resource", {})))
+        except UntranslatableRule:
+            predicate = None
+        # the remaining policy allows exactly when the subject, action and context rules are satisfied
+        targets["resource_id"] = "*"
+        policy_json["targets"] = targets
+        policy_json["rules"] = dict(policy_json["rules"], resource={})
+        policy_json["effect"] = "allow"
+        rest = CompiledPolicies([Policy.from_json(policy_json)])
+        partial_policies.append((policy, predicate, rest))
+    return partial_policies
+
+
+def get_permitted_filter(subject: dict, action: str, policy_location: str):
+    """Get the MongoDB filter selecting the thing descriptions `subject` may access with `action`
+
+    Args:
+        subject (dict): the subject returned by `get_access_subject`
+        action (str): get, delete, or create
+        policy_location (str): the location of the policies
+
+    Returns:
+        dict: the filter, or None if some applicable policy cannot be translated
+    """
+    partial_policies = policy_cache.get_policies(policy_location).get_derived('partial', build_partial_policies)
+    access_request = {
+        "subject": subject,
+        "resource": {"id": "", "attributes": {}},
+        "action": {"id": "", "attributes": {"method": action}},
+        "context": {}
+    }
+    applicable = []
+    for policy, predicate, rest in partial_policies:
+        if not rest.is_allowed(access_request):
+            continue
+        if predicate is None:
+            return None
+        applicable.append((policy, predicate))
+
+    # an allowed thing matches an allow policy, and no deny policy of the same or a higher priority
+    allowed = []
+    for policy, predicate in applicable:
+        if policy.effect != "allow":
+            continue
+        denies = [deny_predicate for deny, deny_predicate in applicable
+                  if deny.effect != "allow" and deny.priority >= policy.priority]
+        if {} in denies:
+            continue
+        allowed.append(_and(predicate, {"$nor": denies} if denies else {}))
+    if not allowed:
+        return MATCH_NOTHING
+    if {} in allowed:
+        return {}
+    return allowed[0] if len(allowed) == 1 else {"$or": allowed}
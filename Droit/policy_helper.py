@@ -0,0 +1,258 @@
+"""
+Policy decision points kept in memory, one per policy location.
+
+The policies of a location are read from its MongoDB storage and parsed once, then held by an in-memory storage
+shared by a cached PDP, so a decision only evaluates the rules. The cache of a location is invalidated when a
+policy is added or deleted there, and reloaded after `POLICY_CACHE_TTL` seconds. Every change also increases a
+version stored with the policies, which is read at most every `POLICY_VERSION_CHECK_INTERVAL` seconds, so the instances
+sharing the database reload the policies within that interval.
+
+The policies of the directory's own location also include the policies inherited from its ancestor directories,
+which are pulled by `views.policy_inheritance` and set here with their version. A directory with a parent denies every
+access until they are set.
+"""
+import fnmatch
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+from flask import current_app as app
+from flask import has_app_context
+from py_abac import PDP
+from py_abac.pdp import EvaluationAlgorithm
+from py_abac.storage.base import Storage
+from py_abac.storage.mongo import MongoStorage
+from pymongo import MongoClient
+
+from .attribute_providers import ATTRIBUTE_PROVIDERS
+from .policy_index import PolicyIndex
+
+DEFAULT_POLICY_CACHE_TTL = 60
+# seconds between two reads of the shared version of the policies of a location
+DEFAULT_POLICY_VERSION_CHECK_INTERVAL = 1
+# number of policies read from the storage in each query
+LOAD_BATCH_SIZE = 100
+# collection of the policy database counting the changes of its policies, shared by all instances using it
+POLICY_VERSION_COLLECTION = 'policy_version'
+
+_client = None
+_client_lock = threading.Lock()
+# every loaded policy set gets a new version, used to key the cached decisions
+_versions = itertools.count(1)
+
+
+def get_mongo_client() -> MongoClient:
+    """Get the MongoDB client shared by all policy storages, it keeps its own connection pool
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient()
+    return _client
+
+
+def get_policy_storage(location: str) -> MongoStorage:
+    """Get the MongoDB storage of the policies of `location`
+    """
+    return MongoStorage(get_mongo_client(), db_name=location)
+
+
+def get_shared_version(location: str) -> int:
+    """Get the number of changes of the policies of `location` made by any instance, 0 if they never changed
+    """
+    document = get_mongo_client()[location][POLICY_VERSION_COLLECTION].find_one({'_id': 'policies'})
+    return document['version'] if document is not None else 0
+
+
+def increase_shared_version(location: str):
+    """Count a change of the policies of `location`, so every instance reloads them at its next decision
+    """
+    get_mongo_client()[location][POLICY_VERSION_COLLECTION].update_one(
+        {'_id': 'policies'}, {'$inc': {'version': 1}}, upsert=True)
+
+
+class ReadOnlyPolicySetError(Exception):
+    """Raised when a cached policy set is asked to change, policies are changed in the MongoDB storage
+    """
+
+
+def target_matches(target_ids, ace_id: str) -> bool:
+    """Check whether a target, an id or a list of ids with fnmatch wildcards, matches an id like py_abac
+    """
+    target_ids = target_ids if isinstance(target_ids, list) else [target_ids]
+    return any(fnmatch.fnmatch(ace_id, target_id) for target_id in target_ids)
+
+
+class PolicySet(Storage):
+    """In-memory storage of the parsed policies of one location, read-only for the PDP
+
+    The policies are returned in the order of decreasing priority, denies before allows of the same priority, so with
+    the highest priority algorithm the first policy fitting a request decides.
+    """
+
+    def __init__(self, policies: list, version: int = None):
+        self._policies = sorted(policies, key=lambda policy: (-policy.priority, policy.is_allowed))
+        self._by_uid = {policy.uid: policy for policy in self._policies}
+        self.version = version if version is not None else next(_versions)
+        # structures derived from the policies, built once per policy set
+        self._derived = {}
+
+    def get_derived(self, name: str, build):
+        """Get a structure derived from the policies, built by `build(policies)` on the first use
+        """
+        if name not in self._derived:
+            self._derived[name] = build(self._policies)
+        return self._derived[name]
+
+    def add(self, policy):
+        raise ReadOnlyPolicySetError("Policies are added to the MongoDB storage")
+
+    def get(self, uid: str):
+        return self._by_uid.get(uid)
+
+    def get_all(self, limit: int, offset: int):
+        return iter(self._policies[offset:offset + limit])
+
+    def get_for_target(self, subject_id: str, resource_id: str, action_id: str):
+        """Get the candidate policies whose resource target matches `resource_id`, like the MongoDB storage queried
+        with the subject and action ids `*`; the PDP checks the subject and action targets
+        """
+        return iter([policy for policy in self.get_for_resource(resource_id)
+                     if target_matches(policy.targets.resource_id, resource_id)])
+
+    def get_for_resource(self, resource_id: str, thing_type: str = None) -> list:
+        """Get the policies that may apply to a resource from the target index, in the order of decreasing priority
+        """
+        return self.get_derived('index', PolicyIndex).get_candidates(resource_id, thing_type)
+
+    def update(self, policy):
+        raise ReadOnlyPolicySetError("Policies are updated in the MongoDB storage")
+
+    def delete(self, uid: str):
+        raise ReadOnlyPolicySetError("Policies are deleted from the MongoDB storage")
+
+    def __len__(self):
+        return len(self._policies)
+
+
+def load_policies(location: str) -> list:
+    """Read and parse all policies of `location` from its MongoDB storage
+    """
+    storage = get_policy_storage(location)
+    policies = []
+    while True:
+        batch = list(storage.get_all(LOAD_BATCH_SIZE, len(policies)))
+        policies.extend(batch)
+        if len(batch) < LOAD_BATCH_SIZE:
+            return policies
+
+
+def get_policy_digest(policies: list) -> str:
+    """Get a version of a list of policies that does not depend on their order or on the process that loaded them
+    """
+    policies_json = sorted((policy.to_json() for policy in policies), key=lambda policy_json: policy_json['uid'])
+    return hashlib.sha1(json.dumps(policies_json, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def make_pdp(policy_set: PolicySet) -> PDP:
+    return PDP(policy_set, EvaluationAlgorithm.HIGHEST_PRIORITY, ATTRIBUTE_PROVIDERS)
+
+
+class PolicyCache(object):
+    """Cached PDP and parsed policies of each location
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # location => (loaded_at, policy_set, pdp, shared version of the loaded policies)
+        self._entries = {}
+        # location => number of invalidations, so a load started before an invalidation is not kept
+        self._generations = {}
+        # location => (checked_at, shared version), so the database is not read by every lookup
+        self._version_checks = {}
+        # location => (version, parsed policies inherited from the ancestor directories)
+        self._inherited = {}
+        # locations that deny every access until their inherited policies are set
+        self._requires_inherited = set()
+
+    def _get_entry(self, location: str):
+        ttl = app.config.get('POLICY_CACHE_TTL', DEFAULT_POLICY_CACHE_TTL) if has_app_context() \
+            else DEFAULT_POLICY_CACHE_TTL
+        entry = self._entries.get(location)
+        # the policies changed by another instance are reloaded at once, so a policy set and the decisions cached
+        # under its version are never older than the shared version
+        shared_version = self._get_shared_version(location)
+        if entry is not None and time.time() - entry[0] < ttl and entry[3] == shared_version:
+            return entry
+        generation = self._generations.get(location, 0)
+        # without a policy every access is denied, a location does not decide with its own policies only
+        policy_set = PolicySet(load_policies(location) + self.get_inherited(location)[1]
+                               if self.is_inherited_loaded(location) else [])
+        entry = (time.time(), policy_set, make_pdp(policy_set), shared_version)
+        with self._lock:
+            if self._generations.get(location, 0) == generation:
+                self._entries[location] = entry
+        return entry
+
+    def _get_shared_version(self, location: str) -> int:
+        """Get the shared version of the policies of `location`, read at most every `POLICY_VERSION_CHECK_INTERVAL`
+        seconds
+        """
+        interval = app.config.get('POLICY_VERSION_CHECK_INTERVAL', DEFAULT_POLICY_VERSION_CHECK_INTERVAL) \
+            if has_app_context() else DEFAULT_POLICY_VERSION_CHECK_INTERVAL
+        checked = self._version_checks.get(location)
+        if checked is not None and time.time() - checked[0] < interval:
+            return checked[1]
+        shared_version = get_shared_version(location)
+        self._version_checks[location] = (time.time(), shared_version)
+        return shared_version
+
+    def get_pdp(self, location: str) -> PDP:
+        """Get the PDP evaluating the policies of `location`, loading them on the first use
+        """
+        return self._get_entry(location)[2]
+
+    def get_policies(self, location: str) -> PolicySet:
+        """Get the parsed policies of `location`, in the order of decreasing priority
+        """
+        return self._get_entry(location)[1]
+
+    def get_inherited(self, location: str) -> tuple:
+        """Get the version and the parsed policies `location` inherits, (None, []) if it inherits nothing
+        """
+        return self._inherited.get(location, (None, []))
+
+    def require_inherited(self, location: str):
+        """Deny every access of `location` until the policies it inherits are set, when it has a parent directory
+        """
+        with self._lock:
+            if location in self._requires_inherited:
+                return
+            self._requires_inherited.add(location)
+        self.invalidate(location)
+
+    def is_inherited_loaded(self, location: str) -> bool:
+        """Check whether `location` may decide, it does not inherit policies or the inherited policies are set
+        """
+        return location not in self._requires_inherited or location in self._inherited
+
+    def set_inherited(self, location: str, version: str, policies: list):
+        """Replace the policies `location` inherits from its ancestors, they are merged at the next decision
+        """
+        with self._lock:
+            self._inherited[location] = (version, policies)
+        self.invalidate(location)
+
+    def invalidate(self, location: str):
+        """Forget the policies of `location`, they are reloaded by the next decision
+        """
+        with self._lock:
+            self._entries.pop(location, None)
+            self._version_checks.pop(location, None)
+            self._generations[location] = self._generations.get(location, 0) + 1
+
+
+policy_cache = PolicyCache()
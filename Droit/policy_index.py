@@ -0,0 +1,97 @@
+"""
+Index of the policies of a location by the resources they may apply to.
+
+Each policy is indexed under the most selective constraint it puts on every resource it applies to: exact thing ids
+or a literal prefix of the thing id from the resource target, or the thing types from the top-level resource rules,
+which must all be satisfied. The thing id is not a resource attribute of the access request, so rules on it do not
+constrain the resource. Policies without such a constraint are always candidates. Finding the candidates of a
+resource costs one lookup per distinct prefix length instead of a scan of all policies.
+"""
+import re
+
+# resource attribute path of the thing type
+TYPE_PATH = "$.thing_type"
+
+
+def get_wildcard_prefix(resource_id: str) -> str:
+    """Get the literal prefix of a target with '*', '?' or '[' wildcards
+    """
+    return re.split(r"[*?\[]", resource_id, maxsplit=1)[0]
+
+
+def get_constraints(policy_json: dict) -> dict:
+    """Find the constraints a policy puts on every resource it applies to
+
+    Returns:
+        dict: {"ids": set of exact ids or None, "prefix": literal id prefix or None, "types": set of thing types or
+            None}
+    """
+    constraints = {"ids": None, "prefix": None, "types": None}
+    resource_id = (policy_json.get("targets") or {}).get("resource_id")
+    if isinstance(resource_id, str) and resource_id != "*":
+        if set("*?[") & set(resource_id):
+            constraints["prefix"] = get_wildcard_prefix(resource_id) or None
+        else:
+            constraints["ids"] = {resource_id}
+    elif isinstance(resource_id, list) and resource_id and all(
+            isinstance(target, str) and not set("*?[") & set(target) for target in resource_id):
+        constraints["ids"] = set(resource_id)
+
+    rules = policy_json.get("rules", {}).get("resource", {})
+    condition = rules.get(TYPE_PATH) if isinstance(rules, dict) else None
+    if not isinstance(condition, dict) or condition.get("case_insensitive"):
+        return constraints
+    if condition.get("condition") == "Equals" and isinstance(condition.get("value"), str):
+        constraints["types"] = {condition["value"]}
+    elif condition.get("condition") == "IsIn" and isinstance(condition.get("values"), list):
+        constraints["types"] = {value for value in condition["values"] if isinstance(value, str)}
+    return constraints
+
+
+class PolicyIndex(object):
+    """Candidate policies of a resource, by exact thing id, thing id prefix and thing type
+    """
+
+    def __init__(self, policies: list):
+        # position of each policy in the priority order, to return the candidates in that order
+        self._rank = {}
+        self._by_id = {}
+        self._by_prefix = {}
+        self._by_type = {}
+        self._generic = []
+        for rank, policy in enumerate(policies):
+            self._rank[id(policy)] = rank
+            constraints = get_constraints(policy.to_json())
+            if constraints["ids"] is not None:
+                for thing_id in constraints["ids"]:
+                    self._by_id.setdefault(thing_id, []).append(policy)
+            elif constraints["prefix"]:
+                self._by_prefix.setdefault(constraints["prefix"], []).append(policy)
+            elif constraints["types"] is not None:
+                for thing_type in constraints["types"]:
+                    self._by_type.setdefault(thing_type, []).append(policy)
+            else:
+                self._generic.append(policy)
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._by_prefix})
+
+    def get_candidates(self, resource_id: str, thing_type: str = None) -> list:
+        """Get the policies that may apply to a resource, in the order of decreasing priority
+
+        Args:
+            resource_id (str): the thing id
+            thing_type (str): the thing type, if it is unknown all policies indexed by type are candidates
+        """
+        resource_id = str(resource_id)
+        candidates = list(self._generic)
+        candidates.extend(self._by_id.get(resource_id, []))
+        for length in self._prefix_lengths:
+            if length > len(resource_id):
+                break
+            candidates.extend(self._by_prefix.get(resource_id[:length], []))
+        if thing_type is not None:
+            candidates.extend(self._by_type.get(thing_type, []))
+        else:
+            for policies in self._by_type.values():
+                candidates.extend(policies)
+        unique = {id(policy): policy for policy in candidates}
+        return sorted(unique.values(), key=lambda policy: self._rank[id(policy)])
@@ -0,0 +1,216 @@
+"""
+In-memory routing table of the current directory.
+
+The name-to-URL mappings (`loc_to_url`) and the target-to-child mappings (`targetLoc_to_childLoc`) are loaded from
+MongoDB once, and every routing lookup is then served from memory. The table must be refreshed whenever these
+collections change.
+
+When the paths of the directories are known (`loc_to_path`), a location in another branch is reached through the
+lowest common ancestor of the two directories instead of the master directory.
+
+A directory name may map to several instance URLs sharing the database of that directory. The routing lookups pick
+one instance with the instance selector, by default the first one; `peers` installs a selector preferring healthy
+instances with the fewest outstanding requests.
+"""
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urljoin, urlsplit
+
+from .models import DirectoryNameToURL, TargetToChildName, DirectoryPath
+from .tasks import start_periodic_task
+
+# A known directory, with the same attribute names as the `DirectoryNameToURL` documents.
+# `url` is the first instance, `instances` lists the URLs of all instances of the directory.
+Directory = namedtuple('Directory', ['directory_name', 'url', 'relationship', 'instances'])
+
+
+def get_base_url(url: str) -> str:
+    """Get the scheme and host part of a URL, which identifies a directory instance
+    """
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class RoutingTable(object):
+    """Compact in-process copy of the routing collections of the current directory
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._directories = {}
+        self._children = []
+        self._parent = None
+        self._master = None
+        self._target_to_child = {}
+        self._paths = {}
+        self._alternates = {}
+        self._instance_selector = lambda urls: urls[0]
+        # routing lookup latency metrics, in seconds
+        self._lookup_count = 0
+        self._lookup_time_total = 0.0
+        self._lookup_time_max = 0.0
+
+    def refresh(self):
+        """Reload the routing table from the database, it should be called after any topology change
+        """
+        instances = {}
+        relationships = {}
+        for document in DirectoryNameToURL.objects():
+            instances.setdefault(document.directory_name, []).append(document.url)
+            relationships[document.directory_name] = document.relationship
+        directories = {}
+        children = []
+        parent = None
+        master = None
+        alternates = {}
+        for directory_name, urls in instances.items():
+            directory = Directory(directory_name, urls[0], relationships[directory_name], tuple(urls))
+            directories[directory_name] = directory
+            if directory.relationship == 'child':
+                children.append(directory)
+            elif directory.relationship == 'parent':
+                parent = directory
+            elif directory.relationship == 'master':
+                master = directory
+            for url in urls:
+                alternates[get_base_url(url)] = [other for other in urls if get_base_url(other) != get_base_url(url)]
+        target_to_child = {mapping.target_name: mapping.child_name for mapping in TargetToChildName.objects()}
+        paths = {document.directory_name: list(document.path) for document in DirectoryPath.objects()}
+
+        with self._lock:
+            self._directories = directories
+            self._children = children
+            self._parent = parent
+            self._master = master
+            self._target_to_child = target_to_child
+            self._paths = paths
+            self._alternates = alternates
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.refresh()
+
+    def set_instance_selector(self, selector):
+        """Set the function choosing one URL among the instance URLs of a directory
+        """
+        self._instance_selector = selector
+
+    def get_url(self, directory: Directory) -> str:
+        """Get the URL of the instance of `directory` to send the next request to
+        """
+        if len(directory.instances) <= 1:
+            return directory.url
+        return self._instance_selector(list(directory.instances))
+
+    def get_alternate_urls(self, url: str) -> list:
+        """Get the base URLs of the other instances of the directory serving `url`
+        """
+        self._ensure_loaded()
+        return list(self._alternates.get(get_base_url(url), []))
+
+    def get_directory(self, directory_name: str):
+        """Get a directory known to current directory (ancestors, children or master) by its name, or None
+        """
+        self._ensure_loaded()
+        return self._directories.get(directory_name)
+
+    def get_directories(self) -> list:
+        """Get all directories known to current directory
+        """
+        self._ensure_loaded()
+        return list(self._directories.values())
+
+    def get_parent(self):
+        """Get the parent directory, or None if current directory is the root
+        """
+        self._ensure_loaded()
+        return self._parent
+
+    def get_children(self) -> list:
+        """Get all direct children directories
+        """
+        self._ensure_loaded()
+        return list(self._children)
+
+    def get_child_name(self, directory_name: str):
+        """Get the name of the child directory which `directory_name` is, or is reached through, or None
+        """
+        self._ensure_loaded()
+        child_name = self._target_to_child.get(directory_name, directory_name)
+        child = self._directories.get(child_name)
+        return child_name if child is not None and child.relationship == 'child' else None
+
+    def get_child_url(self, directory_name: str):
+        """Get the URL of the child directory which `directory_name` is, or is reached through, or None
+        """
+        child_name = self.get_child_name(directory_name)
+        return self.get_url(self._directories[child_name]) if child_name is not None else None
+
+    def get_target_url(self, location: str, api: str = "") -> str:
+        """Check the next possible location to request in order to get the 'location' directory
+
+        See `utils.get_target_url` for the routing rules.
+        """
+        start = time.perf_counter()
+        self._ensure_loaded()
+        target_url = None
+        # 1. check whether the location is known to current directory (parent or direct children)
+        known_directory = self._directories.get(location)
+        if known_directory is not None:
+            target_url = urljoin(self.get_url(known_directory), api)
+        # 2. check if the location is its descendants
+        elif location in self._target_to_child and self._target_to_child[location] in self._directories:
+            target_url = urljoin(self.get_url(self._directories[self._target_to_child[location]]), api)
+        else:
+            # 3. if the path of the location is known, go up to the lowest common ancestor only
+            common_ancestor = self._get_common_ancestor(location)
+            if common_ancestor is not None:
+                target_url = urljoin(self.get_url(common_ancestor), api)
+            # 4. if current is not master directory, return the url of master directory
+            elif self._parent is not None and self._master is not None:
+                target_url = urljoin(self.get_url(self._master), api)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._lookup_count += 1
+            self._lookup_time_total += elapsed
+            self._lookup_time_max = max(self._lookup_time_max, elapsed)
+        return target_url
+
+    def _get_common_ancestor(self, location: str):
+        """Get the lowest ancestor of current directory that is also an ancestor of `location`, or None
+
+        Walking the path of `location` from its deepest directory, the first ancestor of current directory is
+        the lowest common ancestor, since all ancestors of current directory are known.
+        """
+        for directory_name in reversed(self._paths.get(location, [])):
+            directory = self._directories.get(directory_name)
+            if directory is not None and directory.relationship in ('parent', 'ancestor'):
+                return directory
+        return None
+
+    def get_metrics(self) -> dict:
+        """Get the routing lookup latency metrics, in microseconds
+        """
+        with self._lock:
+            return {
+                "lookups": self._lookup_count,
+                "avg_latency_us": self._lookup_time_total / self._lookup_count * 1e6 if self._lookup_count else 0,
+                "max_latency_us": self._lookup_time_max * 1e6,
+                "known_directories": len(self._directories),
+                "known_descendants": len(self._target_to_child),
+                "known_paths": len(self._paths)
+            }
+
+
+routing_table = RoutingTable()
+
+
+def start_routing_refresher(app):
+    """Periodically reload the routing table, every `ROUTING_REFRESH_INTERVAL` seconds (30 by default)
+    """
+    return start_periodic_task(app, "routing-refresher", app.config.get('ROUTING_REFRESH_INTERVAL', 30),
+                               routing_table.refresh)
@@ -1,19 +1,26 @@
 from flask import Flask
 from flask_mongoengine import MongoEngine
+from .audit import start_audit_writer
 from .auth.models import auth_db
 from .databases import init_dir_to_url, init_target_to_child_name, clear_database
 from .databases import mongo
 from .auth.oauth2 import oauth, config_oauth, initiate_providers
+from .peers import start_health_prober
+from .routing import start_routing_refresher
+from .tasks import should_start_tasks
+from .views.lease import start_lease_reaper
+from .views.policy_inheritance import start_policy_inheritance
+from .views.reconciliation import start_reconciler
 from .views.home import home
 from .views.api import api
 from .views.dashboard import dashboard
 from .views.errors import register_error_page
 from .auth import login_manager
 from .auth.routes import auth
-import os
+from config import BaseConfig
 
-SingleConfig = {
-    'SECRET_KEY': os.urandom(128),
+# the defaults shared by all directories come from `BaseConfig`, only the single-directory settings are added here
+SingleConfig = dict(BaseConfig.to_dict(), **{
     'HOST_NAME': "SingleDirectory",
     'ENV_NAME': "SingleDirectory-Dev",
     'PORT': 4999,
@@ -29,7 +36,7 @@ SingleConfig = {
     'OAUTH2_JWT_KEY': 'SingleDirectory-secret',
     'OAUTH2_JWT_ALG': 'HS256',
     'OAUTH2_JWT_EXP': 3600
-}
+})
 
 def main(init_db=True, debug=True, host='localhost'):
     app = Flask(__name__)
@@ -66,6 +73,13 @@ def main(init_db=True, debug=True, host='localhost'):
         clear_database()
         init_dir_to_url('SingleDirectory')
         init_target_to_child_name('SingleDirectory')
+    if should_start_tasks(debug):
+        start_lease_reaper(app)
+        start_health_prober(app)
+        start_routing_refresher(app)
+        start_reconciler(app)
+        start_policy_inheritance(app)
+        start_audit_writer(app)
     app.run(debug=debug, host=host, port=app.config["PORT"])
 
 
@@ -0,0 +1,86 @@
+"""
+Background tasks that run periodically alongside the flask app of a directory, such as lease expiration.
+
+Each task runs in a daemon thread inside a test request context, so helpers using `url_for` work as in a request.
+A singleton task only runs on the instance of the directory that holds its lease in the `task_lock` collection,
+the other instances skip their runs until the lease expires.
+"""
+import datetime
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo.errors import DuplicateKeyError
+
+from .models import TaskLock
+
+# identifies this process as the owner of task leases
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# minimal seconds a task lease lasts, so a short interval does not make the lease expire between two runs
+MIN_TASK_LEASE = 60
+
+
+def should_start_tasks(debug: bool) -> bool:
+    """Check whether background tasks should be started in the current process
+
+    With the debug mode, the flask reloader runs the app in a child process, so tasks are only started there
+    to avoid running them twice.
+    """
+    return not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+
+def acquire_task_lock(name: str, lease: float) -> bool:
+    """Take or renew the lease on the singleton task `name` for `lease` seconds
+
+    Args:
+        name (str): name of the task
+        lease (float): seconds the lease lasts unless it is renewed
+
+    Returns:
+        bool: True if this process holds the lease, False if another instance holds an unexpired one
+    """
+    now = datetime.datetime.utcnow()
+    # the upsert inserts a second lock of the same name when another instance holds the lease, which the unique
+    # index rejects
+    try:
+        TaskLock._get_collection().update_one(
+            {'name': name, '$or': [{'owner': INSTANCE_ID}, {'expires': {'$lt': now}}]},
+            {'$set': {'owner': INSTANCE_ID, 'expires': now + datetime.timedelta(seconds=lease)}}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def start_periodic_task(app, name: str, interval: float, task, singleton: bool = False) -> threading.Thread:
+    """Run `task()` every `interval` seconds in a daemon thread
+
+    Args:
+        app (Flask): the flask app whose context the task runs in
+        name (str): name of the thread, used in error messages
+        interval (float): seconds between the end of a run and the start of the next one
+        task (callable): the function to run, it takes no argument
+        singleton (bool): only run the task on the instance holding its lease, see `acquire_task_lock`. The lease
+            lasts three intervals and at least `MIN_TASK_LEASE` seconds, so a run taking longer than this may
+            overlap with a run on another instance.
+
+    Returns:
+        threading.Thread: the started thread
+    """
+    lease = max(3 * interval, MIN_TASK_LEASE)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.test_request_context():
+                    if singleton and not acquire_task_lock(name, lease):
+                        continue
+                    task()
+            except Exception:
+                app.logger.exception("Background task %s failed", name)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
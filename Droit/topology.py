@@ -0,0 +1,384 @@
+"""
+Topology management of the directory tree.
+
+A topology is either declared in a JSON file, e.g.
+
+    {"directories": [
+        {"name": "level1", "url": "http://localhost:5001", "parent": null, "replicas": ["http://localhost:6001"]},
+        {"name": "level2a", "url": "http://localhost:5002", "parent": "level1"}
+    ]}
+
+where the optional "replicas" are the URLs of other instances of the same directory, sharing its database
+
+from which each directory derives its ancestors, children, master and descendant routes and the paths of all
+directories (used for lowest-common-ancestor routing), or built at runtime with join/leave requests, where the
+parent records the new child and propagates the descendant routes upward.
+In both cases `DirectoryNameToURL`, `TargetToChildName` and `DirectoryPath` are updated incrementally and the
+in-memory routing table is refreshed, so no restart is needed.
+"""
+import atexit
+import json
+from urllib.parse import urljoin
+
+import requests
+from flask import current_app as app
+from flask import url_for
+
+from .models import DirectoryNameToURL, TargetToChildName, DirectoryPath
+from .peer_auth import get_signed_headers
+from .peers import DEFAULT_PEER_TIMEOUT, HEADERS
+from .routing import routing_table
+
+
+
+def parse_topology(data: dict) -> dict:
+    """Validate a declarative topology and index it by directory name
+
+    Args:
+        data (dict): the topology, containing a "directories" list of {"name", "url", "parent", "replicas"} objects
+
+    Returns:
+        dict: mapping from directory name to its {"name", "url", "parent", "urls"} entry, where "urls" lists the URLs
+            of all instances of the directory, starting with "url"
+
+    Raises:
+        ValueError: if a name is duplicated, a parent is unknown, there is not exactly one root or there is a cycle
+    """
+    topology = {}
+    for entry in data.get("directories", []):
+        if not entry.get("name") or not entry.get("url"):
+            raise ValueError(f"Invalid directory entry: {entry}")
+        if entry["name"] in topology:
+            raise ValueError(f"Duplicate directory name: {entry['name']}")
+        replicas = entry.get("replicas", [])
+        if type(replicas) != list:
+            raise ValueError(f"Invalid replicas of '{entry['name']}'")
+        topology[entry["name"]] = {"name": entry["name"], "url": entry["url"], "parent": entry.get("parent"),
+                                   "urls": [entry["url"]] + [url for url in replicas if url != entry["url"]]}
+
+    roots = [name for name, entry in topology.items() if entry["parent"] is None]
+    if len(roots) != 1:
+        raise ValueError("A topology must have exactly one root directory")
+    for name, entry in topology.items():
+        if entry["parent"] is not None and entry["parent"] not in topology:
+            raise ValueError(f"Unknown parent '{entry['parent']}' of '{name}'")
+        if len(get_path(topology, name)) > len(topology):
+            raise ValueError(f"Cycle detected at '{name}'")
+    return topology
+
+
+def load_topology(path: str) -> dict:
+    """Read and validate a topology file, see `parse_topology`
+    """
+    with open(path, 'r', encoding='utf8') as fp:
+        return parse_topology(json.load(fp))
+
+
+def get_path(topology: dict, name: str) -> list:
+    """Get the names of the directories from the root to `name`, both included
+    """
+    path = [name]
+    while topology[path[-1]]["parent"] is not None and len(path) <= len(topology):
+        path.append(topology[path[-1]]["parent"])
+    return path[::-1]
+
+
+def get_root(topology: dict) -> dict:
+    """Get the entry of the root (master) directory
+    """
+    return next(entry for entry in topology.values() if entry["parent"] is None)
+
+
+def get_children(topology: dict, name: str) -> list:
+    """Get the names of the direct children of `name`
+    """
+    return [child_name for child_name, entry in topology.items() if entry["parent"] == name]
+
+
+def get_descendants(topology: dict, name: str) -> list:
+    """Get the names of all descendants of `name`, excluding itself
+    """
+    descendants = []
+    stack = get_children(topology, name)
+    while stack:
+        descendant_name = stack.pop()
+        descendants.append(descendant_name)
+        stack.extend(get_children(topology, descendant_name))
+    return descendants
+
+
+def derive_routes(topology: dict, name: str):
+    """Derive the routing data of directory `name` from the topology
+
+    Returns:
+        tuple: a mapping from known directory name to its (instance urls, relationship), a mapping from each descendant
+            that is not a direct child to the child it is reached through, and a mapping from every directory name
+            to its path
+    """
+    entry = topology[name]
+    root = get_root(topology)
+    directories = {'master': (root["urls"], 'master')}
+    # all ancestors are known, so that a request to another branch goes directly to the lowest common ancestor
+    for ancestor_name in get_path(topology, name)[:-2]:
+        directories[ancestor_name] = (topology[ancestor_name]["urls"], 'ancestor')
+    if entry["parent"] is not None:
+        directories[entry["parent"]] = (topology[entry["parent"]]["urls"], 'parent')
+    target_to_child = {}
+    for child_name in get_children(topology, name):
+        directories[child_name] = (topology[child_name]["urls"], 'child')
+        for descendant_name in get_descendants(topology, child_name):
+            target_to_child[descendant_name] = child_name
+    paths = {directory_name: get_path(topology, directory_name) for directory_name in topology}
+    return directories, target_to_child, paths
+
+
+def apply_routes(directories: dict, target_to_child: dict, paths: dict = None) -> int:
+    """Incrementally update the routing collections to the given routing data and refresh the routing table
+
+    Args:
+        directories (dict): mapping from known directory name to its (instance urls, relationship)
+        target_to_child (dict): mapping from descendant name to the child it is reached through
+        paths (dict): optional, mapping from directory name to its path from the root
+
+    Returns:
+        int: the number of inserted, updated or deleted records
+    """
+    changes = 0
+    # one record per instance of each directory
+    existing_instances = {(document.directory_name, document.url): document
+                          for document in DirectoryNameToURL.objects()}
+    wanted_instances = {(directory_name, url): relationship
+                        for directory_name, (urls, relationship) in directories.items() for url in urls}
+    for instance, document in existing_instances.items():
+        if instance not in wanted_instances:
+            document.delete()
+            changes += 1
+    for (directory_name, url), relationship in wanted_instances.items():
+        document = existing_instances.get((directory_name, url))
+        if document is None:
+            DirectoryNameToURL(directory_name=directory_name, url=url, relationship=relationship).save()
+            changes += 1
+        elif document.relationship != relationship:
+            document.update(set__relationship=relationship)
+            changes += 1
+
+    existing_targets = {mapping.target_name: mapping for mapping in TargetToChildName.objects()}
+    removed_targets = [target_name for target_name in existing_targets if target_name not in target_to_child]
+    if removed_targets:
+        TargetToChildName.objects(target_name__in=removed_targets).delete()
+        changes += len(removed_targets)
+    for target_name, child_name in target_to_child.items():
+        mapping = existing_targets.get(target_name)
+        if mapping is None:
+            TargetToChildName(target_name=target_name, child_name=child_name).save()
+            changes += 1
+        elif mapping.child_name != child_name:
+            mapping.update(set__child_name=child_name)
+            changes += 1
+
+    if paths is not None:
+        existing_paths = {document.directory_name: document for document in DirectoryPath.objects()}
+        removed_paths = [directory_name for directory_name in existing_paths if directory_name not in paths]
+        if removed_paths:
+            DirectoryPath.objects(directory_name__in=removed_paths).delete()
+            changes += len(removed_paths)
+        for directory_name, path in paths.items():
+            document = existing_paths.get(directory_name)
+            if document is None or list(document.path) != path:
+                DirectoryPath.objects(directory_name=directory_name).update_one(set__path=path, upsert=True)
+                changes += 1
+
+    routing_table.refresh()
+    return changes
+
+
+def apply_topology(topology: dict, name: str) -> int:
+    """Update the routing data of directory `name` to match a declarative topology
+
+    Returns:
+        int: the number of changed routing records
+    """
+    if name not in topology:
+        raise ValueError(f"Directory '{name}' is not in the topology")
+    return apply_routes(*derive_routes(topology, name))
+
+
+def add_descendant_routes(via: str, target_names: list):
+    """Record that `target_names` are reached through the child `via`
+    """
+    for target_name in target_names:
+        if target_name == via:
+            continue
+        TargetToChildName.objects(target_name=target_name).update_one(set__child_name=via, upsert=True)
+    routing_table.refresh()
+
+
+def remove_descendant_routes(target_names: list):
+    """Forget the routes of directories that left the subtree, their aggregation data is removed by the caller
+    """
+    TargetToChildName.objects(target_name__in=target_names).delete()
+    routing_table.refresh()
+
+
+def propagate_routes(added: list = None, removed: list = None) -> bool:
+    """Send the changed descendant routes of current directory to the parent, which propagates them upward
+
+    Args:
+        added (list): names of directories that became reachable through current directory
+        removed (list): names of directories that are no longer reachable through current directory
+
+    Returns:
+        bool: True if the parent (if any) has applied the change
+    """
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+    request_data = {"via": app.config['HOST_NAME'], "add": added or [], "remove": removed or []}
+    try:
+        response = post_to_peer(urljoin(routing_table.get_url(parent_dir), url_for('api.topology_routes')),
+                                request_data)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def add_child(name: str, url: str, descendants: list = None) -> dict:
+    """Register a joining directory as a child of current directory and propagate the new routes upward
+
+    An instance joining with the name of an existing child is added as another instance of that child.
+
+    Args:
+        name (str): name of the joining directory
+        url (str): URL of the joining directory
+        descendants (list): names of the directories already under the joining directory
+
+    Returns:
+        dict: the parent, ancestors and master directories and the path of the parent, which the joining directory
+            should record
+    """
+    descendants = descendants or []
+    DirectoryNameToURL.objects(directory_name=name, url=url).update_one(set__relationship='child', upsert=True)
+    add_descendant_routes(name, descendants)
+    propagate_routes(added=[name] + descendants)
+
+    master = routing_table.get_directory('master')
+    ancestors = [directory for directory in DirectoryNameToURL.objects(relationship__in=['parent', 'ancestor'])]
+    local_path = DirectoryPath.objects(directory_name=app.config['HOST_NAME']).first()
+    return {
+        "parent": {"name": app.config['HOST_NAME'], "url": get_local_url()},
+        "ancestors": [{"name": directory.directory_name, "url": directory.url} for directory in ancestors],
+        "master": {"name": "master", "url": master.url if master is not None else get_local_url()},
+        "path": list(local_path.path) if local_path is not None else [app.config['HOST_NAME']]
+    }
+
+
+def remove_child(name: str, url: str = None) -> list:
+    """Remove a leaving child directory and all routes through it, and propagate the removal upward
+
+    Args:
+        name (str): name of the leaving directory
+        url (str): optional, only remove this instance of the directory. The routes are kept while other instances
+            of the directory are left.
+
+    Returns:
+        list: names of the directories no longer reached through current directory, whose aggregation data should
+            be removed, empty if other instances of the child are left
+    """
+    if url is not None:
+        DirectoryNameToURL.objects(directory_name=name, url=url, relationship='child').delete()
+        if DirectoryNameToURL.objects(directory_name=name, relationship='child').count() > 0:
+            routing_table.refresh()
+            return []
+    descendants = [mapping.target_name for mapping in TargetToChildName.objects(child_name=name)]
+    DirectoryNameToURL.objects(directory_name=name, relationship='child').delete()
+    remove_descendant_routes([name] + descendants)
+    propagate_routes(removed=[name] + descendants)
+    return [name] + descendants
+
+
+def get_timeout() -> float:
+    """Get the timeout of the topology requests to the parent, the same as for the other peer requests
+    """
+    return app.config.get('PEER_TIMEOUT', DEFAULT_PEER_TIMEOUT)
+
+
+def post_to_peer(url: str, request_data: dict) -> requests.Response:
+    """Send a topology request to another directory of the tree, with its body signed by the tree secret
+    """
+    body = json.dumps(request_data)
+    return requests.post(url, data=body, headers=get_signed_headers(body, HEADERS), timeout=get_timeout())
+
+
+def get_local_url() -> str:
+    """Get the URL of current directory from its configuration
+    """
+    return app.config.get('URL') or f"http://{app.config.get('HOST', 'localhost')}:{app.config['PORT']}"
+
+
+def join_parent(parent_url: str) -> bool:
+    """Join the tree as a child of the directory at `parent_url`
+
+    The current children and descendants are sent along, so a whole subtree can join at once. The parent, ancestors
+    and master directories returned by the parent are recorded locally, together with the path of current directory.
+
+    Returns:
+        bool: True if the parent accepted the join request
+    """
+    descendants = [child.directory_name for child in routing_table.get_children()] + \
+                  [mapping.target_name for mapping in TargetToChildName.objects()]
+    request_data = {"name": app.config['HOST_NAME'], "url": get_local_url(), "descendants": descendants}
+    try:
+        response = post_to_peer(urljoin(parent_url, url_for('api.topology_join')), request_data)
+    except requests.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+
+    result = response.json()
+    DirectoryNameToURL.objects(relationship__in=['parent', 'ancestor']).delete()
+    for ancestor in result.get("ancestors", []):
+        DirectoryNameToURL.objects(directory_name=ancestor["name"], url=ancestor["url"]).update_one(
+            set__relationship='ancestor', upsert=True)
+    DirectoryNameToURL.objects(directory_name=result["parent"]["name"], url=result["parent"]["url"]).update_one(
+        set__relationship='parent', upsert=True)
+    DirectoryNameToURL.objects(directory_name='master').update_one(
+        set__url=result["master"]["url"], set__relationship='master', upsert=True)
+    # the path of current directory extends the path of its parent
+    DirectoryPath.objects(directory_name=app.config['HOST_NAME']).update_one(
+        set__path=result.get("path", [result["parent"]["name"]]) + [app.config['HOST_NAME']], upsert=True)
+    routing_table.refresh()
+    return True
+
+
+def leave_parent() -> bool:
+    """Leave the tree, asking the parent to remove current directory and its descendants from its routes
+
+    Only this instance leaves, the routes to the directory are kept while other instances are left.
+
+    Returns:
+        bool: True if the parent (if any) accepted the leave request
+    """
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+    try:
+        response = post_to_peer(urljoin(routing_table.get_url(parent_dir), url_for('api.topology_leave')),
+                                {"name": app.config['HOST_NAME'], "url": get_local_url()})
+    except requests.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    DirectoryNameToURL.objects(relationship__in=['parent', 'ancestor', 'master']).delete()
+    DirectoryPath.objects(directory_name=app.config['HOST_NAME']).delete()
+    routing_table.refresh()
+    return True
+
+
+def leave_parent_at_exit(app):
+    """Leave the tree when the process exits, for an instance that joined it at runtime with `join_parent`
+    """
+    def leave():
+        with app.test_request_context():
+            leave_parent()
+
+    atexit.register(leave)
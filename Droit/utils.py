@@ -1,25 +1,21 @@
 """
 Functions declared in this file are helper functions that can be shared by all other modules
 """
-import re
-from datetime import datetime, timedelta
-from urllib.parse import urljoin
-
 import flask
 import jwcrypto.jwk as jwk
 import jwt
 from flask_login import current_user
-from py_abac import PDP, Policy, AccessRequest
-from py_abac.pdp import EvaluationAlgorithm
-from py_abac.provider.base import AttributeProvider
-from py_abac.storage.mongo import MongoStorage
-from pymongo import MongoClient
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
+from py_abac import Policy
 
+from .attribute_providers import get_auth_attributes, get_attribute_context, reset_attribute_context
 from .auth import User, AuthAttribute
 from .auth.models import auth_user_attr_default, auth_server_attr_default
-from .models import DirectoryNameToURL, TargetToChildName, ThingFrequency
+from .decision_cache import decision_cache, get_subject_fingerprint, get_time_dependencies, get_expiration, \
+    get_access_counts
+from .geofence import get_geofence_paths
+from .policy_compiler import CompiledPolicies
+from .policy_helper import policy_cache, get_policy_storage, increase_shared_version
+from .routing import routing_table
 
 
 def is_json_request(request: flask.Request, properties: list = []) -> bool:
@@ -69,8 +65,13 @@ def get_target_url(location: str, api: str = "") -> str:
     Then it will check whether this 'location' is one of descendants directories.
     If it is, then return.
 
+    Otherwise, if the path of this 'location' is known, it will return the URI of the lowest common ancestor, so a
+    request to another branch only goes up as far as needed.
+
     Finally if current directory is not master, then it will return the URI using master directory's location
 
+    The lookup is served by the in-memory routing table of current directory.
+
     Args:
         location (str): the target location to be searched
         api(str): url path after the host name, such as /register, /search. It is highly encouraged to form this parameter using 'url_for'
@@ -79,38 +80,20 @@ def get_target_url(location: str, api: str = "") -> str:
         str: if the location is possible, return the concatenated URI along with the 'api', otherwise return None
 
     """
-    target_url = None
-    # 1. check whether the location is known to current directory (parent or direct children)
-    known_directory = DirectoryNameToURL.objects(
-        directory_name=location).first()
-    if known_directory is not None:
-        target_url = urljoin(known_directory.url, api)
-
-    # 2. check if the location is its descendants
-    elif TargetToChildName.objects(target_name=location).first() is not None:
-        descendant_directory = TargetToChildName.objects(
-            target_name=location).first()
-        target_url = urljoin(DirectoryNameToURL.objects(
-            directory_name=descendant_directory.child_name).first().url, api)
-
-    # 3. if current is not master directory, return the url of master directory
-    elif DirectoryNameToURL.objects(relationship="parent").first() is not None:
-        master_url = DirectoryNameToURL.objects(
-            directory_name="master").first().url
-        target_url = urljoin(master_url, api)
-
-    return target_url
+    return routing_table.get_target_url(location, api)
 
 
 def add_policy_to_storage(policy: dict, location: str) -> bool:
     # json = request.get_json()
     policy = Policy.from_json(policy)
-    client = MongoClient()
-    storage = MongoStorage(client, db_name=location)
+    storage = get_policy_storage(location)
     try:
         storage.add(policy)
     except:
         return False
+    increase_shared_version(location)
+    policy_cache.invalidate(location)
+    decision_cache.invalidate_location(location)
     return True
 
 
@@ -129,28 +112,20 @@ def delete_policy_from_storage(request: flask.Request) -> bool:
     request_json = request.get_json()
     uid = request_json['uid']
     location = request_json['location']
-    client = MongoClient()
-    storage = MongoStorage(client, db_name=location)
+    storage = get_policy_storage(location)
     storage.delete(uid)
+    increase_shared_version(location)
+    policy_cache.invalidate(location)
+    decision_cache.invalidate_location(location)
     return True
 
 
-# check if the request is allowed by policy in the current level
-def is_request_allowed(request: flask.Request) -> bool:
-    """Check whether a request is allowed or not. 
-    Attributes are retrieved by the attribute providers and in order of the providers. 
-
-    Args:
-        request (JSON): request to the thing with identifications about the thing
+def get_access_subject() -> dict:
+    """Get the subject of access requests made by the current user, the user is looked up once
 
     Returns:
-        1/0 (int): indicating a request is allowed or not
-
+        dict: the subject part of a py_abac access request
     """
-
-    request_json = request.get_json()
-    thing_id = request_json['thing_id']
-    policy_location = request_json['location']
     try:
         user_id = current_user.get_user_id()
         user = User.query.filter_by(id=user_id).first()
@@ -158,95 +133,164 @@ def is_request_allowed(request: flask.Request) -> bool:
     except:
         user_id = ""
         user_email = ""
+    return {
+        "id": str(user_id),
+        "attributes": {"email": str(user_email)}
+    }
 
-    class TimestampAttributeProvider(AttributeProvider):
-        def get_attribute_value(self, ace, attribute_path, ctx):
-            if attribute_path == "$.timestamp":
-                print(f"accessed, current timestamp:{datetime.now().timestamp()}")
-                return datetime.now().timestamp()
-            return None
-
-    class GeoAttributeProvider(AttributeProvider):
-        def get_attribute_value(self, ace: str, attribute_path: str, ctx: 'EvaluationContext'):
-            if ace == "subject" and attribute_path[:5] == "$.geo":
-                str = attribute_path[6:-1]
-                point_list = str.split(' ')
-                polygon_list = []
-                for point in point_list:
-                    tmp = point.split(',')
-                    x = int(tmp[0])
-                    y = int(tmp[1])
-                    polygon_list.append((x, y))
-                polygon = Polygon(polygon_list)
-
-                auth_attributes = get_auth_attributes()
-                auth_user_attributes = auth_attributes[0]
-                position = auth_user_attributes.get('position', None)
-                print("position: ", position)
-                # if location is None:
-                #    location = (0,0)
-                point = Point(position)
-
-                return int(polygon.contains(point))
-
-            return None
-
-    class TimespanAttributeProvider(AttributeProvider):
-        def get_attribute_value(self, ace: str, attribute_path: str, ctx: 'EvaluationContext'):
-            if ace == 'resource' and attribute_path[:10] == '$.timespan':
-                timespan = int(attribute_path.partition(': ')[2])
-                start = datetime.utcnow() - timedelta(seconds=timespan)
-                thing_obj = ThingFrequency.objects(thing_id=thing_id).first()
-                cnt = 0
-                if str(user_id) in thing_obj.timestamps:
-                    for timestamp in thing_obj.timestamps[str(user_id)][::-1]:
-                        if timestamp < start:
-                            break
-                        cnt += 1
-                    return cnt
-                else:
-                    return 0
-            return None
-
-    class OtherAttributeProvider(AttributeProvider):
-        def get_attribute_value(self, ace: str, attribute_path: str, ctx):
-            # Assume attribute_path is in the form "$.attribute_name"
-            attr_name = re.search("[a-zA-Z_]+", attribute_path).group().lower()
-            print("attribute_path: ", attribute_path)
-            print("attr_name: ", attr_name)
-
-            auth_attributes = get_auth_attributes()
-            auth_user_attributes = auth_attributes[0]
-            auth_server_attributes = auth_attributes[1]
-            attr_value = auth_user_attributes.get(attr_name, None) or auth_server_attributes.get(attr_name, None)
-            print("attr_value: ", attr_value)
-            return attr_value
-
-    client = MongoClient()
-    storage = MongoStorage(client, db_name=policy_location)
-    pdp = PDP(storage, EvaluationAlgorithm.HIGHEST_PRIORITY,
-              [TimestampAttributeProvider(), TimespanAttributeProvider(), GeoAttributeProvider(),
-               OtherAttributeProvider()])
-
-    access_request_json = {
-        "subject": {
-            "id": str(user_id),
-            "attributes": {"email": str(user_email)}
-        },
+
+def get_access_request(subject: dict, thing_id: str, thing_type: str, action: str = "get") -> dict:
+    """Get the access request of `subject` performing `action` on a thing
+
+    Args:
+        subject (dict): the subject returned by `get_access_subject`
+        thing_id (str): identification of the thing
+        thing_type (str): type of the thing
+        action (str): get, delete, or create
+
+    Returns:
+        dict: the access request in the JSON format of py_abac
+    """
+    return {
+        "subject": subject,
         "resource": {
             "id": str(thing_id),
-            "attributes": {"thing_type": request.get_json().get("thing_type", None)}
+            "attributes": {"thing_type": thing_type}
         },
         "action": {
             "id": "",
-            "attributes": {"method": "get"}
+            "attributes": {"method": action}
         },
         "context": {
         }
     }
 
-    access_request = AccessRequest.from_json(access_request_json)
-    return pdp.is_allowed(access_request)
+
+# check if the request is allowed by policy in the current level
+def is_request_allowed(request: flask.Request) -> bool:
+    """Check whether a request is allowed or not. 
+    Attributes are retrieved by the attribute providers and in order of the providers. 
+
+    Args:
+        request (JSON): request to the thing with identifications about the thing
+
+    Returns:
+        1/0 (int): indicating a request is allowed or not
+
+    """
+
+    return explain_request(request, get_access_subject())[0]
+
+
+def explain_request(request: flask.Request, subject: dict) -> tuple:
+    """Decide whether `subject` may get the thing of a policy decision request, and find the policy that decided it
+
+    The action of the request is not used, see `explain_access` to decide other actions.
+
+    Args:
+        request (flask.Request): request with the location of the policies and the identifications of the thing
+        subject (dict): the subject returned by `get_access_subject`
+
+    Returns:
+        tuple: (True if the access is allowed, uid of the deciding policy or None if no policy applies)
+    """
+    request_json = request.get_json()
+    return explain_access(request_json['location'], subject,
+                          [(request_json['thing_id'], request_json.get("thing_type", None), "get")])[0]
+
+
+def decide_access(policy_location: str, subject: dict, accesses: list) -> list:
+    """Decide many accesses of one subject with the policies of one location, using the decision cache
+
+    Args:
+        policy_location (str): the location of the policies
+        subject (dict): the subject returned by `get_access_subject`
+        accesses (list): list of (thing_id, thing_type, action) tuples
+
+    Returns:
+        list: one bool per access, True if the access is allowed
+    """
+    return [allowed for allowed, _ in explain_access(policy_location, subject, accesses)]
+
+
+def explain_access(policy_location: str, subject: dict, accesses: list) -> list:
+    """Decide many accesses of one subject with the policies of one location and find the deciding policies,
+    using the decision cache
+
+    A decision is cached under the version of the policy set, a fingerprint of the subject and of the attributes
+    of the current user, and the number of accesses of the subject to the thing if the policies count them, until it
+    may change with time. These keys come from the database, so a decision is not reused after a new access, nor
+    after a change of the policies by another instance of the directory once `POLICY_VERSION_CHECK_INTERVAL` seconds
+    have passed.
+
+    Args:
+        policy_location (str): the location of the policies
+        subject (dict): the subject returned by `get_access_subject`
+        accesses (list): list of (thing_id, thing_type, action) tuples
+
+    Returns:
+        list: one (allowed, policy uid) tuple per access, the uid is None if no policy applies
+    """
+    policy_set = policy_cache.get_policies(policy_location)
+    attribute_context = get_attribute_context()
+    fingerprint = get_subject_fingerprint(subject, attribute_context.auth_attributes)
+    dependencies = policy_set.get_derived('time_dependencies', get_time_dependencies)
+    compiled = policy_set.get_derived('compiled', CompiledPolicies)
+    geofence_paths = policy_set.get_derived('geofence_paths', get_geofence_paths)
+    access_counts = get_access_counts(subject['id'], [str(thing_id) for thing_id, _, _ in accesses]) \
+        if dependencies['timespans'] else {}
+    decisions = []
+    for thing_id, thing_type, action in accesses:
+        key = (policy_location, policy_set.version, fingerprint, str(thing_id), thing_type, action,
+               access_counts.get(str(thing_id), 0))
+        decision = decision_cache.get(key)
+        if decision is None:
+            # only the candidate policies of the resource from the target index are evaluated, compiled, and only
+            # their geofences are checked against the position of the user
+            candidates = policy_set.get_for_resource(thing_id, thing_type)
+            attribute_context.geofence_paths = [path for policy in candidates for path in geofence_paths[policy.uid]]
+            policy = compiled.get_deciding_policy(get_access_request(subject, thing_id, thing_type, action),
+                                                  candidates)
+            decision = (policy is not None and policy.is_allowed, policy.uid if policy is not None else None)
+            decision_cache.put(key, decision, get_expiration(dependencies, subject['id'], str(thing_id)),
+                               (subject['id'], str(thing_id)) if dependencies['timespans'] else None)
+        decisions.append(decision)
+    return decisions
+
+
+def filter_allowed_things(things: list, subject: dict, policy_location: str) -> list:
+    """Keep only the thing descriptions that `subject` may get, according to the policies of one location
+
+    Args:
+        things (list): thing descriptions in JSON format
+        subject (dict): the subject returned by `get_access_subject`
+        policy_location (str): the location of the policies
+
+    Returns:
+        list: the allowed thing descriptions, in the same order
+    """
+    if not things:
+        return []
+    decisions = decide_access(policy_location, subject,
+                              [(thing['thing_id'], thing.get('thing_type'), "get") for thing in things])
+    return [thing for thing, allowed in zip(things, decisions) if allowed]
+
+
+def get_allowed_items(items: list, policy_location: str) -> list:
+    """Decide the access of the current user to many things with the policies of one location
+
+    The user is looked up once, and all items are evaluated by the same cached PDP.
+
+    Args:
+        items (list): list of {"thing_id", "thing_type", "action"} objects, the action is "get" by default
+        policy_location (str): the location of the policies
+
+    Returns:
+        list: one bool per item, True if the access is allowed
+    """
+    return decide_access(policy_location, get_access_subject(),
+                         [(item['thing_id'], item.get('thing_type'), str(item.get('action') or "get").lower())
+                          for item in items])
 
 
 def set_auth_user_attr(attr_name, attr_value):
@@ -257,6 +301,7 @@ def set_auth_user_attr(attr_name, attr_value):
     auth_user_attributes[attr_name] = attr_value
     print("auth_user_attributes: ", auth_user_attributes)
     auth_attribute.set_user_attributes(auth_user_attributes)
+    reset_attribute_context()
     flask.session["info_authorize"] = 1
 
 
@@ -268,6 +313,7 @@ def set_auth_server_attr(attr_name, attr_value):
     auth_server_attributes[attr_name] = attr_value
     print("auth_server_attributes: ", auth_server_attributes)
     auth_attribute.set_server_attributes(auth_server_attributes)
+    reset_attribute_context()
 
 
 def clear_auth_attributes():
@@ -275,19 +321,7 @@ def clear_auth_attributes():
     auth_attribute = AuthAttribute.query.filter_by(id=user_id).first()
     auth_attribute.set_user_attributes(auth_user_attr_default)
     auth_attribute.set_server_attributes(auth_server_attr_default)
-
-
-def get_auth_attributes():
-    print("(get_auth_attributes)")
-    if current_user.is_anonymous:
-        return "Please Login", 400
-    user_id = current_user.get_user_id()
-    auth_attribute = AuthAttribute.query.filter_by(id=user_id).first()
-    auth_user_attributes = auth_attribute.get_user_attributes()
-    auth_server_attributes = auth_attribute.get_server_attributes()
-    print("[auth_user_attributes, auth_server_attributes]: ", [auth_user_attributes, auth_server_attributes])
-    # return a list of two dictionaries
-    return [auth_user_attributes, auth_server_attributes]
+    reset_attribute_context()
 
 
 def is_policy_request(policy: dict, keys: list = []) -> bool:
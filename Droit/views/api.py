@@ -1,36 +1,67 @@
 import copy
 import json
 import re
+import time
 import uuid
 from datetime import datetime
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urljoin
 
 import requests
+from bson import json_util
 from flask import Blueprint, request, url_for, make_response, jsonify, session
 from flask import current_app as app
 from flask_login import current_user
 from flask_login import current_user as user
 from py_abac import Policy
-from py_abac.storage.mongo import MongoStorage
-from pymongo import MongoClient
 
-from .broadcast import delete_local_thing_description, push_up_things, parent_aggregation, get_children_result
-from .data_helper import deduplicate_by_id, get_compressed_list, get_final_aggregation
+from .broadcast import delete_local_thing_description, push_up_things, parent_aggregation, get_children_result, \
+    expand_spatial_summary, delete_local_thing_descriptions, register_local_thing_descriptions, parent_count_deltas
+from .data_helper import deduplicate_by_id, get_compressed_list, get_final_aggregation, get_filter_map, \
+    get_selection_map, pop_lease_expires
 from .frequency import add_frequency
+from .counter import increase_type_count, get_type_counts, get_subtree_type_counts, increase_children_count, \
+    remove_children_counts, are_counters_recounted
+from .lease import get_lease_expires, renew_leases
+from .relocation import create_relocation_job, run_relocation_job
+from .policy_inheritance import get_policy_set_json
+from .reconciliation import get_child_aggregation, get_digest, repair_child_aggregation
+from .geo_helper import get_coordinates, min_distance_to_bbox, merge_nearest, count_by_geohash, merge_heat_maps, \
+    GEOHASH_MAX_PRECISION
+from ..attribute_providers import get_attribute_context
+from ..audit import audit_log
 from ..auth.models import auth_db, Policy
-from ..models import ThingDescription, DirectoryNameToURL, TypeToChildrenNames, ThingFrequency
+from ..models import ThingDescription, DirectoryNameToURL, TypeToChildrenNames, ThingFrequency, SpatialSummary, \
+    RelocationJob
+from ..peer_auth import get_forwarded_subject, sign_claims, is_signed_request
+from ..peers import peer_get, peer_post, peer_delete, peer_registry, is_partial_result, \
+    get_long_timeout, DEFAULT_PEER_TIMEOUT, PARTIAL_RESULT_HEADER, HEADERS
+from ..policy_filter import get_permitted_filter
+from ..policy_helper import policy_cache
+from ..routing import routing_table
+from ..topology import parse_topology, apply_topology, add_child, remove_child, add_descendant_routes, \
+    remove_descendant_routes, propagate_routes
 from ..utils import get_target_url, is_json_request, clean_thing_description, add_policy_to_storage, \
-    delete_policy_from_storage, is_policy_request, is_request_allowed, get_auth_attributes, set_auth_user_attr, \
-    generate_jwt
+    delete_policy_from_storage, is_policy_request, explain_access, get_access_subject, \
+    filter_allowed_things, get_auth_attributes, set_auth_user_attr, generate_jwt
 
 ERROR_JSON = {"error": "Invalid request."}
 ERROR_POLICY = {"error": "Invalid policy."}
 ERROR_NO_USER = {"error": "Please login."}
+ERROR_PEER_AUTH = {"error": "The request is not signed by a directory of the tree."}
 OPERATION_COUNT = ""
 
 api = Blueprint('api', __name__)
 
 
+@api.after_request
+def mark_partial_response(response):
+    """Tell the caller that some peers were skipped or failed while answering this request
+    """
+    if is_partial_result():
+        response.headers[PARTIAL_RESULT_HEADER] = 'true'
+    return response
+
+
 @api.route('/register', methods=['POST'])
 def register():
     """Register thing description at the target location. 
@@ -47,6 +78,9 @@ def register():
         location (str): the location where the thing description should be registered
         publicity (number): specify the number of levels that the thing description should be duplicate to upper level directory.
             By default this is zero, means it does not need to be pushed up.
+        pushed_from (str): optional, set by the child directory when the thing description is a pushed-up copy.
+        lease (number): optional, the thing description is deleted after this number of seconds unless the lease is
+            renewed with `renew_leases`. By default there is no lease.
 
     Returns:
         HTTP Response: if the register is completed, a simple success string with HTTP status code 200 is returned
@@ -60,23 +94,33 @@ def register():
     location = body['location']
     thing_description = body['td']
     publicity = int(body['publicity']) if 'publicity' in body else 0
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept-Charset': 'UTF-8'
-    }
     # 3. check if the location is current directory
     local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
     if local_server_name == location:
+        try:
+            lease_expires = get_lease_expires(body.get('lease'))
+        except (TypeError, ValueError):
+            return jsonify(ERROR_JSON), 400
         thing_description = clean_thing_description(thing_description)
 
         # 3a. register locally
         # when this API is called by 'relocate', publicity is in the thing_description object
         # remove it to avoid duplicate key error when creating new object
         registration_result = True
+        # number of things registered here, reported to the ancestors' aggregation data
+        count_delta = 0
         thing_description.pop("publicity", None)
+        thing_description.pop("pushed_from", None)
+        thing_description.pop("_id", None)
         try:
-            new_td = ThingDescription(publicity=publicity, **thing_description)
+            # a relocated thing description keeps its own lease unless a new one is given
+            thing_lease_expires = pop_lease_expires(thing_description)
+            new_td = ThingDescription(publicity=publicity, pushed_from=body.get('pushed_from'),
+                                      lease_expires=lease_expires or thing_lease_expires,
+                                      **thing_description)
             new_td.save()
+            increase_type_count(new_td.thing_type, new_td.pushed_from or local_server_name)
+            count_delta = 1 if new_td.pushed_from is None else 0
             new_freq = ThingFrequency(thing_id=new_td.thing_id, timestamps={})
             new_freq.save()
         except Exception as e:
@@ -86,9 +130,15 @@ def register():
         # 3b. push up thing description and update parent directory's aggregation data
         push_up_result = push_up_things(thing_description, publicity)
         aggregation_result = parent_aggregation("add",
-                                                thing_description["thing_type"], local_server_name)
-
-        # 3c. return result
+                                                thing_description["thing_type"], local_server_name, count_delta)
+        # 3c. expand the spatial summary used by nearest neighbour queries. The thing is registered even if the
+        # parent is not told, the reconciler reports the summary again
+        coordinates = get_coordinates(thing_description)
+        if registration_result and coordinates is not None and \
+                not expand_spatial_summary(local_server_name, coordinates):
+            app.logger.warning("Failed to report the spatial summary of %s to the parent", local_server_name)
+
+        # 3d. return result
         if push_up_result and registration_result and aggregation_result:
             return make_response("Created", 200)
         else:
@@ -101,8 +151,11 @@ def register():
 
     # check if any of above condition is satisfied
     if target_url is not None:
-        master_response = requests.post(
-            target_url, data=json.dumps(body), headers=headers)
+        try:
+            master_response = peer_post(
+                target_url, data=json.dumps(body), headers=HEADERS)
+        except requests.RequestException:
+            return make_response("Register failed", 400)
         return make_response(master_response.reason, master_response.status_code)
 
     # Otherwise the input location is invalid, return
@@ -161,11 +214,10 @@ def policy_attr_auth():
     thing_id = request_json['thing_id']
     policy_location = request_json['location']
 
-    client = MongoClient()
-    storage = MongoStorage(client, db_name=policy_location)
+    storage = policy_cache.get_policies(policy_location)
     add_user_scope_str = ""
     add_server_scope_str = ""
-    for p in storage.get_for_target("", str(thing_id), ""):
+    for p in storage.get_for_resource(str(thing_id), request_json['thing_type']):
         subject_rules = get_attr_list(p.rules.subject)
         context_rules = get_attr_list(p.rules.context)
         print("[API] (policy_attr_auth)")
@@ -226,7 +278,17 @@ def policy_decision():
     """
     if not is_json_request(request, ["thing_id", "thing_type", "action"]):
         return jsonify(ERROR_JSON), 400
-    if is_request_allowed(request):
+    request_json = request.get_json()
+    action = str(request_json['action']).lower()
+    subject = get_access_subject()
+    start_time = time.perf_counter()
+    # the requested action is decided and audited, as by `policy_decisions`
+    allowed, policy_uid = explain_access(request_json['location'], subject,
+                                         [(request_json['thing_id'], request_json['thing_type'], action)])[0]
+    # the record is written by the audit writer in the background
+    audit_log.record(subject['id'], request_json['thing_id'], action, policy_uid, allowed,
+                     time.perf_counter() - start_time)
+    if allowed:
         if not current_user.is_anonymous:
             add_frequency(request.get_json()["thing_id"], str(current_user.get_user_id()))
         td = ThingDescription.objects(thing_id=request.get_json()["thing_id"])
@@ -235,6 +297,74 @@ def policy_decision():
         return jsonify({"id": user.get_id()}), 400
 
 
+@api.route('/policy_decisions', methods=['POST'])
+def policy_decisions():
+    """Determines whether the current user may access each of many things, with the policies of one location
+
+    The user is looked up once and all things are evaluated by the cached policy set of the location.
+
+    Args:
+        The function uses HTTP request directly. These argument must be contained in the request:
+        location (str): the location of the policies
+        items (list): list of {"thing_id", "thing_type", "action"} objects, where action is get, delete, or create
+
+    Returns:
+        HTTP Response: {"decisions": [{"thing_id": ..., "allowed": true}, ...], "tds": [...]} with the decision of
+            each item in the request order and the thing descriptions that are allowed, with HTTP status code 200.
+            If the input is invalid, HTTP status code 400.
+    """
+    if not is_json_request(request, ["location", "items"]):
+        return jsonify(ERROR_JSON), 400
+    items = request.get_json()['items']
+    if type(items) != list or not all(type(item) == dict and 'thing_id' in item for item in items):
+        return jsonify(ERROR_JSON), 400
+
+    subject = get_access_subject()
+    start_time = time.perf_counter()
+    decisions = explain_access(request.get_json()['location'], subject,
+                               [(item['thing_id'], item.get('thing_type'), str(item.get('action') or "get").lower())
+                                for item in items])
+    # every decision is audited, with its share of the evaluation time
+    evaluation_time = (time.perf_counter() - start_time) / max(len(items), 1)
+    for item, (is_allowed, policy_uid) in zip(items, decisions):
+        audit_log.record(subject['id'], item['thing_id'], str(item.get('action') or "get").lower(), policy_uid,
+                         is_allowed, evaluation_time)
+    allowed = [is_allowed for is_allowed, _ in decisions]
+    allowed_ids = [item['thing_id'] for item, is_allowed in zip(items, allowed) if is_allowed]
+    if not current_user.is_anonymous:
+        for thing_id in allowed_ids:
+            add_frequency(thing_id, str(current_user.get_user_id()))
+    decisions = [{"thing_id": item['thing_id'], "allowed": is_allowed} for item, is_allowed in zip(items, allowed)]
+    tds = ThingDescription.objects(thing_id__in=allowed_ids) if allowed_ids else []
+    return jsonify({"decisions": decisions, "tds": tds}), 200
+
+
+@api.route('/policy_set', methods=['GET'])
+def policy_set():
+    """Return the policies that apply to the descendants of current directory, with their version
+
+    The child directories call it periodically with the version they inherited, and the policies are only sent
+    when the version changed. They include the policies of current directory and the ones it inherits.
+
+    Args:
+        location (str): the name of current directory
+        version (str): optional, the version the caller holds
+
+    Returns:
+        HTTP Response: {"location", "version", "changed": true, "policies": [...]} or
+            {"location", "version", "changed": false} if the version did not change, with HTTP status code 200.
+            If the location is not current directory, HTTP status code 400. If current directory does not know the
+            policies it inherits yet, HTTP status code 409, so the caller keeps the policies it inherited.
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    location = request.args.get('location')
+    if not location or location.strip() != local_server_name:
+        return jsonify(ERROR_JSON), 400
+    if not policy_cache.is_inherited_loaded(local_server_name):
+        return jsonify({"error": "Inherited policies are not loaded yet."}), 409
+    return jsonify(get_policy_set_json(local_server_name, request.args.get('version') or None)), 200
+
+
 def get_auth_scopes(auth_scope, attr_list, auth_attributes):
     print("(get_auth_scopes)", auth_scope, attr_list, auth_attributes)
     for s in attr_list:
@@ -277,54 +407,147 @@ def update_type_aggregation():
     Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
 
     Args:
-        request.thing_type (str): the type of the thing description may need to be updated.
+        request.thing_type (str): the type of the thing description may need to be updated. DELETE requests may
+            repeat this argument to remove several types at once.
         request.location (str): specify where the update operation should be done.
+        request.count_delta (int): optional for POST requests, the number of things of `thing_type` newly registered
+            at `location`.
+        request.count_deltas (dict): POST requests may send this mapping from type to the change of its count at
+            `location` instead of `thing_type`, when things are deleted there.
 
     Returns:
         HTTP Response: a brief string explaining the result and corresponding HTTP status code.
             When the update finished, HTTP status code 200 will be return, otherwise 400.
     """
     if request.method == 'POST':
-        if not is_json_request(request, ["location", "thing_type"]):
+        if not is_json_request(request, ["location"]):
             return jsonify(ERROR_JSON), 400
         body = request.get_json()
-        thing_type = body['thing_type']
         location = body['location']
 
-        # 3. update database
+        # 1. only the counts change, several types may be updated in one batched request
+        if 'count_deltas' in body:
+            count_deltas = body['count_deltas']
+            if type(count_deltas) != dict or not all(type(delta) == int for delta in count_deltas.values()):
+                return jsonify(ERROR_JSON), 400
+            for thing_type, delta in count_deltas.items():
+                increase_children_count(thing_type, location, delta)
+            parent_count_deltas(count_deltas, location)
+            return make_response("Update aggregation data successfully.", 200)
+
+        if 'thing_type' not in body or type(body.get('count_delta', 0)) != int:
+            return jsonify(ERROR_JSON), 400
+        thing_type = body['thing_type']
+        count_delta = body.get('count_delta', 0)
+
+        # 2. don't need to do any update
         children_locations = TypeToChildrenNames.objects(
             thing_type=thing_type).first()
-        # don't need to do any update
-        if children_locations is not None and location in children_locations.children_names:
+        if count_delta == 0 and children_locations is not None and location in children_locations.children_names:
             return "No need to update", 200
 
-        if children_locations is None:
-            children_locations = TypeToChildrenNames(
-                thing_type=thing_type, children_names=[location])
-        elif location not in children_locations.children_names:
-            children_locations.children_names.append(location)
-
-        children_locations.save()
+        # 3. update database
+        increase_children_count(thing_type, location, count_delta)
         # 4. recursively update the aggregation data at parent's directory
-        parent_aggregation('add', thing_type, location)
+        parent_aggregation('add', thing_type, location, count_delta)
 
     elif request.method == 'DELETE':
         location = request.args.get('location')
-        thing_type = request.args.get('thing_type')
-        if location is None or thing_type is None:
+        # several types may be removed in one batched request
+        thing_types = request.args.getlist('thing_type')
+        if location is None or not thing_types:
             return "Bad Request(arguments missing).", 400
-        # delete location from the thing_type's aggregation list
-        children_locations = TypeToChildrenNames.objects(
-            thing_type=thing_type).first()
-        if children_locations is not None:
-            children_locations.children_names.remove(location)
-            children_locations.save()
-            # recursively delete parent's aggregation data for the same record
-            parent_aggregation('delete', thing_type, location)
+        # delete location and its count from each thing_type's aggregation data
+        removed_types = [children_locations.thing_type for children_locations in
+                         TypeToChildrenNames.objects(thing_type__in=thing_types, children_names=location)]
+        if removed_types:
+            remove_children_counts(removed_types, [location])
+            # recursively delete parent's aggregation data for the same records
+            parent_aggregation('delete', removed_types, location)
 
     return make_response("Update aggregation data successfully.", 200)
 
 
+@api.route('/update_spatial_summary', methods=['POST'])
+def update_spatial_summary():
+    """Update the spatial summary of a child directory when geo-located things are registered in its subtree
+
+    Args:
+        request.location (str): the name of the child directory reporting its summary.
+        request.bbox (list): [min_lng, min_lat, max_lng, max_lat] covering all geo-located things of the child subtree.
+
+    Returns:
+        HTTP Response: a brief string explaining the result and corresponding HTTP status code.
+            When the update finished, HTTP status code 200 will be return, otherwise 400.
+    """
+    if not is_json_request(request, ["location", "bbox"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    if type(body['bbox']) != list or len(body['bbox']) != 4:
+        return jsonify(ERROR_JSON), 400
+
+    if not expand_spatial_summary(body['location'], body['bbox']):
+        return make_response("Update spatial summary failed", 400)
+    return make_response("Update spatial summary successfully.", 200)
+
+
+@api.route('/reconcile_aggregate', methods=['POST'])
+def reconcile_aggregate():
+    """Compare the aggregation data held for the subtree of a child directory with the child's digest
+
+    The child first sends the digest only. If it does not match, the child sends its full aggregation data again,
+    and the aggregation data of its subtree is replaced in bulk.
+
+    Args:
+        request.location (str): the name of the child directory.
+        request.digest (str): the digest of the aggregation data of the child subtree.
+        request.aggregation (dict): optional, the full aggregation data of the child subtree, mapping from type to
+            a mapping from directory name to the number of things registered there.
+
+    Returns:
+        HTTP Response: {"match": true} if the aggregation data matches or has been repaired, otherwise
+            {"match": false}, with HTTP status code 200. If the location is not a child, HTTP status code 400.
+    """
+    if not is_json_request(request, ["location", "digest"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    location = body['location']
+    if routing_table.get_child_name(location) != location:
+        return jsonify(ERROR_JSON), 400
+
+    if 'aggregation' in body:
+        if type(body['aggregation']) != dict or not all(type(counts) == dict for counts in body['aggregation'].values()):
+            return jsonify(ERROR_JSON), 400
+        repaired = repair_child_aggregation(location, body['aggregation'])
+        return jsonify({"match": True, "repaired": repaired}), 200
+    return jsonify({"match": get_digest(get_child_aggregation(location)) == body['digest']}), 200
+
+
+@api.route('/type_counts', methods=['GET'])
+def type_counts():
+    """Return the number of things of each type stored in the current directory
+
+    The counters are maintained on register, delete and relocate, so no collection scan is needed.
+
+    Args:
+        thing_type (str): optional, only return the counters of this type
+        subtree (str): optional, 'true' to count the things registered in the whole subtree instead, from the counts
+            reported by the descendants
+
+    Returns:
+        HTTP Response: mapping from type to its total count and its count per directory name in JSON format, where
+            things registered here are counted under the current directory name and pushed-up copies are counted under
+            the child directory they are pushed from. With `subtree`, each descendant is counted under its own name
+            and pushed-up copies are excluded. HTTP status code 200 is returned.
+    """
+    thing_type = request.args.get('thing_type')
+    thing_type = None if not thing_type or not thing_type.strip() else thing_type.strip()
+    if request.args.get('subtree', '').lower() == 'true':
+        local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+        return jsonify(get_subtree_type_counts(local_server_name, thing_type)), 200
+    return jsonify(get_type_counts(thing_type)), 200
+
+
 @api.route('/adjacent_directory')
 def adjacent_directory():
     """Returned the neighbor(one-level apart) and master directory names and URIs of the current directory.
@@ -335,6 +558,171 @@ def adjacent_directory():
     return jsonify(DirectoryNameToURL.objects().to_json()), 200
 
 
+@api.route('/routing_metrics')
+def routing_metrics():
+    """Return the latency metrics of the routing lookups served by the in-memory routing table
+
+    Returns:
+        HTTP Response: the number of lookups, their average and maximal latency in microseconds and the size of the
+            routing table in JSON format with HTTP status 200
+    """
+    return jsonify(routing_table.get_metrics()), 200
+
+
+@api.route('/health')
+def health():
+    """Answer the health probes of the peer directories
+
+    Returns:
+        HTTP Response: the name of the current directory in JSON format with HTTP status 200
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    return jsonify({"status": "ok", "name": local_server_name}), 200
+
+
+@api.route('/peers')
+def peers():
+    """Return the circuit breaker state of every peer the current directory has talked to
+
+    Returns:
+        HTTP Response: mapping from peer base URL to its state ('closed', 'open' or 'half_open'), its consecutive
+            failures and the time its circuit was opened, in JSON format with HTTP status 200
+    """
+    return jsonify(peer_registry.get_status()), 200
+
+
+@api.route('/audit_status')
+def audit_status():
+    """Return the state of the audit log of the policy decisions
+
+    Returns:
+        HTTP Response: the number of records waiting in the buffer, its capacity, and the number of records written
+            and dropped because the writer fell behind or failed, in JSON format with HTTP status 200
+    """
+    return jsonify(audit_log.get_status()), 200
+
+
+@api.route('/topology', methods=['POST'])
+def topology():
+    """Reshape the routing data of the current directory according to a declarative topology
+
+    The parent, children, master and descendant routes of the current directory are derived from the topology, and only
+    the changed records of `DirectoryNameToURL` and `TargetToChildName` are written.
+
+    Args:
+        request.directories (list): the {"name", "url", "parent"} entries of all directories of the tree.
+
+    Returns:
+        HTTP Response: the number of changed routing records in JSON format, e.g. {"changes": 3}, with HTTP status
+            code 200. Otherwise a reason is returned with HTTP status code 400, or 403 if the body is not signed with
+            the tree secret
+    """
+    if not is_signed_request(request):
+        return jsonify(ERROR_PEER_AUTH), 403
+    if not is_json_request(request, ["directories"]):
+        return jsonify(ERROR_JSON), 400
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    try:
+        changes = apply_topology(parse_topology(request.get_json()), local_server_name)
+    except (ValueError, TypeError, AttributeError) as e:
+        return make_response(str(e), 400)
+    return jsonify({"changes": changes}), 200
+
+
+@api.route('/topology/join', methods=['POST'])
+def topology_join():
+    """Add a directory (and the subtree under it) as a child of the current directory
+
+    The new routes are propagated upward, so every ancestor can reach the joining directory and its descendants.
+
+    Args:
+        request.name (str): the name of the joining directory.
+        request.url (str): the URL of the joining directory.
+        request.descendants (list): optional, the names of the directories already under the joining directory.
+
+    Returns:
+        HTTP Response: the parent and master directories the joining directory should record in JSON format with HTTP
+            status code 200. Otherwise a reason is returned with HTTP status code 400, or 403 if the body is not signed
+            with the tree secret
+    """
+    if not is_signed_request(request):
+        return jsonify(ERROR_PEER_AUTH), 403
+    if not is_json_request(request, ["name", "url"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    descendants = body.get('descendants', [])
+    if type(descendants) != list:
+        return jsonify(ERROR_JSON), 400
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if body['name'] == local_server_name or local_server_name in descendants:
+        return make_response("A directory cannot join itself", 400)
+    return jsonify(add_child(body['name'], body['url'], descendants)), 200
+
+
+@api.route('/topology/leave', methods=['POST'])
+def topology_leave():
+    """Remove a child directory and all directories reached through it from the routes of the current directory
+
+    Args:
+        request.name (str): the name of the leaving child directory.
+        request.url (str): optional, only this instance of the child leaves, and the routes are kept while other
+            instances of the child are left.
+
+    Returns:
+        HTTP Response: a brief string explaining the result and corresponding HTTP status code.
+            When the child is removed, HTTP status code 200 will be return, 403 if the body is not signed with the
+            tree secret, otherwise 400.
+    """
+    if not is_signed_request(request):
+        return jsonify(ERROR_PEER_AUTH), 403
+    if not is_json_request(request, ["name"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    child = routing_table.get_directory(body['name'])
+    if child is None or child.relationship != 'child':
+        return make_response("Unknown child directory", 400)
+    removed = remove_child(body['name'], body.get('url'))
+    if removed:
+        remove_children_counts(None, removed)
+    return make_response("Leave successfully.", 200)
+
+
+@api.route('/topology/routes', methods=['POST'])
+def topology_routes():
+    """Update the descendant routes through a child directory, and propagate the change upward
+
+    Args:
+        request.via (str): the name of the child directory reporting the change.
+        request.add (list): names of the directories now reached through the child.
+        request.remove (list): names of the directories no longer reached through the child.
+
+    Returns:
+        HTTP Response: a brief string explaining the result and corresponding HTTP status code.
+            When the routes are updated, HTTP status code 200 will be return, 403 if the body is not signed with the
+            tree secret, otherwise 400.
+    """
+    if not is_signed_request(request):
+        return jsonify(ERROR_PEER_AUTH), 403
+    if not is_json_request(request, ["via"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    added = body.get('add', [])
+    removed = body.get('remove', [])
+    if type(added) != list or type(removed) != list:
+        return jsonify(ERROR_JSON), 400
+    child = routing_table.get_directory(body['via'])
+    if child is None or child.relationship != 'child':
+        return make_response("Unknown child directory", 400)
+
+    if removed:
+        remove_descendant_routes(removed)
+        remove_children_counts(None, removed)
+    if added:
+        add_descendant_routes(body['via'], added)
+    propagate_routes(added, removed)
+    return make_response("Update routes successfully.", 200)
+
+
 @api.route('/search', methods=['GET'])
 def search():
     """Search the thing descriptions according to the conditions from the target directory and return all satisfying thing descriptions
@@ -349,6 +737,12 @@ def search():
             is no constraint on the type.
         id (str) : the unique thing id of the thing description. Only the thing description having this id will be returned. If this is missing,
             then there is no constraint on the id.
+        enforce (str): optional, 'true' to return only the thing descriptions the current user may get. Each directory
+            evaluates the user against its own policies before returning its thing descriptions, the user and the
+            user and server attributes are passed to the descendants in the `_subject` argument, signed with the
+            secret shared by the directories of the tree. A `_subject` that is not validly signed is ignored. Pushed-up
+            copies are not returned, since they are decided by the policies of the directory they were registered in,
+            which returns them itself.
 
     Returns:
         HTTP Response: If the search operation is complete without error, a list of thing descriptions in JSON format is returned with HTTP code
@@ -356,7 +750,28 @@ def search():
     """
     location = request.args.get('location')
     local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
-    request_query_string = urlencode(request.args)
+    args = request.args.to_dict()
+    subject = None
+    if args.get('enforce', '').lower() == 'true':
+        # the subject and its attributes are resolved once by the directory the user is logged in, and passed to
+        # other directories signed with the tree secret. A `_subject` that is not validly signed is ignored, and the
+        # caller is evaluated as itself
+        forwarded = get_forwarded_subject(args['_subject']) \
+            if current_user.is_anonymous and '_subject' in args else None
+        if forwarded is not None:
+            subject, auth_attributes = forwarded
+            get_attribute_context().set_auth_attributes(auth_attributes)
+        else:
+            subject = get_access_subject()
+            auth_attributes = get_attribute_context().auth_attributes
+        if type(subject) != dict or type(subject.get('id')) != str or type(subject.get('attributes')) != dict:
+            return jsonify(ERROR_JSON), 400
+        # without a tree secret the descendants evaluate the caller as an anonymous user
+        signed_subject = sign_claims({"subject": subject, "auth_attributes": auth_attributes})
+        args.pop('_subject', None)
+        if signed_subject is not None:
+            args['_subject'] = signed_subject
+    request_query_string = urlencode(args)
     if not location or not location.strip():
         location = local_server_name
     else:
@@ -373,8 +788,19 @@ def search():
         thing_list = []
         # 1. add result in current directory
         things_obj = ThingDescription.objects(thing_type=thing_type) if thing_type else ThingDescription.objects.all()
-
+        if subject is not None:
+            things_obj = things_obj.filter(pushed_from=None)
+
+        # unauthorized thing descriptions never leave the directory, the policies are turned into a query filter
+        # when possible, otherwise each thing description is evaluated
+        permitted_filter = get_permitted_filter(subject, "get", local_server_name) if subject is not None else None
+        if permitted_filter is not None:
+            things_obj = things_obj.filter(__raw__=permitted_filter)
         local_things = json.loads(things_obj.to_json())
+        if subject is not None and permitted_filter is None:
+            local_things = filter_allowed_things(
+                [thing for thing in local_things if thing_id is None or thing["thing_id"] == thing_id],
+                subject, local_server_name)
 
         if local_things is not None:
             thing_list.extend(local_things)
@@ -409,7 +835,7 @@ def search():
     else:
         request_url = f"{target_url}?{request_query_string}"
         try:
-            response = requests.get(request_url)
+            response = peer_get(request_url, timeout=get_long_timeout())
         except:
             return "Search failed", 400
 
@@ -419,6 +845,106 @@ def search():
     return "Search failed", 400
 
 
+@api.route('/nearest', methods=['GET'])
+def nearest():
+    """Search the k thing descriptions nearest to a point in the target directory and all of its descendants
+
+    Each directory runs a local `$geoNear` query, then visits its children in the order of the minimum distance from
+    their spatial summaries. A child subtree is skipped if its closest possible point is farther than the current k-th
+    best result, and the current bound is passed down so that children can prune their own subtrees as well.
+
+    Args:
+        location (str): specify the directory where the search operation should be performed. If this is missing, then
+            the current location is used.
+        lng (float): longitude of the query point.
+        lat (float): latitude of the query point.
+        k (int): the number of thing descriptions to return. By default it is 10.
+        thing_type (str): optional, only thing descriptions of this type will be returned.
+        max_distance (float): optional, only thing descriptions within this distance in meters will be returned.
+
+    Returns:
+        HTTP Response: a list of at most k thing descriptions sorted by the `_distance` field (in meters) with HTTP
+            status code 200. Otherwise a string description along with HTTP status code 400 is returned.
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    location = request.args.get('location')
+    location = local_server_name if not location or not location.strip() else location.strip()
+
+    if location != local_server_name:
+        target_url = get_target_url(location, url_for('api.nearest'))
+        if target_url is None:
+            return "Search failed", 400
+        try:
+            response = peer_get(f"{target_url}?{urlencode(request.args)}", timeout=get_long_timeout())
+        except requests.RequestException:
+            return "Search failed", 400
+        if response.status_code == 200:
+            return jsonify(response.json()), 200
+        return "Search failed", 400
+
+    try:
+        point = [float(request.args['lng']), float(request.args['lat'])]
+        k = int(request.args.get('k', 10))
+        max_distance = float(request.args['max_distance']) if request.args.get('max_distance') else None
+    except (KeyError, ValueError):
+        return jsonify(ERROR_JSON), 400
+    if k <= 0:
+        return jsonify([]), 200
+    thing_type = request.args.get('thing_type')
+    thing_type = None if not thing_type or not thing_type.strip() else thing_type.strip()
+
+    # 1. local $geoNear query
+    geo_near = {
+        "near": {"type": "Point", "coordinates": point},
+        "distanceField": "_distance",
+        "key": "properties.geo.coordinates",
+        "spherical": True,
+        "query": {"thing_type": thing_type} if thing_type else {}
+    }
+    if max_distance is not None:
+        geo_near["maxDistance"] = max_distance
+    cursor = ThingDescription._get_collection().aggregate([{"$geoNear": geo_near}, {"$limit": k}])
+    best_list = merge_nearest([], json.loads(json_util.dumps(cursor)), k)
+
+    # 2. visit children ordered by the minimum distance of their spatial summaries
+    children_directories = routing_table.get_children()
+    if thing_type:
+        type_record = TypeToChildrenNames.objects(thing_type=thing_type).first()
+        child_names = {routing_table.get_child_name(name) for name in type_record.children_names} \
+            if type_record else set()
+        children_directories = [child for child in children_directories if child.directory_name in child_names]
+    summaries = {summary.directory_name: summary.bbox for summary in SpatialSummary.objects(
+        directory_name__in=[child.directory_name for child in children_directories])}
+    # a child without a spatial summary, e.g. whose report failed, is unbounded and cannot be pruned
+    candidates = sorted(((min_distance_to_bbox(point, summaries[child.directory_name])
+                          if summaries.get(child.directory_name) else 0, child)
+                         for child in children_directories),
+                        key=lambda item: item[0])
+
+    for child_distance, child in candidates:
+        bound = best_list[-1]["_distance"] if len(best_list) == k else max_distance
+        if max_distance is not None and bound is not None:
+            bound = min(bound, max_distance)
+        # children are sorted, so no remaining subtree can contain a nearer thing
+        if bound is not None and child_distance > bound:
+            break
+        query_parameters = {"location": child.directory_name, "lng": point[0], "lat": point[1], "k": k}
+        if thing_type:
+            query_parameters["thing_type"] = thing_type
+        if bound is not None:
+            query_parameters["max_distance"] = bound
+        try:
+            response = peer_get(f"{urljoin(routing_table.get_url(child), url_for('api.nearest'))}?{urlencode(query_parameters)}",
+                                timeout=get_long_timeout())
+        except requests.RequestException:
+            continue
+        if response.status_code != 200:
+            continue
+        best_list = merge_nearest(best_list, response.json(), k)
+
+    return jsonify(best_list), 200
+
+
 @api.route('/jwt', methods=['GET'])
 def get_jwt():
     """Generate jwt of the requested thing with minimal inforamtion in the payload`
@@ -464,9 +990,10 @@ def send_jwt():
         'pub_key': session.get('pub_key').decode()
     }
 
-    # send and get response
+    # send and get response, the target is any URL given by the user, not a peer directory
     try:
-        response = requests.post(target_url, data=json.dumps(data))
+        response = requests.post(target_url, data=json.dumps(data),
+                                 timeout=app.config.get('PEER_TIMEOUT', DEFAULT_PEER_TIMEOUT))
     except Exception as e:
         return make_response("Request Failed", 400)
 
@@ -513,7 +1040,7 @@ def delete():
     if target_url is not None:
         request_url = f"{target_url}?{urlencode(request.args)}"
         try:
-            response = requests.delete(request_url)
+            response = peer_delete(request_url)
         except:
             return "", 400
         if response.status_code == 200:
@@ -522,6 +1049,111 @@ def delete():
     return "", 400
 
 
+@api.route('/bulk_delete', methods=['POST'])
+def bulk_delete():
+    """Delete all thing descriptions specified by a list of ids or by a filter from the directory specified by `location`
+
+    If the current directory is the target location specified by `location` argument, the operation is processed locally
+    Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
+
+    The thing descriptions are deleted with one database operation, and the parent directory receives one batched
+    deletion of pushed-up copies and one batched aggregation update.
+
+    Args:
+        This method receive arguments from HTTP request body, which must be JSON format containing following properties
+        location (str): specify the location where the thing descriptions are located
+        thing_ids (list): optional, the ids of the thing descriptions to be deleted
+        filter (dict): optional, the filter conditions of the thing descriptions to be deleted. It accepts "thing_type",
+            "polygon" and property paths such as "properties.status.data", the same as the filter of custom query
+        At least one of a non-empty `thing_ids` and a non-empty `filter` is required. If both are present, both must
+        be satisfied.
+        pushed_from (str): optional, set by the child directory to only delete the copies it pushed up. Otherwise
+            only the thing descriptions registered here are deleted, pushed-up copies follow their original thing.
+
+    Returns:
+        HTTP Response: the number of deleted thing descriptions in JSON format with HTTP status code 200 if the deletion
+        is complete. Otherwise HTTP status code 400 is returned.
+    """
+    if not is_json_request(request, ["location"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    location = body['location'].strip()
+    thing_ids = body.get('thing_ids')
+    filters = body.get('filter')
+    pushed_from = body.get('pushed_from')
+    if (thing_ids is None and filters is None) or (thing_ids is not None and type(thing_ids) != list) or \
+            (filters is not None and type(filters) != dict):
+        return jsonify(ERROR_JSON), 400
+
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if location == local_server_name:
+        filter_map = get_selection_map(thing_ids, filters)
+        if filter_map is None:
+            return jsonify(ERROR_JSON), 400
+        filter_map["pushed_from"] = pushed_from
+        try:
+            deleted_count = delete_local_thing_descriptions(ThingDescription.objects(**filter_map))
+        except Exception:
+            return jsonify({"reason": "filter condition error."}), 400
+        return jsonify({"deleted": deleted_count}), 200
+
+    # if not aiming at current directory, send a request to the correct target location
+    target_url = get_target_url(location, url_for("api.bulk_delete"))
+    if target_url is None:
+        return jsonify(ERROR_JSON), 400
+    try:
+        response = peer_post(target_url, data=json.dumps(body), headers=HEADERS, timeout=get_long_timeout())
+    except requests.RequestException:
+        return "Bulk delete failed", 400
+    if response.status_code == 200:
+        return jsonify(response.json()), 200
+    return "Bulk delete failed", 400
+
+
+@api.route('/renew_leases', methods=['POST'])
+def renew_leases_api():
+    """Renew the leases of many thing descriptions in one batched heartbeat
+
+    If the current directory is the target location specified by `location` argument, the operation is processed locally
+    Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
+
+    Args:
+        This method receive arguments from HTTP request body, which must be JSON format containing following properties
+        location (str): specify the location where the thing descriptions are located
+        thing_ids (list): the ids of the thing descriptions whose leases are renewed
+        lease (number): the new lease in seconds, starting from now
+
+    Returns:
+        HTTP Response: the number of renewed thing descriptions in JSON format with HTTP status code 200.
+            Otherwise HTTP status code 400 is returned.
+    """
+    if not is_json_request(request, ["location", "thing_ids", "lease"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    location = body['location'].strip()
+    if type(body['thing_ids']) != list:
+        return jsonify(ERROR_JSON), 400
+
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if location == local_server_name:
+        try:
+            renewed_count = renew_leases(body['thing_ids'], body['lease'])
+        except (TypeError, ValueError):
+            return jsonify(ERROR_JSON), 400
+        return jsonify({"renewed": renewed_count}), 200
+
+    target_url = get_target_url(location, url_for("api.renew_leases_api"))
+    if target_url is None:
+        return jsonify(ERROR_JSON), 400
+    try:
+        response = peer_post(target_url, data=json.dumps(body), headers=HEADERS)
+    except requests.RequestException:
+        return "Renew leases failed", 400
+    if response.status_code == 200:
+        return jsonify(response.json()), 200
+    return "Renew leases failed", 400
+
+
 @api.route('/relocate', methods=['POST'])
 def relocate():
     """Relocate a thing specified by the `thing_id` from the location specified by `from` to the location specified by `to`
@@ -532,8 +1164,8 @@ def relocate():
     This method performs search operation using the `thing_id` from the `from` directory
     Then the thing description is removed locally, followed by an insertion operation using the same thing description content in `to` directory
     
-    Caution: Currently this two steps are not performed as one transaction, which means even if the second operation (insertion) failed, 
-    the first operation (deletion) is already finished an irrevocable.
+    Caution: Currently this two steps are not performed as one transaction. The deletion only happens after the insertion succeeded,
+    but if the deletion fails, the thing description exists in both directories. Use `bulk_relocate` for a resumable relocation.
 
     Args:
         This method receive arguments from HTTP request body, which must be JSON format containing following properties
@@ -552,11 +1184,6 @@ def relocate():
     from_location = body['from']
     to_location = body['to']
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept-Charset': 'UTF-8'
-    }
-
     local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
     if local_server_name == from_location:
         relocate_thing = ThingDescription.objects(thing_id=thing_id).first()
@@ -570,12 +1197,13 @@ def relocate():
             "publicity": relocate_thing.publicity
         }
         try:
-            response = requests.post(
-                target_url, data=json.dumps(request_data), headers=headers)
-            pass
+            response = peer_post(
+                target_url, data=json.dumps(request_data), headers=HEADERS)
         except:
             return "Relocate failed", 400
-        # 2. delete this thing description at 'from_location'
+        if response.status_code != 200:
+            return "Relocate failed", 400
+        # 2. delete this thing description at 'from_location' only after the insertion succeeded
         delete_local_thing_description(thing_id)
 
         return "", 200
@@ -585,14 +1213,154 @@ def relocate():
     if request_url is None:
         return "Request failed", 400
     try:
-        response = requests.post(
-            request_url, data=json.dumps(body), headers=headers)
+        response = peer_post(
+            request_url, data=json.dumps(body), headers=HEADERS)
     except:
         return "Request failed", 400
 
     return "", response.status_code
 
 
+@api.route('/bulk_register', methods=['POST'])
+def bulk_register():
+    """Register a batch of thing descriptions at the target location.
+
+    If the current directory is the target location specified by `location` argument, the operation is processed locally
+    Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
+
+    The thing descriptions are inserted with one database operation. A thing description that is already registered
+    here is acknowledged as well, so a batch can be sent again after an interruption, and a pushed-up copy of it is
+    converted into the registered thing.
+
+    Args:
+        All of the following arguments are passed in the request body in JSON format.
+        tds (list): the thing descriptions to be registered. Each one may carry its own 'publicity', by default zero.
+        location (str): the location where the thing descriptions should be registered
+        pushed_from (str): optional, set by the child directory when the thing descriptions are pushed-up copies.
+        lease (number): optional, the lease in seconds of all thing descriptions, see `register`.
+
+    Returns:
+        HTTP Response: the ids of the registered thing descriptions and of the pushed-up copies converted into
+            registered things in JSON format, e.g. {"registered": [...], "converted": [...]}, with HTTP status code
+            200. Otherwise a reason is returned with HTTP status code 400
+    """
+    if not is_json_request(request, ["tds", "location"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    location = body['location']
+    if type(body['tds']) != list:
+        return jsonify(ERROR_JSON), 400
+
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if local_server_name == location:
+        try:
+            lease_expires = get_lease_expires(body.get('lease'))
+        except (TypeError, ValueError):
+            return jsonify(ERROR_JSON), 400
+        registered_ids, converted_ids = register_local_thing_descriptions(body['tds'], body.get('pushed_from'),
+                                                                          lease_expires)
+        return jsonify({"registered": registered_ids, "converted": converted_ids}), 200
+
+    target_url = get_target_url(location, url_for("api.bulk_register"))
+    if target_url is None:
+        return jsonify(ERROR_JSON), 400
+    try:
+        response = peer_post(target_url, data=json.dumps(body), headers=HEADERS, timeout=get_long_timeout())
+    except requests.RequestException:
+        return make_response("Register failed", 400)
+    if response.status_code == 200:
+        return jsonify(response.json()), 200
+    return make_response(response.reason, response.status_code)
+
+
+@api.route('/bulk_relocate', methods=['POST'])
+def bulk_relocate():
+    """Relocate all things specified by a list of ids or by a filter from the location `from` to the location `to`
+
+    If the current directory is the `from` location, the operation is processed locally
+    Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
+
+    The thing descriptions are sent to the destination in batches. The progress is journaled, and the local thing
+    descriptions are only deleted after the destination acknowledged them. An interrupted relocation can be resumed
+    by sending the same request with the returned `job_id`.
+
+    Args:
+        This method receive arguments from HTTP request body, which must be JSON format containing following properties
+        from (str): specify the location where the thing descriptions are located
+        to (str): specify the location that the thing descriptions should be relocated to
+        thing_ids (list): optional, the ids of the thing descriptions to be relocated
+        filter (dict): optional, the filter conditions of the thing descriptions to be relocated, the same as bulk_delete
+        At least one of a non-empty `thing_ids` and a non-empty `filter` is required, unless `job_id` is given.
+        batch_size (int): optional, the number of thing descriptions sent in one request. By default it is 100.
+        job_id (str): optional, the id of an interrupted relocation to be resumed. Other selections are ignored.
+
+    Returns:
+        HTTP Response: the report of the relocation in JSON format, including the number of moved things, failed ids and
+            the throughput in things per second. HTTP status code 200 is returned if the relocation is completed,
+            otherwise 400 is returned.
+    """
+    if not is_json_request(request, ["from", "to"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    from_location = body['from'].strip()
+    to_location = body['to'].strip()
+    thing_ids = body.get('thing_ids')
+    filters = body.get('filter')
+    try:
+        batch_size = int(body.get('batch_size', 100))
+    except (TypeError, ValueError):
+        return jsonify(ERROR_JSON), 400
+    if batch_size <= 0 or (thing_ids is not None and type(thing_ids) != list) or \
+            (filters is not None and type(filters) != dict):
+        return jsonify(ERROR_JSON), 400
+
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if local_server_name == from_location:
+        if body.get('job_id'):
+            job = RelocationJob.objects(job_id=body['job_id']).first()
+            if job is None:
+                return jsonify(ERROR_JSON), 400
+        else:
+            filter_map = get_selection_map(thing_ids, filters)
+            if filter_map is None:
+                return jsonify(ERROR_JSON), 400
+            # only the things registered here are relocated, pushed-up copies follow their original thing
+            filter_map["pushed_from"] = None
+            try:
+                job = create_relocation_job(from_location, to_location, ThingDescription.objects(**filter_map),
+                                            batch_size)
+            except Exception:
+                return jsonify({"reason": "filter condition error."}), 400
+        job = run_relocation_job(job)
+        return jsonify(job.to_report()), 200 if job.state == 'completed' else 400
+
+    # delegate the request to other directory
+    request_url = get_target_url(from_location, url_for("api.bulk_relocate"))
+    if request_url is None:
+        return "Request failed", 400
+    try:
+        response = peer_post(request_url, data=json.dumps(body), headers=HEADERS, timeout=get_long_timeout())
+    except requests.RequestException:
+        return "Request failed", 400
+    return make_response(response.content, response.status_code)
+
+
+@api.route('/bulk_relocate/<job_id>', methods=['GET'])
+def bulk_relocate_status(job_id):
+    """Return the report of a relocation journaled in current directory
+
+    Args:
+        job_id (str): the id returned by `bulk_relocate`
+
+    Returns:
+        HTTP Response: the report of the relocation in JSON format with HTTP status code 200, or 404 if it is unknown
+    """
+    job = RelocationJob.objects(job_id=job_id).first()
+    if job is None:
+        return jsonify({"error": "Unknown job id."}), 404
+    return jsonify(job.to_report()), 200
+
+
 @api.route('/custom_query', methods=['GET'])
 def custom_query():
     """Return all thing descriptions from the target directory and its descandant directories that satisfy the filter conditions
@@ -603,8 +1371,11 @@ def custom_query():
         data (str):
         location (str): optional, specify the root directory to be searched. 
         filter (JSON str): 
+        precision (int): required by the HEATMAP operation, the geohash precision of the cells (1 to 12).
     Returns:
         HTTP Response:
+        The HEATMAP operation returns the number of things per geohash cell, e.g.
+        {"operation": "HEATMAP", "precision": 5, "result": {"dr5ru": 3, "dr5rv": 1}}
     """
     script = request.args.get('data')
     try:
@@ -612,7 +1383,7 @@ def custom_query():
     except:
         return jsonify({"error": "Invalid input format"}), 400
 
-    SCRIPT_OPERATION = ["SUM", "AVG", "MIN", "MAX", "COUNT"]  # Allowed operation of the customized script query
+    SCRIPT_OPERATION = ["SUM", "AVG", "MIN", "MAX", "COUNT", "HEATMAP"]  # Allowed operation of the customized script query
 
     # check input combination: type and operation are required
     if "operation" not in script_json or "type" not in script_json or type(script_json["operation"]) != str:
@@ -621,7 +1392,7 @@ def custom_query():
     script_json["operation"] = script_json["operation"].upper()
 
     if script_json["operation"] not in SCRIPT_OPERATION or (
-            script_json["operation"] != "COUNT" and "data" not in script_json):
+            script_json["operation"] not in ("COUNT", "HEATMAP") and "data" not in script_json):
         return jsonify(ERROR_JSON), 400
 
     # 2. Clean parameters
@@ -638,23 +1409,8 @@ def custom_query():
         operation = script_json["operation"].strip()
         thing_type = script_json["type"].strip()
 
-        filter_map = {}
-        # add geographical filter condition
-        if "polygon" in filters and type(filters["polygon"]) == list and len(filters["polygon"]) >= 3:
-            # properties__geo__coordinates represents field properties.geo.coordinates
-            # geo_within_polygon: query string for geospatial query
-            filter_map["properties__geo__coordinates__geo_within_polygon"] = filters.pop("polygon")
-            # An example of mongodb query is: db.td.find({ "properties.geo.coordinates": { $geoWithin: {$polygon: [[-75,40],[-75,41],[-70,41],[-70,40]]}}})
-
-        for filter_name in filters:
-            filter_map[filter_name.replace(".", "__")] = filters[filter_name]
-
-        try:
-            thing_list = json.loads(ThingDescription.objects(thing_type=thing_type, **filter_map).to_json())
-        except:
-            return jsonify({"reason": "filter condition error."}), 400
+        filter_map = get_filter_map(filters)
 
-        # 3. get children result.
         # "_sub_dir" field checks whether current directory is a recursive node
         # if this field is true, which means the request must return a compressed thing list results
         # otherwise, return the final aggregation result
@@ -663,6 +1419,40 @@ def custom_query():
         # delete the "location" field in the query string, then each children will treat themselves as the target dir
         if "location" in script_json:
             del script_json["location"]
+
+        # HEATMAP counts things per geohash cell locally and merges the sparse cell maps of children
+        if operation == "HEATMAP":
+            try:
+                precision = int(script_json.get("precision", 0))
+            except (TypeError, ValueError):
+                precision = 0
+            if not 1 <= precision <= GEOHASH_MAX_PRECISION:
+                return jsonify(ERROR_JSON), 400
+            try:
+                # pushed-up copies are counted by the directory holding the original thing
+                heat_map = count_by_geohash(
+                    ThingDescription.objects(thing_type=thing_type, pushed_from=None, **filter_map), precision)
+            except Exception:
+                return jsonify({"reason": "filter condition error."}), 400
+            children_result_list = get_children_result(thing_type, url_for(
+                "api.custom_query"), f"data={json.dumps(script_json)}")
+            heat_map = merge_heat_maps([heat_map] + children_result_list)
+            if not is_sub_dir:
+                return jsonify({"operation": operation, "precision": precision, "result": heat_map}), 200
+            return jsonify(heat_map), 200
+
+        # an unfiltered COUNT is answered from the counters and the per-descendant counts, without fan-out, once
+        # the counters were recounted from the stored things
+        if operation == "COUNT" and not filters and not is_sub_dir and are_counters_recounted():
+            total = get_subtree_type_counts(local_server_name, thing_type)[thing_type]["total"]
+            return jsonify({"operation": operation, "result": total}), 200
+
+        try:
+            thing_list = json.loads(ThingDescription.objects(thing_type=thing_type, **filter_map).to_json())
+        except Exception:
+            return jsonify({"reason": "filter condition error."}), 400
+
+        # 3. get children result.
         children_result_list = get_children_result(thing_type, url_for(
             "api.custom_query"), f"data={json.dumps(script_json)}")
         thing_list.extend(children_result_list)
@@ -677,7 +1467,7 @@ def custom_query():
         # return the aggregation result if current directory is the root
         # otherwise return the compressed list
         if not is_sub_dir:
-            return jsonify(get_final_aggregation(compressed_thing_list, operation, time_range)), 200
+            return jsonify(get_final_aggregation(compressed_thing_list, operation)), 200
         else:
             return jsonify(compressed_thing_list), 200
 
@@ -687,7 +1477,7 @@ def custom_query():
     if request_url is None:
         return jsonify("Request failed(location does not exist.)"), 400
     try:
-        response = requests.get(f"{request_url}?data={script}")
+        response = peer_get(f"{request_url}?data={script}", timeout=get_long_timeout())
     except:
         return jsonify("Request failed(target location is not running.)"), 400
 
@@ -1,11 +1,19 @@
+import datetime
 import json
-from urllib.parse import urljoin, urlencode
+from urllib.parse import urljoin, urlencode, parse_qsl
 
 import requests
 from flask import current_app as app
 from flask import url_for
+from pymongo.errors import BulkWriteError
 
-from ..models import ThingDescription, DirectoryNameToURL, TypeToChildrenNames, TargetToChildName
+from .counter import increase_type_count, increase_type_counts, get_local_type_count
+from .data_helper import pop_lease_expires
+from .geo_helper import expand_bbox, get_coordinates
+from ..models import ThingDescription, TypeToChildrenNames, SpatialSummary, ThingFrequency
+from ..peers import peer_get, peer_post, peer_delete, get_long_timeout, HEADERS
+from ..routing import routing_table
+from ..utils import clean_thing_description
 
 
 def delete_local_thing_description(thing_id: str):
@@ -25,16 +33,179 @@ def delete_local_thing_description(thing_id: str):
     delete_thing = ThingDescription.objects(thing_id=thing_id).first()
     if delete_thing is None:
         return 404
-    delete_thing.delete()
+    # only count the deletion if this request actually removed the thing description
+    deleted = ThingDescription.objects(thing_id=thing_id).delete()
+    if deleted:
+        increase_type_count(delete_thing.thing_type, delete_thing.pushed_from or app.config['HOST_NAME'], -1)
     # 1. if the publicity is larger than 0, it needs to recursively delete the thing in parent's directory
     if delete_thing.publicity > 0:
         delete_up_things(delete_thing.thing_id)
     # 2. if current directory has no other thing_description of this type,
     # should update parent's aggregation information to delete this one
-    dir_remaining_count = ThingDescription.objects(
-        thing_type=delete_thing.thing_type).count()
-    if dir_remaining_count == 0:
+    if get_local_type_count(delete_thing.thing_type) <= 0:
         parent_aggregation('delete', delete_thing.thing_type, app.config['HOST_NAME'])
+    # otherwise only the counts of the ancestors decrease, if the thing was registered here
+    elif deleted and delete_thing.pushed_from is None:
+        parent_count_deltas({delete_thing.thing_type: -1}, app.config['HOST_NAME'])
+
+
+def register_local_thing_descriptions(thing_descriptions: list, pushed_from: str = None,
+                                      lease_expires: datetime.datetime = None) -> tuple:
+    """Register a batch of thing descriptions in local directory and return the ids that are acknowledged.
+
+    All thing descriptions are inserted with a single `insert_many`. A thing description registered here that
+    already exists as a thing registered here is acknowledged as well, so that a batch can be safely sent again after
+    an interruption. If it exists as a pushed-up copy, e.g. when a thing is relocated to an ancestor of its directory,
+    the copy is converted into the registered thing. Pushed-up copies replace existing copies, since the same thing
+    may be pushed up from a different child after a relocation, but never a thing registered here. Any other
+    duplicate is rejected. The pushed-up copies, aggregation data and spatial summary of the parent directory are
+    updated once per batch.
+
+    Args:
+        thing_descriptions (list): thing descriptions, each one may carry its own 'publicity'
+        pushed_from (str): the child directory name if these thing descriptions are pushed-up copies
+        lease_expires (datetime): optional, the expiration time of the leases of these thing descriptions
+
+    Return:
+        tuple: the 'thing_id' of every thing description that is stored in local directory after the operation, and
+            the 'thing_id' of the pushed-up copies converted into registered things
+    """
+    new_things = []
+    for thing_description in thing_descriptions:
+        thing_description = clean_thing_description(dict(thing_description))
+        publicity = int(thing_description.pop("publicity", 0) or 0)
+        thing_description.pop("pushed_from", None)
+        thing_description.pop("_id", None)
+        # a relocated thing description keeps its own lease unless a new one is given
+        thing_lease_expires = pop_lease_expires(thing_description)
+        try:
+            new_td = ThingDescription(publicity=publicity, pushed_from=pushed_from,
+                                      lease_expires=lease_expires or thing_lease_expires, **thing_description)
+            new_td.validate()
+        except Exception as e:
+            app.logger.warning("Skipped an invalid thing description: %s", e)
+            continue
+        new_things.append((thing_description, new_td))
+    if not new_things:
+        return [], []
+
+    collection = ThingDescription._get_collection()
+    docs = [new_td.to_mongo().to_dict() for _, new_td in new_things]
+    acknowledged = {new_td.thing_id for _, new_td in new_things}
+    inserted = set(acknowledged)
+    converted = set()
+    counter_deltas = {}
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            doc = docs[error['index']]
+            inserted.discard(doc['thing_id'])
+            # 11000: duplicate key, the thing description is already stored
+            if error.get('code') != 11000:
+                acknowledged.discard(doc['thing_id'])
+                continue
+            doc.pop('_id', None)
+            # only a pushed-up copy is replaced, a thing registered here is never overwritten by a copy
+            replaced = collection.find_one_and_replace(
+                {'thing_id': doc['thing_id'], 'pushed_from': {'$ne': None}}, doc)
+            if replaced is not None:
+                key = (replaced.get('thing_type'), replaced['pushed_from'])
+                counter_deltas[key] = counter_deltas.get(key, 0) - 1
+                if pushed_from is None:
+                    # the copy is now the registered thing, it is counted below like an inserted one
+                    inserted.add(doc['thing_id'])
+                    converted.add(doc['thing_id'])
+                else:
+                    key = (doc.get('thing_type'), pushed_from)
+                    counter_deltas[key] = counter_deltas.get(key, 0) + 1
+            elif pushed_from is not None or \
+                    collection.count_documents({'thing_id': doc['thing_id'], 'pushed_from': None}, limit=1) == 0:
+                acknowledged.discard(doc['thing_id'])
+    for _, new_td in new_things:
+        if new_td.thing_id in inserted:
+            key = (new_td.thing_type, pushed_from or app.config['HOST_NAME'])
+            counter_deltas[key] = counter_deltas.get(key, 0) + 1
+    increase_type_counts(counter_deltas)
+    if inserted - converted:
+        try:
+            ThingFrequency._get_collection().insert_many(
+                [{'thing_id': thing_id, 'timestamps': {}} for thing_id in inserted - converted], ordered=False)
+        except BulkWriteError:
+            pass
+
+    registered = [(thing_description, new_td) for thing_description, new_td in new_things
+                  if new_td.thing_id in acknowledged]
+    # push up, update aggregation data and spatial summary once for the whole batch
+    push_up_things_batch([dict(thing_description, publicity=new_td.publicity)
+                          for thing_description, new_td in registered if new_td.publicity > 0])
+    local_server_name = app.config['HOST_NAME']
+    for thing_type in {new_td.thing_type for _, new_td in registered}:
+        # only things registered here are counted by the ancestors, not pushed-up copies
+        count_delta = counter_deltas.get((thing_type, local_server_name), 0) if pushed_from is None else 0
+        parent_aggregation("add", thing_type, local_server_name, count_delta)
+    bbox = None
+    for thing_description, _ in registered:
+        coordinates = get_coordinates(thing_description)
+        if coordinates is not None:
+            bbox = expand_bbox(bbox, coordinates)
+    if bbox is not None:
+        expand_spatial_summary(local_server_name, bbox)
+    return [new_td.thing_id for _, new_td in registered], sorted(converted)
+
+
+def delete_local_thing_descriptions(things_obj, keep_up_ids=()) -> int:
+    """Delete all thing descriptions matched by `things_obj` in local directory with batched propagation.
+
+    The matched thing descriptions are removed with a single `delete_many`. Pushed-up copies in the parent directory
+    are removed with one batched request, and the parent's aggregation data is updated with one request carrying
+    every type that no longer exists in the current directory.
+
+    Args:
+        things_obj (QuerySet): the mongoengine query set of thing descriptions to be deleted
+        keep_up_ids (list): optional, the ids whose copy in the parent directory is kept, because it was converted
+            into the registered thing by a relocation
+
+    Return:
+        int: the number of thing descriptions deleted by this call
+    """
+    delete_things = list(things_obj.only('id', 'thing_id', 'thing_type', 'publicity', 'pushed_from'))
+    if not delete_things:
+        return 0
+    # the things are deleted in one operation per counter, so a counter only decreases by the things deleted by
+    # this call and not by the ones deleted concurrently, e.g. by another instance
+    groups = {}
+    for thing in delete_things:
+        groups.setdefault((thing.thing_type, thing.pushed_from), []).append(thing.id)
+    collection = ThingDescription._get_collection()
+    deltas = {}
+    deleted_count = 0
+    for (thing_type, pushed_from), ids in groups.items():
+        deleted = collection.delete_many({'_id': {'$in': ids}, 'thing_type': thing_type,
+                                          'pushed_from': pushed_from}).deleted_count
+        key = (thing_type, pushed_from or app.config['HOST_NAME'])
+        deltas[key] = deltas.get(key, 0) - deleted
+        deleted_count += deleted
+    thing_ids = [thing.thing_id for thing in delete_things]
+    ThingFrequency.objects(thing_id__in=thing_ids).delete()
+    increase_type_counts(deltas)
+
+    # 1. recursively delete the things whose publicity is larger than 0 in parent's directory
+    pushed_up_ids = [thing.thing_id for thing in delete_things
+                     if thing.publicity > 0 and thing.thing_id not in keep_up_ids]
+    if pushed_up_ids:
+        delete_up_things_batch(pushed_up_ids)
+    # 2. update parent's aggregation information for types that no longer exist in current directory
+    thing_types = {thing.thing_type for thing in delete_things}
+    removed_types = sorted(thing_type for thing_type in thing_types if get_local_type_count(thing_type) <= 0)
+    if removed_types:
+        parent_aggregation('delete', removed_types, app.config['HOST_NAME'])
+    # 3. decrease the counts of the remaining types registered here
+    count_deltas = {thing_type: delta for (thing_type, directory_name), delta in deltas.items()
+                    if directory_name == app.config['HOST_NAME'] and thing_type not in removed_types and delta}
+    if count_deltas:
+        parent_count_deltas(count_deltas, app.config['HOST_NAME'])
+    return deleted_count
 
 
 def push_up_things(thing_description: dict, publicity: int):
@@ -48,28 +219,57 @@ def push_up_things(thing_description: dict, publicity: int):
     Return:
         bool: boolean value indicating the push up result. If succeed, return True, otherwise False
     """
-    parent_directory = DirectoryNameToURL.objects(
-        relationship='parent').first()
+    parent_directory = routing_table.get_parent()
     # 1. only do push-up when the publicity is larger than 0, and it has parent
     if publicity == 0 or parent_directory is None:
         return True
 
     # 2. send push up request to the parent url
-    parent_url = urljoin(parent_directory.url, url_for('api.register'))
+    parent_url = urljoin(routing_table.get_url(parent_directory), url_for('api.register'))
     request_data = {
         "td": thing_description,
         "location": parent_directory.directory_name,
-        "publicity": publicity - 1
+        "publicity": publicity - 1,
+        "pushed_from": app.config['HOST_NAME']
     }
 
-    response = requests.post(parent_url, data=json.dumps(request_data), headers={
-        'Content-Type': 'application/json',
-        'Accept-Charset': 'UTF-8'
-    })
+    try:
+        response = peer_post(parent_url, data=json.dumps(request_data), headers=HEADERS)
+    except requests.RequestException:
+        return False
 
     return response.status_code == 200
 
 
+def push_up_things_batch(thing_descriptions: list) -> bool:
+    """Send one register request to parent directory for all thing descriptions that need to be pushed up
+
+    Args:
+        thing_descriptions (list): thing descriptions carrying their own 'publicity', which is decreased by one
+
+    Return:
+        bool: boolean value indicating the push up result. If succeed, return True, otherwise False
+    """
+    parent_directory = routing_table.get_parent()
+    thing_descriptions = [thing_description for thing_description in thing_descriptions
+                          if thing_description.get("publicity", 0) > 0]
+    if not thing_descriptions or parent_directory is None:
+        return True
+
+    parent_url = urljoin(routing_table.get_url(parent_directory), url_for('api.bulk_register'))
+    request_data = {
+        "tds": [dict(thing_description, publicity=thing_description["publicity"] - 1)
+                for thing_description in thing_descriptions],
+        "location": parent_directory.directory_name,
+        "pushed_from": app.config['HOST_NAME']
+    }
+    try:
+        response = peer_post(parent_url, data=json.dumps(request_data), headers=HEADERS, timeout=get_long_timeout())
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
 def delete_up_things(thing_id: str) -> bool:
     """Send delete request to parent's directory's /delete API, asking to delete the thing description.
 
@@ -78,52 +278,158 @@ def delete_up_things(thing_id: str) -> bool:
     Return:
         bool: True if the deletion is complete, otherwise False.
     """
-    parent_dir = DirectoryNameToURL.objects(relationship='parent').first()
+    parent_dir = routing_table.get_parent()
     response = None
     if parent_dir is not None:
         query_parameters = urlencode(
             {"location": parent_dir.directory_name, "thing_id": thing_id})
-        request_url = f"{urljoin(parent_dir.url, url_for('api.delete'))}?{query_parameters}"
+        request_url = f"{urljoin(routing_table.get_url(parent_dir), url_for('api.delete'))}?{query_parameters}"
         try:
-            response = requests.delete(request_url)
+            response = peer_delete(request_url)
         except:
             return False
     return response is None or response.status_code == 200
 
 
-def parent_aggregation(operation: str, thing_type: str, location: str) -> bool:
+def delete_up_things_batch(thing_ids: list) -> bool:
+    """Send one request to parent's directory's /bulk_delete API, asking to delete all the thing descriptions.
+
+    Args:
+        thing_ids (list): Unique identifers of thing descriptions to be deleted.
+    Return:
+        bool: True if the deletion is complete, otherwise False.
+    """
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+    request_url = urljoin(routing_table.get_url(parent_dir), url_for('api.bulk_delete'))
+    # only remove the copies pushed up from current directory, copies pushed up again
+    # from another child after a relocation are kept
+    request_data = {"location": parent_dir.directory_name, "thing_ids": thing_ids,
+                    "pushed_from": app.config['HOST_NAME']}
+    try:
+        response = peer_post(request_url, data=json.dumps(request_data), headers=HEADERS, timeout=get_long_timeout())
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def parent_aggregation(operation: str, thing_type, location: str, count_delta: int = 0) -> bool:
     """Send a post request to parent's directory to update the aggregation data.
 
     Args:
-        thing_type(str): Specify the type of the aggregation.
+        thing_type(str): Specify the type of the aggregation. The 'delete' operation also accepts a list of types,
+            which are removed with one request.
         location(str): the directory name that the aggregation should be using to update.
+        count_delta(int): used by the 'add' operation, the number of things of this type newly registered at
+            `location`, pushed-up copies excluded.
 
     Returns:
         bool: True if the update is complete, otherwise False.
     :return: boolean value indicating the update result. return True if update successfully
     """
 
-    parent_dir = DirectoryNameToURL.objects(relationship='parent').first()
+    parent_dir = routing_table.get_parent()
     if parent_dir is None:
         return True
 
     request_body = {"location": location, "thing_type": thing_type}
     response = None
 
-    if operation == "add":
-        request_url = urljoin(parent_dir.url, url_for(
-            'api.update_type_aggregation'))
-        response = requests.post(request_url, data=json.dumps(request_body), headers={
-            'Content-Type': 'application/json',
-            'Accept-Charset': 'UTF-8'
-        })
-    elif operation == "delete":
-        request_url = f"{urljoin(parent_dir.url, url_for('api.update_type_aggregation'))}?{urljoin(request_body)}"
-        response = requests.delete(request_url)
+    try:
+        if operation == "add":
+            request_url = urljoin(routing_table.get_url(parent_dir), url_for(
+                'api.update_type_aggregation'))
+            request_body["count_delta"] = count_delta
+            response = peer_post(request_url, data=json.dumps(request_body), headers=HEADERS)
+        elif operation == "delete":
+            request_url = f"{urljoin(routing_table.get_url(parent_dir), url_for('api.update_type_aggregation'))}?{urlencode(request_body, doseq=True)}"
+            response = peer_delete(request_url)
+    except requests.RequestException:
+        return False
 
     return response and response.status_code == 200
 
 
+def parent_count_deltas(count_deltas: dict, location: str) -> bool:
+    """Send the changes of the number of things registered at `location` to parent's directory, in one request
+
+    Args:
+        count_deltas(dict): mapping from type to the change of its count
+        location(str): the directory name where the things are registered
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+
+    request_url = urljoin(routing_table.get_url(parent_dir), url_for('api.update_type_aggregation'))
+    try:
+        response = peer_post(request_url, data=json.dumps({"location": location, "count_deltas": count_deltas}),
+                             headers=HEADERS)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def expand_spatial_summary(directory_name: str, bbox: list) -> bool:
+    """Expand the spatial summary of `directory_name` to cover `bbox`, and report to parent if the subtree box grows.
+
+    The summary of the current directory covers itself and all of its descendants, so it is expanded together with
+    any child summary. Summaries only grow, which keeps them a conservative bound for distance-based pruning.
+
+    Args:
+        directory_name (str): the current directory name or the name of a direct child
+        bbox (list): a [lng, lat] point or a [min_lng, min_lat, max_lng, max_lat] bounding box to be covered
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    local_server_name = app.config['HOST_NAME']
+    names = {directory_name, local_server_name}
+    local_grown = False
+    for name in names:
+        summary = SpatialSummary.objects(directory_name=name).first()
+        if summary is None:
+            summary = SpatialSummary(directory_name=name, bbox=[])
+        new_bbox = expand_bbox(summary.bbox, bbox)
+        if new_bbox == summary.bbox:
+            continue
+        summary.bbox = new_bbox
+        summary.save()
+        if name == local_server_name:
+            local_grown = True
+
+    if not local_grown:
+        return True
+    return parent_spatial_summary(SpatialSummary.objects(directory_name=local_server_name).first().bbox,
+                                  local_server_name)
+
+
+def parent_spatial_summary(bbox: list, location: str) -> bool:
+    """Send a post request to parent's directory to expand the spatial summary of `location`.
+
+    Args:
+        bbox (list): the bounding box of all geo-located things under `location`
+        location (str): the directory name whose summary should be updated in the parent directory
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+
+    request_url = urljoin(routing_table.get_url(parent_dir), url_for('api.update_spatial_summary'))
+    try:
+        response = peer_post(request_url, data=json.dumps({"location": location, "bbox": bbox}), headers=HEADERS)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
 def get_children_result(thing_type: str, api: str, query_string: str) -> list:
     """Get thing descriptions from all children directories and return the result
 
@@ -139,34 +445,40 @@ def get_children_result(thing_type: str, api: str, query_string: str) -> list:
     Returns:
         list: the list of thing descriptions that meet the filter condition. Each thing description is a dict object.
     """
-    children_directories = DirectoryNameToURL.objects(
-        relationship='child').all()
+    children_directories = routing_table.get_children()
     # Get children names that contains only the 'thing_type' according to the aggregation stats
     descendant_names_with_type = TypeToChildrenNames.objects(thing_type=thing_type).first() \
         if thing_type is not None else TypeToChildrenNames.objects.first()
-    descendant_to_child_mappings = TargetToChildName.objects().all()
     # Send request to each child node that has thing descriptions with this [thing_type] and get result as a list
     result_list = []
+    requested = set()
     if children_directories and descendant_names_with_type:
-        child_name_to_url_map = {
-            child_directory.directory_name: child_directory.url for child_directory in children_directories
-        }
-        if descendant_to_child_mappings:
-            for mapping in descendant_to_child_mappings:
-                child_name_to_url_map[mapping.target_name] = child_name_to_url_map[mapping.child_name]
-
-        for descendant_directory_name in descendant_names_with_type.children_names:
-            child_url = child_name_to_url_map[descendant_directory_name]
-            para_dict = dict(k.split('=') for k in query_string.split('&'))
+        # ask the largest subtrees first, according to the counts reported by the descendants
+        children_counts = descendant_names_with_type.children_counts or {}
+        descendant_names = sorted(descendant_names_with_type.children_names,
+                                  key=lambda name: -children_counts.get(name, 0))
+        for descendant_directory_name in descendant_names:
+            child_name = routing_table.get_child_name(descendant_directory_name)
+            if child_name is None:
+                continue
+            para_dict = dict(parse_qsl(query_string, keep_blank_values=True))
             if 'location' in para_dict.keys():
                 # tmpstr = query_string.split('&', 1)[1]
                 # new_query_string = f"location={descendant_directory_name}&{tmpstr}"
                 para_dict['location'] = descendant_directory_name
                 new_query_string = urlencode(para_dict)
-                request_url = f"{urljoin(child_url, api)}?{new_query_string}"
             else:
-                request_url = f"{urljoin(child_url, api)}?{query_string}"
-            response = requests.get(request_url)
+                new_query_string = query_string
+            # several descendants may be reached through the same child, only send each request once
+            if (child_name, new_query_string) in requested:
+                continue
+            requested.add((child_name, new_query_string))
+            request_url = f"{urljoin(routing_table.get_child_url(child_name), api)}?{new_query_string}"
+            # a child whose circuit is open is skipped immediately, and the result is marked as partial
+            try:
+                response = peer_get(request_url, timeout=get_long_timeout())
+            except requests.RequestException:
+                continue
             if response.status_code != 200:
                 continue
             child_result = response.json()
@@ -0,0 +1,136 @@
+import threading
+
+from ..models import TypeCounter, TypeToChildrenNames
+
+# set once the counters were recounted from the stored thing descriptions by this process, before that they may miss
+# the things stored while they were not maintained
+_recounted = threading.Event()
+
+
+def mark_counters_recounted():
+    """Record that the counters match the stored thing descriptions, see `reconciliation.recount_local_types`
+    """
+    _recounted.set()
+
+
+def are_counters_recounted() -> bool:
+    """Check whether the counters can answer counts instead of counting the thing descriptions
+    """
+    return _recounted.is_set()
+
+
+def increase_type_count(thing_type, directory_name, delta=1):
+    """Atomically add `delta` to the number of things of `thing_type` stored locally on behalf of `directory_name`
+
+    Args:
+        thing_type (str): the type of the things
+        directory_name (str): current directory name for things registered here, or the name of the child directory
+            that pushed the copies up
+        delta (int): the number to add, negative when things are deleted
+    """
+    if not delta:
+        return
+    TypeCounter.objects(thing_type=thing_type, directory_name=directory_name).update_one(
+        inc__count=delta, upsert=True)
+
+
+def increase_type_counts(deltas):
+    """Apply a batch of counter changes
+
+    Args:
+        deltas (dict): mapping from (thing_type, directory_name) to the number to add
+    """
+    for (thing_type, directory_name), delta in deltas.items():
+        increase_type_count(thing_type, directory_name, delta)
+
+
+def get_local_type_count(thing_type):
+    """Get the number of things of `thing_type` stored locally, including pushed-up copies
+    """
+    return sum(counter.count for counter in TypeCounter.objects(thing_type=thing_type))
+
+
+def get_type_counts(thing_type=None):
+    """Get the local type cardinalities
+
+    Args:
+        thing_type (str): optional, only return the counters of this type
+    Returns:
+        dict: mapping from type to its total count and its count per directory name, e.g.
+            {"bus": {"total": 3, "by_directory": {"level2a": 2, "level3aa": 1}}}
+    """
+    counters = TypeCounter.objects(thing_type=thing_type) if thing_type else TypeCounter.objects.all()
+    type_counts = {}
+    for counter in counters:
+        type_count = type_counts.setdefault(counter.thing_type, {"total": 0, "by_directory": {}})
+        type_count["total"] += counter.count
+        type_count["by_directory"][counter.directory_name] = counter.count
+    return type_counts
+
+
+def increase_children_count(thing_type, directory_name, delta=0):
+    """Record that the descendant `directory_name` holds things of `thing_type`, and add `delta` to its count
+
+    A negative delta only decreases the count, the descendant is removed from the aggregation data by the
+    'delete' aggregation update once it holds no thing of this type.
+
+    Args:
+        thing_type (str): the type of the things
+        directory_name (str): the descendant directory name
+        delta (int): the change of the number of things registered at the descendant
+    """
+    collection = TypeToChildrenNames._get_collection()
+    if delta < 0:
+        collection.update_one({'type': thing_type, 'childLocs': directory_name},
+                              {'$inc': {f'childCounts.{directory_name}': delta}})
+        return
+    update = {'$addToSet': {'childLocs': directory_name}}
+    if delta > 0:
+        update['$inc'] = {f'childCounts.{directory_name}': delta}
+    collection.update_one({'type': thing_type}, update, upsert=True)
+
+
+def remove_children_counts(thing_types, directory_names):
+    """Remove descendants from the aggregation data of the given types, or of all types if `thing_types` is None
+    """
+    query = {'childLocs': {'$in': directory_names}}
+    if thing_types is not None:
+        query['type'] = {'$in': thing_types}
+    TypeToChildrenNames._get_collection().update_many(query, {
+        '$pullAll': {'childLocs': directory_names},
+        '$unset': {f'childCounts.{directory_name}': '' for directory_name in directory_names}
+    })
+
+
+def get_subtree_type_counts(directory_name, thing_type=None):
+    """Get the number of things of each type registered in the subtree of the current directory
+
+    The count of the current directory comes from its own counters, and the counts of the descendants from the
+    aggregation data, so no descendant is requested. Pushed-up copies are not counted twice.
+
+    Args:
+        directory_name (str): current directory name
+        thing_type (str): optional, only return the count of this type
+
+    Returns:
+        dict: mapping from type to its total count and its count per directory name, e.g.
+            {"bus": {"total": 3, "by_directory": {"level2a": 2, "level3aa": 1}}}
+    """
+    counters = TypeCounter.objects(thing_type=thing_type, directory_name=directory_name) if thing_type \
+        else TypeCounter.objects(directory_name=directory_name)
+    aggregations = TypeToChildrenNames.objects(thing_type=thing_type) if thing_type \
+        else TypeToChildrenNames.objects.all()
+    type_counts = {}
+    for counter in counters:
+        if counter.count > 0:
+            type_counts[counter.thing_type] = {"total": counter.count, "by_directory": {directory_name: counter.count}}
+    for aggregation in aggregations:
+        for descendant_name, count in (aggregation.children_counts or {}).items():
+            if count <= 0:
+                continue
+            type_count = type_counts.setdefault(aggregation.thing_type, {"total": 0, "by_directory": {}})
+            type_count["total"] += count
+            type_count["by_directory"][descendant_name] = count
+    if thing_type and thing_type not in type_counts:
+        type_counts[thing_type] = {"total": 0, "by_directory": {}}
+    return type_counts
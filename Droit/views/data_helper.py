@@ -1,4 +1,7 @@
+import json
+
 import requests
+from bson import json_util
 
 
 def deduplicate_by_id(thing_list):
@@ -18,6 +21,62 @@ def deduplicate_by_id(thing_list):
     return unique_thing_list
 
 
+def pop_lease_expires(thing_description):
+    """Remove and return the lease expiration carried by a serialized thing description, e.g. during a relocation
+
+    Args:
+        thing_description (dict): the thing description in the JSON format of `to_json`
+
+    Returns:
+        datetime: the expiration time of the lease, or None if the thing description has no lease
+    """
+    lease_expires = thing_description.pop("lease_expires", None)
+    if lease_expires is None:
+        return None
+    return json_util.loads(json.dumps(lease_expires))
+
+
+def get_filter_map(filters):
+    """Translate the filter conditions of a request into mongoengine query keyword arguments
+
+    Args:
+        filters (dict): filter conditions. The "polygon" key is a geographical filter on the thing's coordinates,
+            any other key is a dot-separated property path that must be equal to the given value
+    Returns:
+        dict: keyword arguments that can be passed to `ThingDescription.objects`
+    """
+    filters = dict(filters)
+    filter_map = {}
+    # add geographical filter condition
+    if "polygon" in filters and type(filters["polygon"]) == list and len(filters["polygon"]) >= 3:
+        # properties__geo__coordinates represents field properties.geo.coordinates
+        # geo_within_polygon: query string for geospatial query
+        filter_map["properties__geo__coordinates__geo_within_polygon"] = filters.pop("polygon")
+        # An example of mongodb query is: db.td.find({ "properties.geo.coordinates": { $geoWithin: {$polygon: [[-75,40],[-75,41],[-70,41],[-70,40]]}}})
+
+    for filter_name in filters:
+        filter_map[filter_name.replace(".", "__")] = filters[filter_name]
+    return filter_map
+
+
+def get_selection_map(thing_ids, filters):
+    """Translate the selection of a bulk operation, a list of ids and filter conditions, into query keyword arguments
+
+    Args:
+        thing_ids (list): optional, the ids of the selected thing descriptions
+        filters (dict): optional, the filter conditions of the selected thing descriptions, see `get_filter_map`
+    Returns:
+        dict: keyword arguments that can be passed to `ThingDescription.objects`, or None if neither a non-empty list
+            of ids nor a filter condition is given, since such a selection would match every thing description
+    """
+    filter_map = get_filter_map(filters) if filters else {}
+    if not thing_ids and not filter_map:
+        return None
+    if thing_ids is not None:
+        filter_map["thing_id__in"] = thing_ids
+    return filter_map
+
+
 def get_time_range_data(all_data, time_range_start, time_range_end):
     '''Get the time range specification
 
@@ -1,5 +1,6 @@
 import datetime
 
+from ..decision_cache import decision_cache
 from ..models import ThingFrequency
 
 
@@ -11,3 +12,5 @@ def add_frequency(thing_id, user_id):
         thing_obj.timestamps[user_id] = []
     thing_obj.timestamps[user_id].append(datetime.datetime.utcnow())
     thing_obj.save()
+    # the decisions counting the accesses of this user to the thing may change
+    decision_cache.invalidate_access(user_id, thing_id)
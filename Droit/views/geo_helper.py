@@ -0,0 +1,165 @@
+import math
+
+# Earth radius in meters, the same value used by MongoDB for spherical 2dsphere queries
+EARTH_RADIUS = 6378100.0
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_MAX_PRECISION = 12
+
+
+def get_coordinates(thing_description):
+    """Get the [lng, lat] pair stored at `properties.geo.coordinates` of a thing description
+
+    Args:
+        thing_description (dict): the thing description
+    Returns:
+        list: the [lng, lat] pair, or None if the thing description is not geo-located
+    """
+    try:
+        lng, lat = thing_description["properties"]["geo"]["coordinates"]
+        return [float(lng), float(lat)]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def expand_bbox(bbox, other):
+    """Get the smallest bounding box covering both `bbox` and `other`
+
+    Args:
+        bbox (list): [min_lng, min_lat, max_lng, max_lat], or None if empty
+        other (list): another bounding box, or a single [lng, lat] point
+    Returns:
+        list: the merged bounding box
+    """
+    if len(other) == 2:
+        other = [other[0], other[1], other[0], other[1]]
+    if not bbox:
+        return list(other)
+    return [min(bbox[0], other[0]), min(bbox[1], other[1]), max(bbox[2], other[2]), max(bbox[3], other[3])]
+
+
+def haversine_distance(point_a, point_b):
+    """Get the great-circle distance in meters between two [lng, lat] points
+    """
+    lng_a, lat_a = map(math.radians, point_a)
+    lng_b, lat_b = map(math.radians, point_b)
+    h = math.sin((lat_b - lat_a) / 2) ** 2 + \
+        math.cos(lat_a) * math.cos(lat_b) * math.sin((lng_b - lng_a) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def min_distance_to_bbox(point, bbox):
+    """Get the smallest possible distance in meters between `point` and any point inside `bbox`
+
+    The closest point on the parallel edges shares the longitude of `point` when it is in range, and the closest
+    point on the meridian edges is found by projecting `point` onto the great circle of the meridian.
+    Corners are always candidates, so the result is a lower bound that can be safely used for pruning.
+
+    Args:
+        point (list): [lng, lat] of the query point
+        bbox (list): [min_lng, min_lat, max_lng, max_lat]
+    Returns:
+        float: 0 if the point is inside the box, otherwise the distance to the closest edge
+    """
+    lng, lat = point
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if min_lng <= lng <= max_lng and min_lat <= lat <= max_lat:
+        return 0.0
+
+    candidates = [[min_lng, min_lat], [min_lng, max_lat], [max_lng, min_lat], [max_lng, max_lat]]
+    if min_lng <= lng <= max_lng:
+        candidates.append([lng, min_lat])
+        candidates.append([lng, max_lat])
+    for edge_lng in (min_lng, max_lng):
+        delta = math.radians(lng - edge_lng)
+        if math.cos(delta) > 0:
+            edge_lat = math.degrees(math.atan(math.tan(math.radians(lat)) / math.cos(delta)))
+            candidates.append([edge_lng, min(max(edge_lat, min_lat), max_lat)])
+
+    return min(haversine_distance(point, candidate) for candidate in candidates)
+
+
+def merge_nearest(best_list, new_list, k):
+    """Merge two lists of thing descriptions carrying a `_distance` field, keeping the k nearest distinct things
+
+    Args:
+        best_list (list): current best thing descriptions, sorted by `_distance`
+        new_list (list): thing descriptions to be merged
+        k (int): the number of thing descriptions to keep
+    Returns:
+        list: at most k thing descriptions deduplicated by 'thing_id' and sorted by `_distance`
+    """
+    nearest_by_id = {thing["thing_id"]: thing for thing in best_list}
+    for thing in new_list:
+        current = nearest_by_id.get(thing["thing_id"])
+        if current is None or thing["_distance"] < current["_distance"]:
+            nearest_by_id[thing["thing_id"]] = thing
+    return sorted(nearest_by_id.values(), key=lambda item: item["_distance"])[:k]
+
+
+def encode_geohash(lng, lat, precision):
+    """Encode a [lng, lat] point to a geohash string
+
+    Args:
+        lng (float): longitude of the point
+        lat (float): latitude of the point
+        precision (int): the number of characters of the geohash
+    Returns:
+        str: the geohash of the cell containing the point
+    """
+    lng_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    # bits alternate between longitude and latitude, starting from longitude
+    is_lng = True
+    while len(geohash) < precision:
+        value, value_range = (lng, lng_range) if is_lng else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        is_lng = not is_lng
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def count_by_geohash(things_obj, precision):
+    """Count geo-located things per geohash cell
+
+    Things sharing the same coordinates are first grouped by MongoDB, so only one small document per distinct
+    position leaves the database.
+
+    Args:
+        things_obj (QuerySet): the mongoengine query set of thing descriptions to be counted
+        precision (int): the geohash precision of the cells
+    Returns:
+        dict: sparse mapping from geohash cell to the number of things in it
+    """
+    heat_map = {}
+    for group in things_obj.aggregate({"$group": {"_id": "$properties.geo.coordinates", "count": {"$sum": 1}}}):
+        coordinates = group["_id"]
+        if not isinstance(coordinates, list) or len(coordinates) != 2:
+            continue
+        cell = encode_geohash(float(coordinates[0]), float(coordinates[1]), precision)
+        heat_map[cell] = heat_map.get(cell, 0) + group["count"]
+    return heat_map
+
+
+def merge_heat_maps(heat_maps):
+    """Merge sparse geohash cell-to-count mappings by summing the counts of the same cell
+    """
+    merged = {}
+    for heat_map in heat_maps:
+        if not isinstance(heat_map, dict):
+            continue
+        for cell, count in heat_map.items():
+            merged[cell] = merged.get(cell, 0) + count
+    return merged
@@ -0,0 +1,68 @@
+import datetime
+
+from .broadcast import delete_local_thing_descriptions
+from ..models import ThingDescription
+from ..tasks import start_periodic_task
+
+
+def get_lease_expires(lease):
+    """Get the expiration time of a lease of `lease` seconds starting now, or None if `lease` is not set
+
+    Raises:
+        ValueError: if `lease` is not a positive number
+    """
+    if lease is None:
+        return None
+    lease = float(lease)
+    if not lease > 0:
+        raise ValueError(f"lease must be a positive number of seconds, got {lease}")
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=lease)
+
+
+def renew_leases(thing_ids, lease):
+    """Renew the leases of many things registered in local directory with one update
+
+    Args:
+        thing_ids (list): ids of the things to renew
+        lease (float): the new lease duration in seconds, starting now
+
+    Returns:
+        int: the number of renewed things
+
+    Raises:
+        ValueError: if `lease` is not a positive number
+    """
+    if lease is None:
+        raise ValueError("lease is required to renew leases")
+    return ThingDescription.objects(thing_id__in=thing_ids, pushed_from=None).update(
+        set__lease_expires=get_lease_expires(lease))
+
+
+def expire_leases(batch_size=500):
+    """Delete all things whose lease has expired, in batches
+
+    The deletion is the same as the bulk delete API, so pushed-up copies and the parent's aggregation data are cleaned
+    up with one request per batch.
+
+    Args:
+        batch_size (int): the maximal number of things deleted in each batch
+
+    Returns:
+        int: the number of expired things
+    """
+    expired_count = 0
+    while True:
+        expired_ids = [thing.thing_id for thing in ThingDescription.objects(
+            lease_expires__lt=datetime.datetime.utcnow()).only('thing_id').limit(batch_size)]
+        if not expired_ids:
+            return expired_count
+        expired_count += delete_local_thing_descriptions(ThingDescription.objects(thing_id__in=expired_ids))
+
+
+def start_lease_reaper(app):
+    """Periodically expire leases in the background, every `LEASE_REAP_INTERVAL` seconds (30 by default)
+
+    The reaper is the only deleter of expired things and runs on one instance of the directory at a time.
+    """
+    return start_periodic_task(app, "lease-reaper", app.config.get('LEASE_REAP_INTERVAL', 30), expire_leases,
+                               singleton=True)
@@ -0,0 +1,130 @@
+"""
+Inheritance of the policies of the ancestor directories.
+
+Policies stored at a directory apply to the things of all its descendants. Every directory keeps in memory the merged
+policy set it inherits, with its version, and periodically sends that version to its parent. Only when the parent's
+merged policy set, its own policies and the ones it inherits, has another version, the parent sends the policies.
+The inherited policies are merged with the policies of the directory's own location, so decisions stay local.
+
+The pulled policy set is persisted, so the instances of a directory share it and a restarted directory knows it
+before its parent answers. A directory with a parent denies every access until it knows its inherited policies, and
+it keeps them while its parent is unreachable.
+"""
+import json
+from datetime import datetime
+from urllib.parse import urljoin
+
+import requests
+from flask import current_app as app
+from flask import url_for
+from py_abac import Policy
+
+from ..decision_cache import decision_cache
+from ..models import InheritedPolicySet
+from ..peers import peer_get
+from ..policy_helper import policy_cache, get_policy_digest
+from ..routing import routing_table
+from ..tasks import start_periodic_task
+
+
+def get_policy_set_json(location: str, version: str = None) -> dict:
+    """Get the merged policy set of a location with its version
+
+    Args:
+        location (str): the location of the policies
+        version (str): the version the caller holds, the policies are omitted if it is the current version
+
+    Returns:
+        dict: {"location", "version", "changed", "policies"} where the policies are in JSON format
+    """
+    policy_set = policy_cache.get_policies(location)
+    current_version = policy_set.get_derived('digest', get_policy_digest)
+    if current_version == version:
+        return {"location": location, "version": current_version, "changed": False}
+    return {"location": location, "version": current_version, "changed": True,
+            "policies": [policy.to_json() for policy in policy_set.get_all(len(policy_set), 0)]}
+
+
+def set_inherited_policies(version: str, policies: list):
+    """Replace the policies current directory inherits, and drop the decisions made with the previous ones
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    policy_cache.set_inherited(local_server_name, version, policies)
+    decision_cache.invalidate_location(local_server_name)
+
+
+def load_persisted_policies() -> bool:
+    """Set the inherited policies persisted by the last pull of any instance of current directory, if their version
+    differs from the inherited one
+
+    Returns:
+        bool: True if the inherited policies changed
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if routing_table.get_parent() is not None:
+        policy_cache.require_inherited(local_server_name)
+    persisted = InheritedPolicySet.objects(directory_name=local_server_name).first()
+    if persisted is None or (policy_cache.is_inherited_loaded(local_server_name) and
+                             persisted.version == policy_cache.get_inherited(local_server_name)[0]):
+        return False
+    set_inherited_policies(persisted.version,
+                           [Policy.from_json(policy_json) for policy_json in json.loads(persisted.policies)])
+    return True
+
+
+def pull_inherited_policies() -> bool:
+    """Pull the merged policy set of the parent directory when its version differs from the inherited one, and
+    persist it for the next start and the other instances
+
+    Returns:
+        bool: True if the inherited policies changed
+    """
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        # the root directory inherits nothing. A directory whose parent is unknown for a moment, e.g. while the
+        # routing table is rewritten, keeps the policies it inherited
+        return False
+    policy_cache.require_inherited(local_server_name)
+    version = policy_cache.get_inherited(local_server_name)[0] \
+        if policy_cache.is_inherited_loaded(local_server_name) else None
+
+    request_url = urljoin(routing_table.get_url(parent_dir), url_for('api.policy_set'))
+    try:
+        response = peer_get(request_url, params={"location": parent_dir.directory_name, "version": version or ""})
+    except requests.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    body = response.json()
+    if not body.get("changed") or body.get("version") == version:
+        return False
+    InheritedPolicySet.objects(directory_name=local_server_name).update_one(
+        set__parent_name=parent_dir.directory_name, set__version=body["version"],
+        set__policies=json.dumps(body["policies"]), set__updated_at=datetime.utcnow(), upsert=True)
+    set_inherited_policies(body["version"], [Policy.from_json(policy_json) for policy_json in body["policies"]])
+    return True
+
+
+def refresh_inherited_policies() -> bool:
+    """Load the inherited policies persisted by another instance, then pull them from the parent directory
+
+    Returns:
+        bool: True if the inherited policies changed
+    """
+    changed = load_persisted_policies()
+    return pull_inherited_policies() or changed
+
+
+def start_policy_inheritance(app):
+    """Pull the inherited policies before the directory serves, falling back to the persisted ones if the parent does
+    not answer, then check their version in the background every `POLICY_INHERIT_INTERVAL` seconds (30 by default)
+
+    Until the inherited policies are known, a directory with a parent denies every access. In the background, only
+    one instance of the directory pulls from the parent, and every instance loads what it persisted.
+    """
+    with app.test_request_context():
+        refresh_inherited_policies()
+    interval = app.config.get('POLICY_INHERIT_INTERVAL', 30)
+    start_periodic_task(app, "policy_inheritance_load", interval, load_persisted_policies)
+    return start_periodic_task(app, "policy_inheritance", interval, pull_inherited_policies, singleton=True)
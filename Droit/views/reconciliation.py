@@ -0,0 +1,196 @@
+"""
+Anti-entropy reconciliation of the aggregation data between a directory and its parent.
+
+Aggregation updates are sent once and their failures are ignored, so the index of the parent may drift from the
+things actually held in the subtree of a child. Periodically, every directory first recounts its own things, then
+sends the parent a digest of the aggregation data the parent should hold for its subtree. Only when the digest
+differs from the parent's copy, the full data is sent and the parent repairs its index in bulk.
+"""
+import hashlib
+import json
+from urllib.parse import urljoin
+
+import requests
+from flask import current_app as app
+from flask import url_for
+from pymongo import UpdateOne, DeleteOne
+
+from .broadcast import parent_spatial_summary
+from .counter import mark_counters_recounted
+from ..models import ThingDescription, TypeCounter, TypeToChildrenNames, SpatialSummary
+from ..peers import peer_post, HEADERS
+from ..routing import routing_table
+from ..tasks import start_periodic_task
+
+
+
+def recount_local_types() -> int:
+    """Recompute the type counters from the thing descriptions stored locally, and repair the drifted counters
+
+    The counters are read before the things are counted, and each repair only applies if the counter still holds
+    the value it was compared with: the difference is added with `$inc`, a new counter is only inserted if it is
+    still missing, and an empty counter is only deleted if it is still empty. A counter changed by a concurrent
+    registration or deletion is left as is, and is compared again in the next round.
+
+    Returns:
+        int: the number of counters that were changed
+    """
+    local_server_name = app.config['HOST_NAME']
+    counters = list(TypeCounter._get_collection().find({}, {'type': 1, 'loc': 1, 'count': 1}))
+    actual_counts = {}
+    for group in ThingDescription._get_collection().aggregate([
+            {'$group': {'_id': {'type': '$thing_type', 'from': '$pushed_from'}, 'count': {'$sum': 1}}}]):
+        key = (group['_id'].get('type'), group['_id'].get('from') or local_server_name)
+        actual_counts[key] = actual_counts.get(key, 0) + group['count']
+
+    operations = []
+    for counter in counters:
+        count = actual_counts.pop((counter.get('type'), counter.get('loc')), 0)
+        if count == 0:
+            operations.append(DeleteOne({'_id': counter['_id'], 'count': counter.get('count')}))
+        elif counter.get('count') != count:
+            operations.append(UpdateOne({'_id': counter['_id'], 'count': counter.get('count')},
+                                        {'$inc': {'count': count - (counter.get('count') or 0)}}))
+    for (thing_type, directory_name), count in actual_counts.items():
+        operations.append(UpdateOne({'type': thing_type, 'loc': directory_name}, {'$setOnInsert': {'count': count}},
+                                    upsert=True))
+    changed_count = 0
+    if operations:
+        result = TypeCounter._get_collection().bulk_write(operations, ordered=False)
+        changed_count = result.modified_count + result.upserted_count + result.deleted_count
+    mark_counters_recounted()
+    return changed_count
+
+
+def get_subtree_aggregation() -> dict:
+    """Get the aggregation data the parent should hold for the subtree of current directory
+
+    Current directory is listed for every type it holds, with the number of things registered here, and each
+    descendant is listed with the count reported by it.
+
+    Returns:
+        dict: mapping from type to a mapping from directory name to count, e.g. {"bus": {"level3aa": 2}}
+    """
+    local_server_name = app.config['HOST_NAME']
+    aggregation = {}
+    for counter in TypeCounter.objects.all():
+        if counter.count <= 0:
+            continue
+        owned_counts = aggregation.setdefault(counter.thing_type, {})
+        owned_counts.setdefault(local_server_name, 0)
+        if counter.directory_name == local_server_name:
+            owned_counts[local_server_name] += counter.count
+    for children_locations in TypeToChildrenNames.objects.all():
+        if not children_locations.children_names:
+            continue
+        children_counts = children_locations.children_counts or {}
+        type_counts = aggregation.setdefault(children_locations.thing_type, {})
+        for descendant_name in children_locations.children_names:
+            type_counts[descendant_name] = children_counts.get(descendant_name, 0)
+    return aggregation
+
+
+def get_child_aggregation(child_name: str) -> dict:
+    """Get the aggregation data held by current directory for the descendants reached through `child_name`
+
+    Returns:
+        dict: in the same format as `get_subtree_aggregation`
+    """
+    aggregation = {}
+    for children_locations in TypeToChildrenNames.objects.all():
+        children_counts = children_locations.children_counts or {}
+        for descendant_name in children_locations.children_names:
+            if routing_table.get_child_name(descendant_name) == child_name:
+                aggregation.setdefault(children_locations.thing_type, {})[descendant_name] = \
+                    children_counts.get(descendant_name, 0)
+    return aggregation
+
+
+def get_digest(aggregation: dict) -> str:
+    """Get a compact digest of aggregation data, independent of the order of types and directory names
+    """
+    return hashlib.sha1(json.dumps(aggregation, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def repair_child_aggregation(child_name: str, aggregation: dict) -> int:
+    """Replace the aggregation data held for the descendants reached through `child_name` with `aggregation`
+
+    Only the differences are written, with one bulk write.
+
+    Args:
+        child_name (str): the name of the child directory
+        aggregation (dict): the aggregation data sent by the child, see `get_subtree_aggregation`
+
+    Returns:
+        int: the number of types whose aggregation data was changed
+    """
+    current = get_child_aggregation(child_name)
+    operations = []
+    for thing_type in set(current) | set(aggregation):
+        current_counts = current.get(thing_type, {})
+        actual_counts = aggregation.get(thing_type, {})
+        stale_names = [name for name in current_counts if name not in actual_counts]
+        changed_counts = {name: count for name, count in actual_counts.items() if current_counts.get(name) != count}
+        if stale_names:
+            operations.append(UpdateOne({'type': thing_type}, {
+                '$pullAll': {'childLocs': stale_names},
+                '$unset': {f'childCounts.{name}': '' for name in stale_names}
+            }))
+        if changed_counts:
+            operations.append(UpdateOne({'type': thing_type}, {
+                '$addToSet': {'childLocs': {'$each': list(changed_counts)}},
+                '$set': {f'childCounts.{name}': count for name, count in changed_counts.items()}
+            }, upsert=True))
+    if operations:
+        TypeToChildrenNames._get_collection().bulk_write(operations, ordered=True)
+    return len(operations)
+
+
+def reconcile_with_parent() -> bool:
+    """Repair the local type counters, then check the parent's aggregation data of current subtree and repair it
+
+    The spatial summary of current subtree is reported to the parent again, in case an earlier report failed.
+
+    Returns:
+        bool: True if the parent's aggregation data matches current subtree, or there is no parent
+    """
+    # 1. recount the local things
+    recount_local_types()
+    parent_dir = routing_table.get_parent()
+    if parent_dir is None:
+        return True
+    summary = SpatialSummary.objects(directory_name=app.config['HOST_NAME']).first()
+    if summary is not None and summary.bbox:
+        parent_spatial_summary(summary.bbox, app.config['HOST_NAME'])
+
+    # 2. send the digest only
+    aggregation = get_subtree_aggregation()
+    request_url = urljoin(routing_table.get_url(parent_dir), url_for('api.reconcile_aggregate'))
+    request_body = {"location": app.config['HOST_NAME'], "digest": get_digest(aggregation)}
+    try:
+        response = peer_post(request_url, data=json.dumps(request_body), headers=HEADERS)
+    except requests.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    if response.json().get("match"):
+        return True
+
+    # 3. on mismatch, send the full aggregation data
+    request_body["aggregation"] = aggregation
+    try:
+        response = peer_post(request_url, data=json.dumps(request_body), headers=HEADERS)
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def start_reconciler(app):
+    """Recount the local types once before the directory serves, then periodically reconcile the aggregation data
+    with the parent in the background, every `RECONCILE_INTERVAL` seconds (60 by default), on one instance of the
+    directory at a time
+    """
+    with app.app_context():
+        recount_local_types()
+    return start_periodic_task(app, "reconciler", app.config.get('RECONCILE_INTERVAL', 60), reconcile_with_parent,
+                               singleton=True)
@@ -0,0 +1,98 @@
+import json
+import time
+import uuid
+
+import requests
+from flask import url_for
+
+from .broadcast import delete_local_thing_descriptions
+from ..models import ThingDescription, RelocationJob
+from ..peers import peer_post, get_long_timeout, HEADERS
+from ..routing import routing_table
+from ..utils import get_target_url
+
+
+def create_relocation_job(from_location: str, to_location: str, things_obj, batch_size: int) -> RelocationJob:
+    """Record the ids of all things to be relocated in a new relocation journal
+
+    Only the things registered in current directory are relocated, pushed-up copies follow their original thing.
+
+    Args:
+        from_location (str): current directory name
+        to_location (str): the directory the things are moved to
+        things_obj (QuerySet): the mongoengine query set of thing descriptions to be relocated
+        batch_size (int): the number of thing descriptions sent to the destination in each request
+
+    Returns:
+        RelocationJob: the saved relocation journal
+    """
+    pending_ids = [thing.thing_id for thing in things_obj.filter(pushed_from=None).only('thing_id')]
+    job = RelocationJob(job_id=str(uuid.uuid4()), from_location=from_location, to_location=to_location,
+                        batch_size=batch_size, pending_ids=pending_ids)
+    job.save()
+    return job
+
+
+def is_parent(directory_name: str) -> bool:
+    """Check whether `directory_name` is the parent of the current directory
+    """
+    parent_directory = routing_table.get_parent()
+    return parent_directory is not None and parent_directory.directory_name == directory_name
+
+
+def run_relocation_job(job: RelocationJob) -> RelocationJob:
+    """Move the pending things of a relocation journal to its destination batch by batch
+
+    Each batch is registered at the destination first, and only the acknowledged thing descriptions are deleted
+    locally. The journal is updated after the deletion, so after a crash the job can be run again: a batch that
+    is sent twice is acknowledged by the destination again, and ids that no longer exist locally were already moved.
+
+    Args:
+        job (RelocationJob): the relocation journal to run or resume
+
+    Returns:
+        RelocationJob: the updated relocation journal. Its state is 'completed' when no pending id is left,
+            'interrupted' if the destination could not be reached, or 'failed' if the destination is unknown
+    """
+    target_url = get_target_url(job.to_location, url_for('api.bulk_register'))
+    if target_url is None:
+        job.update(set__state='failed')
+        job.reload()
+        return job
+
+    job.update(set__state='running')
+    pending_ids = list(job.pending_ids)
+    while pending_ids:
+        start = time.time()
+        batch_ids = pending_ids[:job.batch_size]
+        things = json.loads(ThingDescription.objects(thing_id__in=batch_ids, pushed_from=None).to_json())
+        failed_ids = []
+        moved_count = 0
+        if things:
+            # 1. insert the batch at the destination
+            try:
+                response = peer_post(target_url, data=json.dumps({"location": job.to_location, "tds": things}),
+                                     headers=HEADERS, timeout=get_long_timeout())
+            except requests.RequestException:
+                response = None
+            if response is None or response.status_code != 200:
+                job.update(set__state='interrupted', inc__elapsed=time.time() - start)
+                job.reload()
+                return job
+            # 2. delete only the acknowledged thing descriptions locally. If the destination is the parent, the
+            # copies it converted into registered things must not be deleted as the copies pushed up from here
+            acknowledged_ids = set(response.json().get("registered", []))
+            keep_up_ids = set(response.json().get("converted", [])) if is_parent(job.to_location) else set()
+            moved_count = delete_local_thing_descriptions(ThingDescription.objects(
+                thing_id__in=[thing["thing_id"] for thing in things if thing["thing_id"] in acknowledged_ids]),
+                keep_up_ids)
+            failed_ids = [thing["thing_id"] for thing in things if thing["thing_id"] not in acknowledged_ids]
+
+        # 3. journal the progress of this batch, only the thing descriptions deleted here are counted as moved
+        job.update(pull_all__pending_ids=batch_ids, push_all__failed_ids=failed_ids,
+                   inc__moved_count=moved_count, inc__elapsed=time.time() - start)
+        pending_ids = pending_ids[len(batch_ids):]
+
+    job.update(set__state='completed')
+    job.reload()
+    return job
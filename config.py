@@ -14,6 +14,38 @@ Set up the configuration for flask environment using classes
 class BaseConfig(object):
     # Used for flask session to generate session id
     SECRET_KEY = os.urandom(128)
+    # Secret shared by all directories of the tree, signing the requests they send on behalf of their users
+    TREE_SECRET = os.environ.get('TREE_SECRET', 'droit-tree-secret')
+    # Seconds a request signed by another directory of the tree is accepted
+    PEER_TOKEN_TTL = 60
+    # Seconds between two runs of the lease reaper that deletes things with expired leases
+    LEASE_REAP_INTERVAL = 30
+    # Seconds to wait for a peer directory to connect and to answer
+    PEER_TIMEOUT = 10
+    # Seconds to wait for a peer directory running a bulk operation or a query fanned out to its subtree
+    PEER_LONG_TIMEOUT = 300
+    # Seconds between two health probes of the peer directories, and the timeout of a probe
+    HEALTH_CHECK_INTERVAL = 10
+    HEALTH_CHECK_TIMEOUT = 2
+    # Consecutive failures opening the circuit of a peer, and seconds before a trial request is allowed again
+    CIRCUIT_FAILURE_THRESHOLD = 3
+    CIRCUIT_RESET_TIMEOUT = 30
+    # Reads slower than this percentile of the recent latencies of an instance are hedged to another instance
+    HEDGE_PERCENTILE = 95
+    # Seconds between two reloads of the routing table, so instances sharing a database see each other's changes
+    ROUTING_REFRESH_INTERVAL = 30
+    # Seconds between two reconciliations of the aggregation data with the parent directory
+    RECONCILE_INTERVAL = 60
+    # Seconds the parsed policies of a location are kept before reloading, they are reloaded at once on changes
+    POLICY_CACHE_TTL = 60
+    # Seconds between two checks of the changes made to the policies by other instances
+    POLICY_VERSION_CHECK_INTERVAL = 1
+    # Seconds a policy decision is cached at most, time-dependent decisions expire earlier
+    DECISION_CACHE_TTL = 60
+    # Seconds between two version checks of the policies inherited from the parent directory
+    POLICY_INHERIT_INTERVAL = 30
+    # Seconds between two flushes of the buffered audit records of the policy decisions
+    AUDIT_FLUSH_INTERVAL = 1
 
     @classmethod
     def to_dict(cls):
@@ -191,6 +223,33 @@ dev_config = {
 }
 
 
+def make_dev_config(name: str, port: int, host: str = 'localhost', mongodb_host: str = 'localhost',
+                    mongodb_port: int = 27017):
+    """
+    Generate the development configuration of a directory that is not listed in `dev_config`, e.g. a directory
+    declared in a topology file or joining the tree at runtime. The database is named after the directory.
+    """
+    return type(f"{name.capitalize()}DevConfig", (DevConfig,), {
+        "HOST_NAME": name,
+        "ENV_NAME": f"{name.capitalize()}-Dev",
+        "PORT": port,
+        "URL": f"http://{host}:{port}",
+        # mongo engine
+        "MONGODB_HOST": mongodb_host,
+        "MONGODB_PORT": mongodb_port,
+        "MONGODB_DB": name,
+        "MONGO_DBNAME": name,
+        # pymongo
+        "MONGO_URI": f"mongodb://{mongodb_host}:{mongodb_port}/{name}",
+        # OAUth2
+        "OAUTH2_JWT_ENABLED": True,
+        "OAUTH2_JWT_ISS": f"http://{host}:{port}/",
+        "OAUTH2_JWT_KEY": f"{name}-secret",
+        "OAUTH2_JWT_ALG": 'HS256',
+        "OAUTH2_JWT_EXP": 3600
+    })
+
+
 class DepConfig(BaseConfig):
     # Deployment Environment Configurations
     ENV_NAME = "Deployment"
@@ -0,0 +1,125 @@
+'''
+This program benchmarks the compiled policies against the py_abac interpreter
+
+Random policies on the email of the subject, the type and id of the thing and the action are decided for random
+access requests by the py_abac PDP, by the compiled policies, and by the compiled candidate policies from the
+target index. All attributes are in the access requests, so no attribute provider is used.
+'''
+import os
+import random
+import sys
+import time
+
+import click
+from py_abac import PDP, Policy, AccessRequest
+from py_abac.pdp import EvaluationAlgorithm
+from py_abac.storage.memory import MemoryStorage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Droit.policy_compiler import CompiledPolicies  # noqa: E402
+from Droit.policy_helper import PolicySet  # noqa: E402
+
+typeList = ["file", "light", "thermometer", "bus"]
+actionList = ["get", "delete", "create"]
+domainList = ["example.com", "uci.edu", "test.org"]
+
+
+def generatePolicy(index, num_thing):
+    """
+    generate a random policy in JSON format
+    """
+    resource_rules = {"$.thing_type": {"condition": "Equals", "value": random.choice(typeList)}}
+    if random.random() < 0.5:
+        resource_rules["id"] = {"condition": "RegexMatch", "value": ".*"}
+    targets = {}
+    if random.random() < 0.5:
+        targets["resource_id"] = "urn:dev:wot:com:example:servient:" + str(random.randint(1, num_thing))
+    return {
+        "uid": str(index),
+        "description": "benchmark policy " + str(index),
+        "effect": random.choice(["allow", "deny"]),
+        "rules": {
+            "subject": {"$.email": {"condition": "RegexMatch", "value": ".*@" + random.choice(domainList)}},
+            "resource": resource_rules,
+            "action": [{"$.method": {"condition": "Equals", "value": action}}
+                       for action in random.sample(actionList, 2)],
+            "context": {}
+        },
+        "targets": targets,
+        "priority": random.randint(0, 10)
+    }
+
+
+def generateRequest(index, num_thing):
+    """
+    generate a random access request in JSON format
+    """
+    return {
+        "subject": {
+            "id": str(index),
+            "attributes": {"email": "user" + str(index) + "@" + random.choice(domainList)}
+        },
+        "resource": {
+            "id": "urn:dev:wot:com:example:servient:" + str(random.randint(1, num_thing)),
+            "attributes": {"thing_type": random.choice(typeList)}
+        },
+        "action": {
+            "id": "",
+            "attributes": {"method": random.choice(actionList)}
+        },
+        "context": {
+        }
+    }
+
+
+def timeDecisions(decide, requests):
+    """
+    decide all requests, return the decisions and the average time of a decision
+    """
+    start_time = time.time()
+    decisions = [decide(request) for request in requests]
+    end_time = time.time()
+    return decisions, (end_time - start_time) / len(requests)
+
+
+@click.command()
+@click.option('--num_policy', default=200, type=int, help="number of random policies, by default is 200")
+@click.option('--num_request', default=1000, type=int, help="number of random access requests, by default is 1000")
+@click.option('--num_thing', default=100, type=int, help="number of distinct thing ids, by default is 100")
+@click.option('--seed', default=0, type=int, help="seed of the random generator, by default is 0")
+def main(num_policy, num_request, num_thing, seed):
+    random.seed(seed)
+    policies = [Policy.from_json(generatePolicy(i, num_thing)) for i in range(num_policy)]
+    requests = [generateRequest(i, num_thing) for i in range(num_request)]
+
+    storage = MemoryStorage()
+    for policy in policies:
+        storage.add(policy)
+    pdp = PDP(storage, EvaluationAlgorithm.HIGHEST_PRIORITY, [])
+    policy_set = PolicySet(policies)
+    ordered_policies = list(policy_set.get_all(num_policy, 0))
+    compiled = CompiledPolicies(ordered_policies, [])
+
+    start_time = time.time()
+    CompiledPolicies(ordered_policies, [])
+    print(f"Compiling {num_policy} policies takes {time.time() - start_time} s")
+
+    expected, interpreterTime = timeDecisions(
+        lambda request: pdp.is_allowed(AccessRequest.from_json(request)), requests)
+    print(f"py_abac interpreter: average time is {interpreterTime} s")
+    decisions, compiledTime = timeDecisions(compiled.is_allowed, requests)
+    print(f"compiled policies: average time is {compiledTime} s")
+    indexedDecisions, indexedTime = timeDecisions(
+        lambda request: compiled.is_allowed(request, policy_set.get_for_resource(
+            request["resource"]["id"], request["resource"]["attributes"]["thing_type"])), requests)
+    print(f"compiled candidate policies: average time is {indexedTime} s")
+
+    if decisions != expected or indexedDecisions != expected:
+        raise Exception("The compiled policies do not decide like the interpreter!")
+    print(f"{sum(expected)} of {num_request} requests allowed, speedup is {interpreterTime / compiledTime:.1f}x, "
+          f"{interpreterTime / indexedTime:.1f}x with the index")
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Generate a directory tree of configurable depth and fan-out, and run all its directories as local processes.
+
+Each directory gets its own port (counting from --base-port) and its own MongoDB database named after the directory.
+With --root-replicas, extra instances of the root directory share its database and run on the following ports.
+The generated topology file is used by every process to derive its routing data, see `Droit/topology.py`.
+
+Example:
+    python launcher.py --depth 4 --fan-out 3 --base-port 6001
+"""
+import json
+import os
+import string
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import click
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_child_label(index: int, fan_out: int) -> str:
+    """Get the suffix distinguishing the `index`-th child, a letter as in the built-in tree when possible
+    """
+    if fan_out <= len(string.ascii_lowercase):
+        return string.ascii_lowercase[index]
+    return f"-{index}"
+
+
+def generate_topology(depth: int, fan_out: int, base_port: int = 5001, host: str = 'localhost',
+                      root_replicas: int = 0) -> dict:
+    """Generate a complete tree with the naming scheme of the built-in tree (level1, level2a, level3ab, ...)
+
+    Args:
+        depth (int): the number of levels, 1 means a single root directory
+        fan_out (int): the number of children of each non-leaf directory
+        base_port (int): the port of the root directory, the others get the following ports in breadth-first order
+        host (str): the host of all directories
+        root_replicas (int): the number of extra instances of the root directory
+
+    Returns:
+        dict: the topology, in the format read by `Droit.topology.load_topology`
+    """
+    directories = [{"name": "level1", "url": f"http://{host}:{base_port}", "parent": None}]
+    current_level = [("level1", "")]
+    for level in range(2, depth + 1):
+        next_level = []
+        for parent_name, parent_suffix in current_level:
+            for index in range(fan_out):
+                suffix = parent_suffix + get_child_label(index, fan_out)
+                name = f"level{level}{suffix}"
+                directories.append({"name": name, "url": f"http://{host}:{base_port + len(directories)}",
+                                    "parent": parent_name})
+                next_level.append((name, suffix))
+        current_level = next_level
+    directories[0]["replicas"] = [f"http://{host}:{base_port + len(directories) + index}"
+                                  for index in range(root_replicas)]
+    return {"directories": directories}
+
+
+def start_directories(topology: dict, topology_path: str, log_dir: str, host: str = 'localhost') -> list:
+    """Start one `run.py` process per directory of the topology, with a clean database
+
+    Returns:
+        list: (directory entry, process) pairs
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    processes = []
+    for entry in topology["directories"]:
+        log_file = open(os.path.join(log_dir, f"{entry['name']}.log"), 'w')
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_DIR, "run.py"), "--level", entry["name"], "--topology", topology_path,
+             "--init-db", "True", "--debug", "False", "--host", host],
+            cwd=ROOT_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+        processes.append((entry, process))
+    return processes
+
+
+def start_replicas(topology: dict, topology_path: str, log_dir: str, host: str = 'localhost') -> list:
+    """Start the extra instances of the directories, reusing the database of their (already running) directory
+
+    Returns:
+        list: (instance entry, process) pairs
+    """
+    processes = []
+    for entry in topology["directories"]:
+        for index, url in enumerate(entry.get("replicas", []), start=1):
+            log_file = open(os.path.join(log_dir, f"{entry['name']}-replica{index}.log"), 'w')
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT_DIR, "run.py"), "--level", entry["name"], "--topology",
+                 topology_path, "--port", str(urlsplit(url).port), "--debug", "False", "--host", host],
+                cwd=ROOT_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+            processes.append(({"name": f"{entry['name']}-replica{index}", "url": url}, process))
+    return processes
+
+
+def wait_until_ready(processes: list, timeout: float) -> list:
+    """Poll every directory until it answers /api/adjacent_directory, or until the timeout is reached
+
+    Returns:
+        list: the names of the directories that are not ready
+    """
+    deadline = time.time() + timeout
+    pending = list(processes)
+    while pending and time.time() < deadline:
+        still_pending = []
+        for entry, process in pending:
+            if process.poll() is not None:
+                # the process exited, it will never be ready
+                still_pending.append((entry, process))
+                continue
+            try:
+                response = requests.get(f"{entry['url']}/api/adjacent_directory", timeout=1)
+                if response.status_code == 200:
+                    continue
+            except requests.RequestException:
+                pass
+            still_pending.append((entry, process))
+        pending = still_pending
+        if all(process.poll() is not None for _, process in pending):
+            break
+        if pending:
+            time.sleep(0.5)
+    return [entry["name"] for entry, _ in pending]
+
+
+def stop_directories(processes: list, timeout: float = 10):
+    """Terminate all directory processes, killing those that do not exit in time
+    """
+    for _, process in processes:
+        if process.poll() is None:
+            process.terminate()
+    deadline = time.time() + timeout
+    for _, process in processes:
+        try:
+            process.wait(timeout=max(0.0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+@click.command()
+@click.option('--depth', default=3, type=click.IntRange(min=1), help="The number of levels of the tree.\nBy default it's 3.")
+@click.option('--fan-out', default=2, type=click.IntRange(min=1), help="The number of children of each non-leaf directory.\nBy default it's 2.")
+@click.option('--base-port', default=5001, type=int, help="The port of the root directory, the others use the following ports.\nBy default it's 5001.")
+@click.option('--host', default='localhost', type=str, help="The host that all directories are running on.\nBy default it is localhost")
+@click.option('--output', default='topology.generated.json', type=click.Path(dir_okay=False),
+              help="The path of the generated topology file.\nBy default it's topology.generated.json.")
+@click.option('--log-dir', default='logs', type=click.Path(file_okay=False), help="The directory of the process logs.\nBy default it's logs.")
+@click.option('--ready-timeout', default=120, type=float, help="Seconds to wait for all directories to be ready.\nBy default it's 120.")
+@click.option('--root-replicas', default=0, type=click.IntRange(min=0), help="The number of extra instances of the root directory.\nBy default it's 0.")
+@click.option('--generate-only', is_flag=True, default=False, help="Only write the topology file, do not start the directories.")
+def main(depth, fan_out, base_port, host, output, log_dir, ready_timeout, root_replicas, generate_only):
+    """
+    Generate the tree, start all directories, wait for them to be ready, and tear them down on Ctrl+C
+    """
+    # 1. generate and write the topology
+    topology = generate_topology(depth, fan_out, base_port, host, root_replicas)
+    with open(output, 'w', encoding='utf8') as fp:
+        json.dump(topology, fp, indent=2)
+    click.echo(f"Generated {len(topology['directories'])} directories "
+               f"(depth {depth}, fan-out {fan_out}) into {output}")
+    if generate_only:
+        return
+
+    # 2. start the directories and wait for them
+    start = time.time()
+    processes = start_directories(topology, os.path.abspath(output), log_dir, host)
+    try:
+        not_ready = wait_until_ready(processes, ready_timeout)
+        if not not_ready and root_replicas:
+            # replicas share the database of their directory, so they start after it was initialized
+            replicas = start_replicas(topology, os.path.abspath(output), log_dir, host)
+            processes.extend(replicas)
+            not_ready = wait_until_ready(replicas, ready_timeout)
+        if not_ready:
+            click.echo(f"{len(not_ready)} directories are not ready, see {log_dir}: {', '.join(not_ready[:10])}")
+            return
+        click.echo(f"All directories are ready after {time.time() - start:.1f}s, press Ctrl+C to stop them")
+
+        # 3. keep running until interrupted or a directory exits
+        while all(process.poll() is None for _, process in processes):
+            time.sleep(1)
+        click.echo("A directory exited, stopping the tree")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_directories(processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,54 @@
 import click
 from flask_mongoengine import MongoEngine
 from Droit import create_app
+from Droit.audit import start_audit_writer
 from Droit.auth.models import auth_db
-from Droit.databases import init_dir_to_url, init_target_to_child_name, clear_database
+from Droit.databases import clear_database
 from Droit.databases import mongo
 from Droit.auth.oauth2 import oauth, config_oauth, initiate_providers
-from config import dev_config
+from Droit.peers import start_health_prober
+from Droit.routing import start_routing_refresher
+from Droit.tasks import should_start_tasks
+from Droit.topology import load_topology, apply_topology, join_parent, leave_parent_at_exit
+from Droit.views.lease import start_lease_reaper
+from Droit.views.policy_inheritance import start_policy_inheritance
+from Droit.views.reconciliation import start_reconciler
+from config import dev_config, make_dev_config
+from urllib.parse import urlparse
+import os
+
+# The topology file describing the built-in nine-level tree
+DEFAULT_TOPOLOGY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topology.json')
 
 @click.command()
 @click.option('--init-db', default=False, type=bool, help="Clean previous data and insert URL mappings into database.\nBy default it's True")
 @click.option('--debug', default=True, type=bool, help="Use Debug Mode.\nBy default it's True.")
 @click.option('--host', default='localhost', type=str, help="The host that this app is running on.\n By default it is localhost")
-@click.option('--level', default='level1', type=click.Choice(['level1','level2a','level2b','level3aa','level3ab','level4aba','level4abb','level5abba','level5abbb'], case_sensitive=False), 
-                    help = "Specify which directory to run.\nBy default its the level1.\n If the mode is 'all', this argument will be ignored.")
-def main(level, init_db, debug, host):
+@click.option('--level', default='level1', type=str,
+                    help = "Specify which directory to run.\nBy default its the level1.\n It must be one of the built-in levels, a directory of the topology file, or a new directory joining with --parent-url.")
+@click.option('--topology', default=None, type=click.Path(exists=True, dir_okay=False),
+                    help="A topology file (JSON) from which the routing data of the directory is derived.\nBy default the built-in nine-level tree is used.")
+@click.option('--port', default=None, type=int, help="The port of a directory that is neither built-in nor in the topology file, or of a replica of a directory of the topology file.")
+@click.option('--parent-url', default=None, type=str, help="Join the tree as a child of the directory running at this URL, and leave it when stopping.")
+def main(level, init_db, debug, host, topology, port, parent_url):
     """
     Load all configurations for the application, and then start running
     """
     app = create_app()
     # initialize Flask app
-    app_config = dev_config[level]
+    tree = load_topology(topology) if topology else None
+    if tree is not None and level in tree:
+        # a replica of a directory of the topology runs on its own port, given by --port
+        app_config = make_dev_config(level, port or urlparse(tree[level]["url"]).port, host)
+    elif port is not None:
+        app_config = make_dev_config(level, port, host)
+    elif level in dev_config:
+        app_config = dev_config[level]
+    else:
+        raise click.BadParameter(f"Unknown directory '{level}', give --topology or --port", param_hint='--level')
     app.config.update(**app_config.to_dict())
+    if tree is None and parent_url is None and level in dev_config:
+        tree = load_topology(DEFAULT_TOPOLOGY_PATH)
 
     # initialize db connections for mongo engine, and pymongo
     mongo_db = MongoEngine(app)
@@ -39,8 +67,23 @@ def main(level, init_db, debug, host):
             auth_db.create_all()
         # Initialize IoT related tables in MongoDB
         clear_database()
-        init_dir_to_url(level)
-        init_target_to_child_name(level)
+    # derive the routing data from the topology, only the changed records are written
+    if tree is not None and level in tree:
+        with app.app_context():
+            apply_topology(tree, level)
+    if parent_url is not None:
+        with app.test_request_context():
+            if not join_parent(parent_url):
+                raise click.ClickException(f"Failed to join the directory at {parent_url}")
+        # an instance that joined at runtime leaves the tree when it stops
+        leave_parent_at_exit(app)
+    if should_start_tasks(debug):
+        start_lease_reaper(app)
+        start_health_prober(app)
+        start_routing_refresher(app)
+        start_reconciler(app)
+        start_policy_inheritance(app)
+        start_audit_writer(app)
     app.run(debug = debug, host= host, port= app.config["PORT"])
 
 
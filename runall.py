@@ -3,10 +3,11 @@ Starting scripts for running all directories all together.
 
 """
 import subprocess
+import sys
 
 level_names = ["level1", "level2a", "level2b", "level3aa", "level3ab", "level4aba", "level4abb", "level5abba", "level5abbb"]
 
-processes = [subprocess.Popen(["D:\\DABAC\\venv\\Scripts\\python.exe", "./run.py", "--level", level_name]) for level_name in level_names]
+processes = [subprocess.Popen([sys.executable, "./run.py", "--level", level_name]) for level_name in level_names]
 
 for p in processes:
     p.wait()
@@ -0,0 +1,83 @@
+"""
+Tests of the counts answered from the type counters and the per-descendant counts of the aggregation data, which
+replace counting the thing descriptions of the subtree for an unfiltered COUNT.
+
+The directory is level2a, it stores its own things and the copies pushed up from level3aa, and level3aa and its child
+level4aaa report their counts in the aggregation data.
+"""
+from collections import namedtuple
+
+import pytest
+
+from Droit.views import counter
+from Droit.views.counter import get_subtree_type_counts, get_type_counts
+
+Counter = namedtuple('Counter', ['thing_type', 'directory_name', 'count'])
+Aggregation = namedtuple('Aggregation', ['thing_type', 'children_names', 'children_counts'])
+
+# (thing_type, directory name) of the things of the subtree, the things of the descendants are also pushed up
+THINGS = [("bus", "level2a")] * 3 + [("light", "level2a")] + [("bus", "level3aa")] * 2 + [("bus", "level4aaa")] + \
+    [("thermostat", "level4aaa")] * 2
+
+
+class FakeManager(object):
+    """The `objects` manager of a model, filtering its documents by field values
+    """
+
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def __call__(self, **filters):
+        return [document for document in self.documents
+                if all(getattr(document, field) == value for field, value in filters.items())]
+
+    def all(self):
+        return list(self.documents)
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    """The counters of level2a, with the copies pushed up from level3aa counted under level3aa
+    """
+    counts = {}
+    for thing_type, directory_name in THINGS:
+        key = (thing_type, "level2a" if directory_name == "level2a" else "level3aa")
+        counts[key] = counts.get(key, 0) + 1
+    children_counts = {}
+    for thing_type, directory_name in THINGS:
+        if directory_name != "level2a":
+            children_counts.setdefault(thing_type, {}).setdefault(directory_name, 0)
+            children_counts[thing_type][directory_name] += 1
+    # a descendant whose things of a type were all deleted keeps a zero count until the aggregation is updated
+    children_counts["light"] = {"level3aa": 0}
+    monkeypatch.setattr(counter, "TypeCounter", type("TypeCounter", (), {"objects": FakeManager(
+        [Counter(thing_type, directory_name, count) for (thing_type, directory_name), count in counts.items()])}))
+    monkeypatch.setattr(counter, "TypeToChildrenNames", type("TypeToChildrenNames", (), {"objects": FakeManager(
+        [Aggregation(thing_type, list(descendant_counts), descendant_counts)
+         for thing_type, descendant_counts in children_counts.items()])}))
+
+
+def count_things(thing_type: str) -> int:
+    return sum(1 for thing in THINGS if thing[0] == thing_type)
+
+
+@pytest.mark.parametrize("thing_type", ["bus", "light", "thermostat", "missing"])
+def test_subtree_count_matches_the_things(counters, thing_type):
+    assert get_subtree_type_counts("level2a", thing_type)[thing_type]["total"] == count_things(thing_type)
+
+
+def test_subtree_counts_per_directory(counters):
+    assert get_subtree_type_counts("level2a") == {
+        "bus": {"total": 6, "by_directory": {"level2a": 3, "level3aa": 2, "level4aaa": 1}},
+        "light": {"total": 1, "by_directory": {"level2a": 1}},
+        "thermostat": {"total": 2, "by_directory": {"level4aaa": 2}},
+    }
+
+
+def test_local_counts_include_the_pushed_up_copies(counters):
+    assert get_type_counts() == {
+        "bus": {"total": 6, "by_directory": {"level2a": 3, "level3aa": 3}},
+        "light": {"total": 1, "by_directory": {"level2a": 1}},
+        "thermostat": {"total": 2, "by_directory": {"level3aa": 2}},
+    }
+    assert get_type_counts("light") == {"light": {"total": 1, "by_directory": {"level2a": 1}}}
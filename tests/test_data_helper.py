@@ -0,0 +1,37 @@
+"""
+Tests of the selection of the bulk operations: a selection that would match every thing description, no ids and no
+filter condition, is rejected.
+"""
+import pytest
+
+from Droit.views.data_helper import get_filter_map, get_selection_map
+
+POLYGON = [[-75, 40], [-75, 41], [-70, 41], [-70, 40]]
+
+
+@pytest.mark.parametrize("thing_ids, filters", [
+    (None, None),
+    (None, {}),
+    ([], None),
+    ([], {}),
+])
+def test_empty_selection_is_rejected(thing_ids, filters):
+    assert get_selection_map(thing_ids, filters) is None
+
+
+@pytest.mark.parametrize("thing_ids, filters, expected", [
+    (["urn:bus:1", "urn:bus:2"], None, {"thing_id__in": ["urn:bus:1", "urn:bus:2"]}),
+    (None, {"thing_type": "bus"}, {"thing_type": "bus"}),
+    # an empty list of ids with a filter selects nothing, not every thing matching the filter
+    ([], {"thing_type": "bus"}, {"thing_type": "bus", "thing_id__in": []}),
+    (["urn:bus:1"], {"properties.color": "red"}, {"properties__color": "red", "thing_id__in": ["urn:bus:1"]}),
+    (None, {"polygon": POLYGON}, {"properties__geo__coordinates__geo_within_polygon": POLYGON}),
+])
+def test_selection_map(thing_ids, filters, expected):
+    assert get_selection_map(thing_ids, filters) == expected
+
+
+def test_filter_map_does_not_change_the_filters():
+    filters = {"polygon": POLYGON, "thing_type": "bus"}
+    get_filter_map(filters)
+    assert filters == {"polygon": POLYGON, "thing_type": "bus"}
@@ -0,0 +1,162 @@
+"""
+Tests of the decision cache: the expiration of decisions depending on `$.timestamp` and `$.timespan`, and the keys
+under which `explain_access` caches them, which change with the version of the policy set and with the number of
+accesses of the subject to the thing.
+
+The recorded accesses are read from a fake `ThingFrequency`.
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from py_abac import Policy
+
+from Droit import attribute_providers, decision_cache as decision_cache_module, utils
+from Droit.decision_cache import DecisionCache, DEFAULT_DECISION_CACHE_TTL, get_expiration, get_time_dependencies
+from Droit.policy_helper import PolicySet
+
+SUBJECT = {"id": "1", "attributes": {"email": "alice@example.com"}}
+
+
+def make_policy(uid: str, effect: str, resource=None, context=None) -> Policy:
+    return Policy.from_json({
+        "uid": uid,
+        "description": uid,
+        "effect": effect,
+        "rules": {
+            "subject": {},
+            "resource": resource or {},
+            "action": {"$.method": {"condition": "Equals", "value": "get"}},
+            "context": context or {}
+        },
+        "targets": {},
+        "priority": 0
+    })
+
+
+class FakeThingFrequency(object):
+    """Recorded accesses, thing id => subject id => list of UTC datetimes
+    """
+    documents = {}
+
+    def __init__(self, timestamps: dict):
+        self.timestamps = timestamps
+
+    @classmethod
+    def objects(cls, thing_id: str):
+        documents = [cls(cls.documents[thing_id])] if thing_id in cls.documents else []
+        return type("QuerySet", (), {"first": lambda self: documents[0] if documents else None})()
+
+
+@pytest.fixture
+def accesses(monkeypatch):
+    """Recorded accesses of the subjects to the things, read by the providers and by `get_expiration`
+    """
+    FakeThingFrequency.documents = {}
+    monkeypatch.setattr(decision_cache_module, "ThingFrequency", FakeThingFrequency)
+    monkeypatch.setattr(attribute_providers, "ThingFrequency", FakeThingFrequency)
+    return FakeThingFrequency.documents
+
+
+@pytest.fixture
+def policies(monkeypatch, accesses):
+    """The policy set of the location, replaced by assigning `policies['set']`
+    """
+    policies = {}
+    monkeypatch.setattr(utils.policy_cache, "get_policies", lambda location: policies['set'])
+    monkeypatch.setattr(utils, "decision_cache", DecisionCache())
+    monkeypatch.setattr(utils, "get_access_counts", lambda subject_id, thing_ids: {
+        thing_id: len(accesses.get(thing_id, {}).get(subject_id, [])) for thing_id in thing_ids})
+    return policies
+
+
+def test_time_dependencies_are_collected():
+    dependencies = get_time_dependencies([
+        make_policy("before", "allow", context={"$.timestamp": {"condition": "Lt", "value": 2000000000}}),
+        make_policy("window", "allow", context={"$.timestamp": {"condition": "AllOf", "values": [
+            {"condition": "Gte", "value": 1000}, {"condition": "Not", "value": {"condition": "Gt", "value": 3000}}]}}),
+        make_policy("rate", "deny", resource={"$.timespan: 60": {"condition": "Gte", "value": 3}}),
+    ])
+    assert dependencies == {"timestamps": [1000, 3000, 2000000000], "timespans": [60]}
+
+
+def test_decision_expires_at_the_next_timestamp_threshold():
+    now = time.time()
+    dependencies = {"timestamps": [now - 100, now + 10, now + 20], "timespans": []}
+    assert get_expiration(dependencies, "1", "urn:bus:1") == now + 10
+    assert get_expiration({"timestamps": [now - 100], "timespans": []}, "1", "urn:bus:1") == \
+        pytest.approx(now + DEFAULT_DECISION_CACHE_TTL, abs=1)
+
+
+def test_decision_expires_when_the_oldest_access_leaves_the_window(accesses):
+    utc_now = datetime.utcnow()
+    accesses["urn:bus:1"] = {"1": [utc_now - timedelta(seconds=100), utc_now - timedelta(seconds=45),
+                                   utc_now - timedelta(seconds=5)]}
+    expires = get_expiration({"timestamps": [], "timespans": [60]}, "1", "urn:bus:1")
+    assert expires == pytest.approx(time.time() + 15, abs=1)
+    assert get_expiration({"timestamps": [], "timespans": [60]}, "2", "urn:bus:1") == \
+        pytest.approx(time.time() + DEFAULT_DECISION_CACHE_TTL, abs=1)
+
+
+def test_expired_decision_is_dropped(monkeypatch):
+    cache = DecisionCache()
+    now = time.time()
+    cache.put(("location", 1), (True, "allow"), now + 10)
+    cache.put(("location", 2), (True, "allow"), now - 1)
+    assert cache.get(("location", 1)) == (True, "allow")
+    assert cache.get(("location", 2)) is None
+
+    monkeypatch.setattr(decision_cache_module.time, "time", lambda: now + 11)
+    assert cache.get(("location", 1)) is None
+
+
+def test_least_recently_used_decision_is_evicted():
+    cache = DecisionCache(max_size=2)
+    expires = time.time() + 10
+    cache.put(("location", 1), (True, None), expires)
+    cache.put(("location", 2), (True, None), expires)
+    cache.get(("location", 1))
+    cache.put(("location", 3), (True, None), expires)
+    assert cache.get(("location", 2)) is None
+    assert cache.get(("location", 1)) is not None
+
+
+def test_invalidation_by_access_and_location():
+    cache = DecisionCache()
+    expires = time.time() + 10
+    cache.put(("level1", "a"), (True, None), expires, ("1", "urn:bus:1"))
+    cache.put(("level1", "b"), (True, None), expires)
+    cache.put(("level2", "c"), (True, None), expires)
+
+    cache.invalidate_access("1", "urn:bus:1")
+    assert cache.get(("level1", "a")) is None
+    assert cache.get(("level1", "b")) is not None
+
+    cache.invalidate_location("level1")
+    assert cache.get(("level1", "b")) is None
+    assert cache.get(("level2", "c")) is not None
+
+
+def test_new_policy_version_misses_cached_decisions(policies):
+    policies['set'] = PolicySet([make_policy("allow-all", "allow")], version=1)
+    assert utils.explain_access("level1", SUBJECT, [("urn:bus:1", "bus", "get")]) == [(True, "allow-all")]
+
+    # the cached decision is reused while the version is the same
+    policies['set'] = PolicySet([make_policy("deny-all", "deny")], version=1)
+    assert utils.explain_access("level1", SUBJECT, [("urn:bus:1", "bus", "get")]) == [(True, "allow-all")]
+
+    policies['set'] = PolicySet([make_policy("deny-all", "deny")], version=2)
+    assert utils.explain_access("level1", SUBJECT, [("urn:bus:1", "bus", "get")]) == [(False, "deny-all")]
+
+
+def test_new_access_misses_cached_decisions(policies, accesses):
+    policies['set'] = PolicySet([
+        make_policy("deny-frequent", "deny", resource={"$.timespan: 60": {"condition": "Gte", "value": 2}}),
+        make_policy("allow-all", "allow"),
+    ], version=1)
+    accesses["urn:bus:1"] = {"1": [datetime.utcnow() - timedelta(seconds=5)]}
+    assert utils.explain_access("level1", SUBJECT, [("urn:bus:1", "bus", "get")]) == [(True, "allow-all")]
+
+    # the number of accesses is part of the key, so the second access is decided again
+    accesses["urn:bus:1"]["1"].append(datetime.utcnow())
+    assert utils.explain_access("level1", SUBJECT, [("urn:bus:1", "bus", "get")]) == [(False, "deny-frequent")]
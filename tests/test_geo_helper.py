@@ -0,0 +1,112 @@
+"""
+Tests of the geographical helpers of the search APIs.
+
+`min_distance_to_bbox` prunes the children of a k-nearest-neighbour search, so it must never exceed the distance to
+a thing inside the spatial summary of a child, which is checked on a grid of points inside each box. The heat maps
+are counted from the groups of an aggregation over a fake query set.
+"""
+import random
+
+import pytest
+
+from Droit.views.geo_helper import count_by_geohash, encode_geohash, haversine_distance, merge_heat_maps, \
+    merge_nearest, min_distance_to_bbox
+
+BBOXES = [
+    [-75.0, 40.0, -70.0, 41.0],
+    [10.0, -10.0, 20.0, 10.0],
+    [170.0, 60.0, 179.0, 80.0],
+    [-1.0, -1.0, 1.0, 1.0],
+]
+
+
+def grid(bbox, steps: int = 20) -> list:
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return [[min_lng + (max_lng - min_lng) * i / steps, min_lat + (max_lat - min_lat) * j / steps]
+            for i in range(steps + 1) for j in range(steps + 1)]
+
+
+def thing(thing_id: str, distance: float) -> dict:
+    return {"thing_id": thing_id, "_distance": distance}
+
+
+@pytest.mark.parametrize("bbox", BBOXES)
+def test_min_distance_is_a_lower_bound(bbox):
+    points = grid(bbox)
+    rng = random.Random(0)
+    for _ in range(200):
+        query = [rng.uniform(-180, 180), rng.uniform(-85, 85)]
+        bound = min_distance_to_bbox(query, bbox)
+        assert bound <= min(haversine_distance(query, point) for point in points) + 1e-6, query
+
+
+@pytest.mark.parametrize("bbox", BBOXES)
+def test_min_distance_is_zero_inside(bbox):
+    assert min_distance_to_bbox([(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2], bbox) == 0.0
+    assert min_distance_to_bbox(bbox[:2], bbox) == 0.0
+
+
+def test_min_distance_to_the_nearest_edge():
+    bbox = [-75.0, 40.0, -70.0, 41.0]
+    # due north of the box, the nearest point is on the top edge at the same longitude
+    assert min_distance_to_bbox([-72.0, 42.0], bbox) == pytest.approx(haversine_distance([-72.0, 42.0], [-72.0, 41.0]))
+    # due east, the nearest point of the meridian edge is slightly towards the pole from the query latitude
+    east = min_distance_to_bbox([-60.0, 40.5], bbox)
+    assert east <= haversine_distance([-60.0, 40.5], [-70.0, 40.5])
+    assert east == pytest.approx(min(haversine_distance([-60.0, 40.5], point) for point in grid(bbox, 200)), rel=1e-3)
+
+
+def test_merge_nearest_keeps_k_nearest_distinct_things():
+    best = [thing("a", 1.0), thing("b", 5.0)]
+    merged = merge_nearest(best, [thing("c", 2.0), thing("b", 3.0), thing("d", 9.0)], 3)
+    assert merged == [thing("a", 1.0), thing("c", 2.0), thing("b", 3.0)]
+
+
+def test_merge_nearest_keeps_the_nearer_copy():
+    merged = merge_nearest([thing("a", 1.0)], [thing("a", 4.0)], 2)
+    assert merged == [thing("a", 1.0)]
+    assert merge_nearest([], [], 2) == []
+
+
+class FakeQuerySet(object):
+    """Query set answering the `$group` stage of `count_by_geohash` over the given coordinates
+    """
+
+    def __init__(self, coordinates: list):
+        self.coordinates = coordinates
+
+    def aggregate(self, *pipeline):
+        groups = {}
+        for coordinates in self.coordinates:
+            key = repr(coordinates)
+            groups.setdefault(key, {"_id": coordinates, "count": 0})["count"] += 1
+        return iter(groups.values())
+
+
+@pytest.mark.parametrize("lng, lat, precision, expected", [
+    (-5.6, 42.6, 5, "ezs42"),
+    (10.40744, 57.64911, 11, "u4pruydqqvj"),
+    (-180.0, -90.0, 4, "0000"),
+    (179.99, 89.99, 4, "zzzz"),
+    (0.0, 0.0, 1, "s"),
+])
+def test_encode_geohash(lng, lat, precision, expected):
+    assert encode_geohash(lng, lat, precision) == expected
+
+
+def test_geohash_prefix_is_the_coarser_cell():
+    cells = [encode_geohash(10.40744, 57.64911, precision) for precision in range(1, 13)]
+    assert all(finer.startswith(coarser) for coarser, finer in zip(cells, cells[1:]))
+
+
+def test_count_by_geohash_buckets_things_per_cell():
+    things_obj = FakeQuerySet([[-5.6, 42.6], [-5.6, 42.6], [-5.61, 42.61], [10.4, 57.6], None, [1.0], "bad"])
+    assert count_by_geohash(things_obj, 3) == {"ezs": 3, "u4p": 1}
+    assert count_by_geohash(things_obj, 1) == {"e": 3, "u": 1}
+    assert count_by_geohash(FakeQuerySet([]), 5) == {}
+
+
+def test_merge_heat_maps_sums_the_same_cells():
+    merged = merge_heat_maps([{"ezs": 3, "u4p": 1}, {"ezs": 2}, None, {"dr5": 4}, "error"])
+    assert merged == {"ezs": 5, "u4p": 1, "dr5": 4}
+    assert merge_heat_maps([]) == {}
@@ -0,0 +1,99 @@
+"""
+Tests of the signed claims the directories of a tree send to each other, in particular the `_subject` of an enforced
+search: only a subject signed with the tree secret is trusted, any other `_subject` is ignored. The bodies of the
+topology requests are signed the same way.
+"""
+import json
+import time
+
+from Droit import peer_auth
+from Droit.peer_auth import get_forwarded_subject, get_signed_headers, is_signed_request, sign_claims, verify_claims, \
+    PEER_TOKEN_HEADER
+
+SECRET = "tree-secret"
+SUBJECT = {"id": "alice", "attributes": {"role": "admin"}}
+AUTH_ATTRIBUTES = [{"position": [1.0, 2.0]}, {"clearance": 3}]
+HEADERS = {'Content-Type': 'application/json'}
+
+
+class FakeRequest(object):
+    """The parts of `flask.Request` read by `is_signed_request`
+    """
+
+    def __init__(self, body: str, headers: dict):
+        self.headers = headers
+        self._body = body.encode('utf-8')
+
+    def get_data(self) -> bytes:
+        return self._body
+
+
+def test_signed_claims_are_verified():
+    token = sign_claims({"subject": SUBJECT}, SECRET)
+    claims = verify_claims(token, SECRET)
+    assert claims["subject"] == SUBJECT
+
+
+def test_signed_subject_is_forwarded():
+    token = sign_claims({"subject": SUBJECT, "auth_attributes": AUTH_ATTRIBUTES}, SECRET)
+    assert get_forwarded_subject(token, SECRET) == (SUBJECT, AUTH_ATTRIBUTES)
+
+
+def test_unsigned_subject_is_ignored():
+    unsigned = json.dumps(dict(SUBJECT, auth_attributes=AUTH_ATTRIBUTES))
+    assert get_forwarded_subject(unsigned, SECRET) is None
+
+
+def test_subject_signed_with_another_secret_is_ignored():
+    token = sign_claims({"subject": SUBJECT, "auth_attributes": AUTH_ATTRIBUTES}, "another-secret")
+    assert get_forwarded_subject(token, SECRET) is None
+
+
+def test_tampered_subject_is_ignored():
+    token = sign_claims({"subject": SUBJECT, "auth_attributes": AUTH_ATTRIBUTES}, SECRET)
+    payload, signature = token.split(".")
+    forged = sign_claims({"subject": {"id": "mallory", "attributes": {"role": "admin"}},
+                          "auth_attributes": AUTH_ATTRIBUTES}, "another-secret")
+    assert get_forwarded_subject(f"{forged.split('.')[0]}.{signature}", SECRET) is None
+    assert get_forwarded_subject(f"{payload}.{signature[:-2]}", SECRET) is None
+
+
+def test_expired_subject_is_ignored(monkeypatch):
+    token = sign_claims({"subject": SUBJECT, "auth_attributes": AUTH_ATTRIBUTES}, SECRET)
+    now = time.time()
+    monkeypatch.setattr(peer_auth.time, "time", lambda: now + peer_auth.DEFAULT_PEER_TOKEN_TTL + 1)
+    assert get_forwarded_subject(token, SECRET) is None
+
+
+def test_malformed_signed_subject_is_ignored():
+    assert get_forwarded_subject(sign_claims({"subject": SUBJECT}, SECRET), SECRET) is None
+    assert get_forwarded_subject(sign_claims({"subject": {"id": 1, "attributes": {}},
+                                              "auth_attributes": AUTH_ATTRIBUTES}, SECRET), SECRET) is None
+    assert get_forwarded_subject(sign_claims({"subject": SUBJECT, "auth_attributes": [{}]}, SECRET), SECRET) is None
+
+
+def test_nothing_is_trusted_without_a_secret():
+    assert sign_claims({"subject": SUBJECT}) is None
+    assert verify_claims(sign_claims({"subject": SUBJECT}, SECRET)) is None
+    assert get_forwarded_subject(None, SECRET) is None
+
+
+def test_signed_topology_request_is_accepted():
+    body = json.dumps({"name": "level3ac", "url": "http://localhost:5010"})
+    headers = get_signed_headers(body, HEADERS, SECRET)
+    assert headers["Content-Type"] == "application/json"
+    assert is_signed_request(FakeRequest(body, headers), SECRET)
+
+
+def test_unsigned_topology_request_is_rejected():
+    body = json.dumps({"name": "level3ac", "url": "http://localhost:5010"})
+    assert not is_signed_request(FakeRequest(body, HEADERS), SECRET)
+    assert PEER_TOKEN_HEADER not in get_signed_headers(body, HEADERS)
+
+
+def test_signature_of_another_body_is_rejected():
+    signed = get_signed_headers(json.dumps({"via": "level2a", "remove": []}), HEADERS, SECRET)
+    forged_body = json.dumps({"via": "level2a", "remove": ["level3aa"]})
+    assert not is_signed_request(FakeRequest(forged_body, signed), SECRET)
+    assert not is_signed_request(FakeRequest(forged_body, get_signed_headers(forged_body, HEADERS, "another-secret")),
+                                 SECRET)
@@ -0,0 +1,118 @@
+"""
+Tests of the hedged reads to the instances of a peer directory and of the marking of partial results.
+
+The requests are answered by a fake `send_to_peer`, keyed by the base URL of the instance.
+"""
+import time
+
+import pytest
+import requests
+
+from Droit import peers
+
+PRIMARY = "http://primary:5002/api/search"
+ALTERNATE = "http://alternate:5002"
+
+
+def make_response(status_code: int, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+class FakeRegistry(object):
+    """Peer registry with an available alternate instance and a fixed latency percentile
+    """
+
+    def __init__(self, threshold: float = 0.05):
+        self.threshold = threshold
+
+    def is_available(self, url: str) -> bool:
+        return True
+
+    def get_latency_percentile(self, url: str, percentile: float) -> float:
+        return self.threshold
+
+    def choose_instance(self, urls: list) -> str:
+        return urls[0]
+
+
+class FakeRoutingTable(object):
+    def get_alternate_urls(self, url: str) -> list:
+        return [ALTERNATE]
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """Map from instance to the (delay, response or exception) answering its requests, and the URLs requested
+    """
+    answers = {}
+    sent = []
+
+    def send_to_peer(method, url, kwargs):
+        sent.append(url)
+        delay, answer = answers[peers.get_base_url(url)]
+        time.sleep(delay)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(peers, "send_to_peer", send_to_peer)
+    monkeypatch.setattr(peers, "peer_registry", FakeRegistry())
+    monkeypatch.setattr(peers, "routing_table", FakeRoutingTable())
+    answers['sent'] = sent
+    return answers
+
+
+def test_fast_primary_is_not_hedged(answers):
+    answers["http://primary:5002"] = (0, make_response(200))
+    answers[ALTERNATE] = (0, make_response(200))
+    assert peers.send_hedged('GET', PRIMARY, {}, 95).status_code == 200
+    assert answers['sent'] == [PRIMARY]
+
+
+def test_slow_primary_is_hedged(answers):
+    answers["http://primary:5002"] = (0.5, make_response(200, {"instance": "primary"}))
+    answers[ALTERNATE] = (0, make_response(200, {"instance": "alternate"}))
+    assert peers.send_hedged('GET', PRIMARY, {}, 95).headers["instance"] == "alternate"
+
+
+@pytest.mark.parametrize("failure", [requests.ConnectionError("refused"), make_response(503)])
+def test_fast_failure_falls_through_to_alternate(answers, failure):
+    answers["http://primary:5002"] = (0, failure)
+    answers[ALTERNATE] = (0, make_response(200))
+    assert peers.send_hedged('GET', PRIMARY, {}, 95).status_code == 200
+    assert answers['sent'] == [PRIMARY, "http://alternate:5002/api/search"]
+
+
+def test_error_response_preferred_when_both_fail(answers):
+    answers["http://primary:5002"] = (0, make_response(503))
+    answers[ALTERNATE] = (0, requests.ConnectionError("refused"))
+    assert peers.send_hedged('GET', PRIMARY, {}, 95).status_code == 503
+
+
+def test_request_error_raised_when_both_raise(answers):
+    answers["http://primary:5002"] = (0, requests.ConnectionError("refused"))
+    answers[ALTERNATE] = (0, requests.Timeout("slow"))
+    with pytest.raises(requests.RequestException):
+        peers.send_hedged('GET', PRIMARY, {}, 95)
+
+
+@pytest.mark.parametrize("method, partial", [('GET', True), ('POST', False), ('DELETE', False)])
+def test_only_reads_mark_partial_results(monkeypatch, method, partial):
+    marks = []
+    monkeypatch.setattr(peers, "mark_partial_result", lambda: marks.append(True))
+    monkeypatch.setattr(peers, "get_healthy_url", lambda url: url)
+    monkeypatch.setattr(peers, "send_hedged", lambda method, url, kwargs, percentile: make_response(503))
+    monkeypatch.setattr(peers, "send_to_peer", lambda method, url, kwargs: make_response(503))
+    assert peers.peer_request(method, PRIMARY).status_code == 503
+
+    def fail(*args):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(peers, "send_hedged", fail)
+    monkeypatch.setattr(peers, "send_to_peer", fail)
+    with pytest.raises(requests.RequestException):
+        peers.peer_request(method, PRIMARY)
+    assert marks == ([True, True] if partial else [])
@@ -0,0 +1,113 @@
+"""
+Tests of the compiled policies, checked against the decisions of the py_abac PDP with the highest priority algorithm
+on the same policies and access requests.
+"""
+import pytest
+from py_abac import AccessRequest, EvaluationAlgorithm, PDP, Policy
+
+from Droit.policy_compiler import CompiledPolicies, compile_condition
+from Droit.policy_helper import PolicySet
+from Droit.utils import get_access_request
+
+
+def make_policy(uid: str, effect: str, priority: int = 0, resource=None, subject=None, action="get",
+                resource_id="*") -> Policy:
+    return Policy.from_json({
+        "uid": uid,
+        "description": uid,
+        "effect": effect,
+        "rules": {
+            "subject": subject or {},
+            "resource": resource or {},
+            "action": {"$.method": {"condition": "Equals", "value": action}},
+            "context": {}
+        },
+        "targets": {"resource_id": resource_id},
+        "priority": priority
+    })
+
+
+ACCESSES = [
+    ("urn:bus:1", "bus", "get"),
+    ("urn:bus:2", "bus", "delete"),
+    ("urn:light:1", "light", "get"),
+    ("urn:thermo:1", None, "get"),
+    ("other", "file", "get"),
+]
+ALICE = {"id": "1", "attributes": {"email": "alice@example.com", "clearance": 3, "groups": ["staff"]}}
+BOB = {"id": "2", "attributes": {"email": "bob@example.com"}}
+ANONYMOUS = {"id": "", "attributes": {}}
+
+POLICY_SETS = {
+    "deny overrides allow of the same priority": [
+        make_policy("allow-all", "allow"),
+        make_policy("deny-bus-1", "deny", resource_id="urn:bus:1"),
+    ],
+    "higher priority allow wins": [
+        make_policy("deny-all", "deny", priority=1),
+        make_policy("allow-urn", "allow", priority=2, resource_id="urn:*"),
+    ],
+    "lower priority allow loses": [
+        make_policy("deny-bus", "deny", priority=3, resource={"$.thing_type": {"condition": "Equals", "value": "bus"}}),
+        make_policy("allow-all", "allow", priority=1),
+    ],
+    "wildcard and list targets": [
+        make_policy("allow-list", "allow", resource_id=["urn:bus:1", "urn:light:*"]),
+        make_policy("allow-single-char", "allow", resource_id="urn:bus:?", action="delete"),
+        make_policy("deny-class", "deny", resource_id="urn:l[i]ght:*", priority=1,
+                    subject={"$.email": {"condition": "StartsWith", "value": "bob"}}),
+    ],
+    "missing attributes": [
+        make_policy("allow-clearance", "allow", subject={"$.clearance": {"condition": "Gte", "value": 2}}),
+        make_policy("allow-not-exists", "allow", resource_id="other",
+                    subject={"$.clearance": {"condition": "NotExists"}}),
+        make_policy("deny-no-type", "deny", resource={"$.thing_type": {"condition": "NotExists"}}),
+        make_policy("allow-staff", "allow", resource_id="urn:bus:*", action="delete",
+                    subject={"$.groups": {"condition": "AnyIn", "values": ["staff"]}}),
+    ],
+    "disjunction of rules": [
+        make_policy("allow-either", "allow", subject=[{"$.email": {"condition": "EndsWith", "value": "@example.com"}},
+                                                      {"$.clearance": {"condition": "Gt", "value": 5}}]),
+    ],
+    "nothing applies": [
+        make_policy("allow-missing", "allow", resource={"$.thing_type": {"condition": "Equals", "value": "missing"}}),
+    ],
+}
+
+
+@pytest.mark.parametrize("name", sorted(POLICY_SETS))
+@pytest.mark.parametrize("subject", [ALICE, BOB, ANONYMOUS])
+def test_compiled_policies_agree_with_pdp(name, subject):
+    policy_set = PolicySet(POLICY_SETS[name])
+    compiled = CompiledPolicies(list(policy_set.get_all(len(policy_set), 0)), [])
+    pdp = PDP(PolicySet(POLICY_SETS[name]), EvaluationAlgorithm.HIGHEST_PRIORITY, [])
+
+    for thing_id, thing_type, action in ACCESSES:
+        access_request = get_access_request(subject, thing_id, thing_type, action)
+        expected = pdp.is_allowed(AccessRequest.from_json(access_request))
+        assert compiled.is_allowed(access_request) == expected, (thing_id, action)
+        # the candidate policies from the target index decide the same way as all policies
+        assert compiled.is_allowed(access_request, policy_set.get_for_resource(thing_id, thing_type)) == expected
+
+
+def test_deciding_policy_is_the_first_fitting_one():
+    policy_set = PolicySet(POLICY_SETS["deny overrides allow of the same priority"])
+    compiled = CompiledPolicies(list(policy_set.get_all(len(policy_set), 0)), [])
+
+    assert compiled.get_deciding_policy(get_access_request(ALICE, "urn:bus:1", "bus")).uid == "deny-bus-1"
+    assert compiled.get_deciding_policy(get_access_request(ALICE, "urn:bus:2", "bus")).uid == "allow-all"
+    assert compiled.get_deciding_policy(get_access_request(ALICE, "urn:bus:2", "bus", "delete")) is None
+
+
+@pytest.mark.parametrize("condition, value, satisfied", [
+    ({"condition": "Equals", "value": "3"}, 3, False),
+    ({"condition": "Gt", "value": 3}, "4", False),
+    ({"condition": "Eq", "value": 3}, None, False),
+    ({"condition": "IsIn", "values": ["bus"]}, None, False),
+    ({"condition": "IsNotIn", "values": ["bus"]}, None, True),
+    ({"condition": "AllIn", "values": ["a", "b"]}, "a", False),
+    ({"condition": "CIDR", "value": "10.0.0.0/8"}, "10.1.2.3", True),
+    ({"condition": "CIDR", "value": "10.0.0.0/8"}, "not an address", False),
+])
+def test_compiled_conditions_check_types(condition, value, satisfied):
+    assert compile_condition(condition)(value) == satisfied
@@ -0,0 +1,196 @@
+"""
+Tests of the translation of policies into a MongoDB filter over thing descriptions.
+
+The filters are evaluated by a small matcher implementing the MongoDB query operators the translation produces, and
+`get_permitted_filter` is checked against the decisions of the py_abac PDP on the same policies.
+"""
+import re
+
+import pytest
+from py_abac import AccessRequest, EvaluationAlgorithm, PDP, Policy
+
+from Droit import policy_filter
+from Droit.policy_filter import MATCH_NOTHING, UntranslatableRule, get_permitted_filter, translate_condition
+from Droit.policy_helper import PolicySet
+from Droit.utils import get_access_request
+
+MISSING = object()
+
+
+def _matches_operator(value, operator: str, operand, query: dict) -> bool:
+    if operator == "$ne":
+        return value is MISSING or value != operand
+    if operator == "$type":
+        return (operand == "string" and isinstance(value, str)) or \
+            (operand == "number" and isinstance(value, (int, float)) and not isinstance(value, bool))
+    if operator == "$in":
+        return (None if value is MISSING else value) in operand
+    if operator == "$nin":
+        return (None if value is MISSING else value) not in operand
+    if operator == "$regex":
+        flags = re.IGNORECASE if "i" in query.get("$options", "") else 0
+        return isinstance(value, str) and re.search(operand, value, flags) is not None
+    if operator == "$options":
+        return True
+    if operator == "$not":
+        return not _matches_value(value, operand)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        if value is MISSING or isinstance(value, str) != isinstance(operand, str):
+            return False
+        return {"$gt": value > operand, "$gte": value >= operand,
+                "$lt": value < operand, "$lte": value <= operand}[operator]
+    raise AssertionError(f"unexpected operator {operator}")
+
+
+def _matches_value(value, query) -> bool:
+    if isinstance(query, dict) and query and all(key.startswith("$") for key in query):
+        return all(_matches_operator(value, operator, operand, query) for operator, operand in query.items())
+    if query is None:
+        return value is MISSING or value is None
+    return value is not MISSING and value == query
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Tell whether a document matches a MongoDB filter made of the operators used by the translation
+    """
+    for key, value in query.items():
+        if key == "$and":
+            if not all(matches(document, q) for q in value):
+                return False
+        elif key == "$or":
+            if not any(matches(document, q) for q in value):
+                return False
+        elif key == "$nor":
+            if any(matches(document, q) for q in value):
+                return False
+        elif not _matches_value(document.get(key, MISSING), value):
+            return False
+    return True
+
+
+@pytest.mark.parametrize("condition, expected", [
+    ({"condition": "Equals", "value": "bus"}, {"thing_type": "bus"}),
+    ({"condition": "Gt", "value": 3}, {"thing_type": {"$gt": 3}}),
+    ({"condition": "Neq", "value": 3}, {"thing_type": {"$ne": 3, "$type": "number"}}),
+    ({"condition": "NotEquals", "value": "bus"}, {"thing_type": {"$ne": "bus", "$type": "string"}}),
+    ({"condition": "IsIn", "values": ["bus", "light"]}, {"thing_type": {"$in": ["bus", "light"]}}),
+    ({"condition": "IsNotIn", "values": ["bus"]}, {"thing_type": {"$nin": ["bus"]}}),
+    ({"condition": "Exists"}, {"thing_type": {"$ne": None}}),
+    ({"condition": "NotExists"}, {"thing_type": None}),
+    ({"condition": "Any"}, {}),
+    ({"condition": "AnyOf", "values": []}, MATCH_NOTHING),
+])
+def test_translate_condition(condition, expected):
+    assert translate_condition("thing_type", condition) == expected
+
+
+@pytest.mark.parametrize("condition", [
+    {"condition": "CIDR", "value": "10.0.0.0/8"},
+    {"condition": "EqualsAttribute", "ace": "subject", "path": "$.type"},
+    {"condition": "Gt", "value": 3, "case_insensitive": True},
+])
+def test_translate_condition_untranslatable(condition):
+    with pytest.raises(UntranslatableRule):
+        translate_condition("thing_type", condition)
+
+
+@pytest.mark.parametrize("condition, value, satisfied", [
+    ({"condition": "Equals", "value": "Bus", "case_insensitive": True}, "bUS", True),
+    ({"condition": "Equals", "value": "a.b", "case_insensitive": True}, "axb", False),
+    ({"condition": "NotEquals", "value": "bus"}, MISSING, False),
+    ({"condition": "NotEquals", "value": "bus"}, "light", True),
+    ({"condition": "Neq", "value": 3}, "3", False),
+    ({"condition": "StartsWith", "value": "bu"}, "bus", True),
+    ({"condition": "EndsWith", "value": "us"}, "light", False),
+    ({"condition": "Contains", "value": "u"}, "bus", True),
+    ({"condition": "NotContains", "value": "u"}, "bus", False),
+    ({"condition": "NotContains", "value": "u"}, MISSING, False),
+    ({"condition": "RegexMatch", "value": "^b.s$"}, "bus", True),
+    ({"condition": "IsIn", "values": ["bus"]}, MISSING, False),
+    ({"condition": "Not", "value": {"condition": "Equals", "value": "bus"}}, "light", True),
+    ({"condition": "AllOf", "values": [{"condition": "StartsWith", "value": "b"},
+                                       {"condition": "EndsWith", "value": "s"}]}, "bus", True),
+    ({"condition": "AnyOf", "values": [{"condition": "Equals", "value": "light"},
+                                       {"condition": "Equals", "value": "bus"}]}, "bus", True),
+])
+def test_translate_condition_matches(condition, value, satisfied):
+    document = {} if value is MISSING else {"thing_type": value}
+    assert matches(document, translate_condition("thing_type", condition)) == satisfied
+
+
+def make_policy(uid: str, effect: str, priority: int = 0, resource=None, subject=None, resource_id="*") -> Policy:
+    return Policy.from_json({
+        "uid": uid,
+        "description": uid,
+        "effect": effect,
+        "rules": {
+            "subject": subject or {},
+            "resource": resource or {},
+            "action": {"$.method": {"condition": "Equals", "value": "get"}},
+            "context": {}
+        },
+        "targets": {"resource_id": resource_id},
+        "priority": priority
+    })
+
+
+THINGS = [
+    {"thing_id": "urn:bus:1", "thing_type": "bus"},
+    {"thing_id": "urn:bus:2", "thing_type": "bus"},
+    {"thing_id": "urn:light:1", "thing_type": "light"},
+    {"thing_id": "urn:thermo:1", "thing_type": "thermostat"},
+    {"thing_id": "other", "thing_type": "file"},
+]
+ALICE = {"id": "1", "attributes": {"email": "alice@example.com"}}
+BOB = {"id": "2", "attributes": {"email": "bob@example.com"}}
+
+POLICY_SETS = {
+    "allow types": [
+        make_policy("allow-bus", "allow", resource={"$.thing_type": {"condition": "Equals", "value": "bus"}}),
+        make_policy("allow-light", "allow", resource={"$.thing_type": {"condition": "IsIn", "values": ["light"]}}),
+    ],
+    "deny overrides allow of the same priority": [
+        make_policy("allow-all", "allow"),
+        make_policy("deny-bus-1", "deny", resource_id="urn:bus:1"),
+    ],
+    "higher priority allow wins": [
+        make_policy("deny-all", "deny", priority=1),
+        make_policy("allow-urn", "allow", priority=2, resource_id="urn:*"),
+    ],
+    "subject rules": [
+        make_policy("allow-alice", "allow", subject={"$.email": {"condition": "Equals", "value": "alice@example.com"}}),
+        make_policy("deny-alice-thermo", "deny", subject={"$.email": {"condition": "EndsWith", "value": "example.com"}},
+                    resource={"$.thing_type": {"condition": "StartsWith", "value": "thermo"}}),
+    ],
+    "literal path": [
+        make_policy("allow-id-literal", "allow", resource={"id": {"condition": "Equals", "value": "id"}}),
+        make_policy("deny-wildcards", "deny", resource_id=["urn:bus:?", "urn:l[i]ght:*"]),
+    ],
+    "nothing applies": [
+        make_policy("allow-missing", "allow", resource={"$.thing_type": {"condition": "Equals", "value": "missing"}}),
+    ],
+}
+
+
+@pytest.mark.parametrize("name", sorted(POLICY_SETS))
+@pytest.mark.parametrize("subject", [ALICE, BOB])
+def test_get_permitted_filter_agrees_with_pdp(monkeypatch, name, subject):
+    policy_set = PolicySet(POLICY_SETS[name])
+    monkeypatch.setattr(policy_filter.policy_cache, "get_policies", lambda location: policy_set)
+    pdp = PDP(PolicySet(POLICY_SETS[name]), EvaluationAlgorithm.HIGHEST_PRIORITY, [])
+
+    query = get_permitted_filter(subject, "get", "location")
+
+    assert query is not None
+    for thing in THINGS:
+        access_request = get_access_request(subject, thing["thing_id"], thing["thing_type"], "get")
+        assert matches(thing, query) == pdp.is_allowed(AccessRequest.from_json(access_request)), thing
+
+
+def test_get_permitted_filter_untranslatable(monkeypatch):
+    policy_set = PolicySet([
+        make_policy("allow-timespan", "allow", resource={"$.timespan": {"condition": "Gt", "value": 0}}),
+    ])
+    monkeypatch.setattr(policy_filter.policy_cache, "get_policies", lambda location: policy_set)
+
+    assert get_permitted_filter(ALICE, "get", "location") is None
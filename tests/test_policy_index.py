@@ -0,0 +1,108 @@
+"""
+Tests of the target index of the policies: the candidates of a resource must include every policy that may apply to
+it, which is checked against `Policy.fits` of py_abac, and they are returned in the priority order of the policy set.
+"""
+import pytest
+from py_abac import AccessRequest, Policy
+from py_abac.context import EvaluationContext
+
+from Droit.policy_helper import PolicySet
+from Droit.policy_index import PolicyIndex, get_constraints, get_wildcard_prefix
+from Droit.utils import get_access_request
+
+
+def make_policy(uid: str, effect: str = "allow", priority: int = 0, resource=None, resource_id="*") -> Policy:
+    return Policy.from_json({
+        "uid": uid,
+        "description": uid,
+        "effect": effect,
+        "rules": {
+            "subject": {},
+            "resource": resource or {},
+            "action": {},
+            "context": {}
+        },
+        "targets": {"resource_id": resource_id},
+        "priority": priority
+    })
+
+
+POLICIES = [
+    make_policy("all"),
+    make_policy("exact", resource_id="urn:bus:1"),
+    make_policy("list", priority=2, resource_id=["urn:bus:2", "urn:light:1"]),
+    make_policy("glob-star", "deny", priority=1, resource_id="urn:bus:*"),
+    make_policy("glob-char", resource_id="urn:light:?"),
+    make_policy("glob-class", "deny", resource_id="urn:[lt]*"),
+    make_policy("glob-list", resource_id=["urn:thermo:*", "urn:bus:1"]),
+    make_policy("type-bus", resource={"$.thing_type": {"condition": "Equals", "value": "bus"}}),
+    make_policy("types", resource={"$.thing_type": {"condition": "IsIn", "values": ["light", "thermostat"]}}),
+    make_policy("type-insensitive", resource={"$.thing_type": {"condition": "Equals", "value": "BUS",
+                                                                "case_insensitive": True}}),
+    make_policy("id-rule", resource={"$.id": {"condition": "Equals", "value": "urn:bus:1"}}),
+]
+RESOURCES = [
+    ("urn:bus:1", "bus"),
+    ("urn:bus:2", "bus"),
+    ("urn:bus:10", None),
+    ("urn:light:1", "light"),
+    ("urn:light:12", "light"),
+    ("urn:thermo:1", "thermostat"),
+    ("urn:tv", "tv"),
+    ("urn:", None),
+    ("other", "file"),
+]
+
+
+@pytest.mark.parametrize("resource_id, expected", [
+    ("urn:bus:*", "urn:bus:"),
+    ("urn:light:?", "urn:light:"),
+    ("urn:[lt]*", "urn:"),
+    ("*", ""),
+])
+def test_get_wildcard_prefix(resource_id, expected):
+    assert get_wildcard_prefix(resource_id) == expected
+
+
+@pytest.mark.parametrize("uid, expected", [
+    ("all", {"ids": None, "prefix": None, "types": None}),
+    ("list", {"ids": {"urn:bus:2", "urn:light:1"}, "prefix": None, "types": None}),
+    ("glob-class", {"ids": None, "prefix": "urn:", "types": None}),
+    ("glob-list", {"ids": None, "prefix": None, "types": None}),
+    ("types", {"ids": None, "prefix": None, "types": {"light", "thermostat"}}),
+    ("type-insensitive", {"ids": None, "prefix": None, "types": None}),
+    ("id-rule", {"ids": None, "prefix": None, "types": None}),
+])
+def test_get_constraints(uid, expected):
+    policy = next(policy for policy in POLICIES if policy.uid == uid)
+    assert get_constraints(policy.to_json()) == expected
+
+
+@pytest.mark.parametrize("resource_id, thing_type", RESOURCES)
+def test_candidates_include_the_applicable_policies(resource_id, thing_type):
+    policy_set = PolicySet(POLICIES)
+    candidates = policy_set.get_for_resource(resource_id, thing_type)
+    context = EvaluationContext(AccessRequest.from_json(get_access_request(
+        {"id": "1", "attributes": {}}, resource_id, thing_type)), [])
+
+    applicable = [policy.uid for policy in POLICIES if policy.fits(context)]
+    assert set(applicable) <= {policy.uid for policy in candidates}
+
+
+@pytest.mark.parametrize("resource_id, thing_type", RESOURCES)
+def test_candidates_keep_the_priority_order(resource_id, thing_type):
+    policy_set = PolicySet(POLICIES)
+    ordered = list(policy_set.get_all(len(policy_set), 0))
+    candidates = policy_set.get_for_resource(resource_id, thing_type)
+    assert candidates == [policy for policy in ordered if policy in candidates]
+
+
+def test_unrelated_policies_are_not_candidates():
+    candidates = {policy.uid for policy in PolicyIndex(POLICIES).get_candidates("urn:bus:10", "bus")}
+    assert candidates == {"all", "glob-star", "glob-class", "glob-list", "type-bus", "type-insensitive", "id-rule"}
+
+
+def test_unknown_type_keeps_the_policies_indexed_by_type():
+    candidates = {policy.uid for policy in PolicyIndex(POLICIES).get_candidates("other")}
+    assert {"type-bus", "types"} <= candidates
+    assert "type-bus" not in {policy.uid for policy in PolicyIndex(POLICIES).get_candidates("other", "file")}
@@ -0,0 +1,163 @@
+"""
+Tests of the journal of a bulk relocation: a job interrupted by the destination, or by a crash of the directory, can
+be run again until it completes, and every thing description ends up at exactly one of the two directories.
+
+The thing descriptions of both directories and the journal are kept in memory by fakes of the mongoengine classes.
+"""
+import json
+
+import pytest
+import requests
+
+from Droit.views import relocation
+from Droit.views.relocation import run_relocation_job
+
+THING_IDS = [f"urn:bus:{i}" for i in range(5)]
+
+
+class FakeJob(object):
+    """Relocation journal applying the mongoengine update operators used by `run_relocation_job`
+    """
+
+    def __init__(self, pending_ids: list, batch_size: int = 2):
+        self.to_location = "level2b"
+        self.batch_size = batch_size
+        self.pending_ids = list(pending_ids)
+        self.failed_ids = []
+        self.moved_count = 0
+        self.elapsed = 0
+        self.state = 'running'
+
+    def update(self, **kwargs):
+        for key, value in kwargs.items():
+            operator, field = key.split('__', 1)
+            if operator == 'set':
+                setattr(self, field, value)
+            elif operator == 'inc':
+                setattr(self, field, getattr(self, field) + value)
+            elif operator == 'pull_all':
+                setattr(self, field, [item for item in getattr(self, field) if item not in value])
+            elif operator == 'push_all':
+                getattr(self, field).extend(value)
+
+    def reload(self):
+        pass
+
+
+class FakeQuerySet(object):
+    def __init__(self, store: dict, thing_ids: list):
+        self.thing_ids = [thing_id for thing_id in thing_ids if thing_id in store]
+        self.store = store
+
+    def to_json(self) -> str:
+        return json.dumps([self.store[thing_id] for thing_id in self.thing_ids])
+
+
+class Directories(object):
+    """The thing descriptions of the source and of the destination, and the answers of the destination
+    """
+
+    def __init__(self):
+        self.source = {thing_id: {"thing_id": thing_id, "thing_type": "bus"} for thing_id in THING_IDS}
+        self.destination = {}
+        # number of batches the destination accepts before it becomes unreachable, None for no limit
+        self.reachable_batches = None
+        # ids the destination refuses to register
+        self.rejected_ids = set()
+
+    def objects(self, thing_id__in: list, pushed_from=None):
+        return FakeQuerySet(self.source, thing_id__in)
+
+    def peer_post(self, url: str, data: str, **kwargs):
+        if self.reachable_batches is not None:
+            if self.reachable_batches == 0:
+                raise requests.ConnectionError("unreachable")
+            self.reachable_batches -= 1
+        registered = []
+        for thing in json.loads(data)["tds"]:
+            if thing["thing_id"] not in self.rejected_ids:
+                self.destination[thing["thing_id"]] = thing
+                registered.append(thing["thing_id"])
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"registered": registered, "converted": []}).encode('utf-8')
+        return response
+
+    def delete_local_thing_descriptions(self, things_obj, keep_up_ids=()):
+        for thing_id in things_obj.thing_ids:
+            del self.source[thing_id]
+        return len(things_obj.thing_ids)
+
+
+@pytest.fixture
+def directories(monkeypatch):
+    directories = Directories()
+    monkeypatch.setattr(relocation, "ThingDescription", directories)
+    monkeypatch.setattr(relocation, "peer_post", directories.peer_post)
+    monkeypatch.setattr(relocation, "delete_local_thing_descriptions", directories.delete_local_thing_descriptions)
+    monkeypatch.setattr(relocation, "get_target_url", lambda location, api: f"http://localhost:5003{api}")
+    monkeypatch.setattr(relocation, "url_for", lambda endpoint: "/api/bulk_register")
+    monkeypatch.setattr(relocation, "get_long_timeout", lambda: 1)
+    monkeypatch.setattr(relocation, "is_parent", lambda directory_name: False)
+    return directories
+
+
+def assert_moved_once(directories: Directories):
+    assert set(directories.source) | set(directories.destination) == set(THING_IDS)
+    assert not set(directories.source) & set(directories.destination)
+
+
+def test_relocation_completes(directories):
+    job = run_relocation_job(FakeJob(THING_IDS))
+    assert (job.state, job.pending_ids, job.moved_count) == ('completed', [], 5)
+    assert set(directories.destination) == set(THING_IDS)
+    assert_moved_once(directories)
+
+
+def test_interrupted_relocation_is_resumed(directories):
+    directories.reachable_batches = 1
+    job = run_relocation_job(FakeJob(THING_IDS))
+    assert (job.state, job.pending_ids, job.moved_count) == ('interrupted', THING_IDS[2:], 2)
+    assert_moved_once(directories)
+
+    directories.reachable_batches = None
+    job = run_relocation_job(job)
+    assert (job.state, job.pending_ids, job.moved_count) == ('completed', [], 5)
+    assert_moved_once(directories)
+
+
+def test_crash_before_journaling_a_batch(directories):
+    # the first batch was registered and deleted, but the directory crashed before the journal was updated
+    job = FakeJob(THING_IDS)
+    for thing_id in THING_IDS[:2]:
+        directories.destination[thing_id] = directories.source.pop(thing_id)
+
+    job = run_relocation_job(job)
+    assert (job.state, job.pending_ids, job.moved_count) == ('completed', [], 3)
+    assert_moved_once(directories)
+
+
+def test_crash_before_deleting_a_batch(directories):
+    # the first batch was registered, but the directory crashed before deleting its local copies
+    job = FakeJob(THING_IDS)
+    for thing_id in THING_IDS[:2]:
+        directories.destination[thing_id] = dict(directories.source[thing_id])
+
+    job = run_relocation_job(job)
+    assert (job.state, job.pending_ids, job.moved_count) == ('completed', [], 5)
+    assert_moved_once(directories)
+
+
+def test_rejected_things_stay_and_are_reported(directories):
+    directories.rejected_ids = {THING_IDS[1]}
+    job = run_relocation_job(FakeJob(THING_IDS))
+    assert (job.state, job.failed_ids, job.moved_count) == ('completed', [THING_IDS[1]], 4)
+    assert set(directories.source) == {THING_IDS[1]}
+    assert_moved_once(directories)
+
+
+def test_unknown_destination_fails(directories, monkeypatch):
+    monkeypatch.setattr(relocation, "get_target_url", lambda location, api: None)
+    job = run_relocation_job(FakeJob(THING_IDS))
+    assert (job.state, job.pending_ids) == ('failed', THING_IDS)
+    assert set(directories.source) == set(THING_IDS)
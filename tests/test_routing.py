@@ -0,0 +1,150 @@
+"""
+Tests of the in-memory routing table of a directory, loaded from fakes of the routing collections.
+
+The tree used by the tests is
+
+    level1 - level2a - level3aa - level4aaa
+           |         - level3ab
+           - level2b - level3ba
+
+and the routing table is the one of level2a unless stated otherwise. When the paths of the directories are known, a
+directory in another branch is reached through the lowest common ancestor.
+"""
+from collections import namedtuple
+
+import pytest
+
+from Droit import routing
+from Droit.routing import RoutingTable
+
+NameToURL = namedtuple('NameToURL', ['directory_name', 'url', 'relationship'])
+TargetToChild = namedtuple('TargetToChild', ['target_name', 'child_name'])
+Path = namedtuple('Path', ['directory_name', 'path'])
+
+LEVEL2A_DIRECTORIES = [
+    NameToURL("master", "http://localhost:5001", "master"),
+    NameToURL("level1", "http://localhost:5001", "parent"),
+    NameToURL("level3aa", "http://localhost:5004", "child"),
+    NameToURL("level3ab", "http://localhost:5005", "child"),
+    NameToURL("level3ab", "http://localhost:6005", "child"),
+]
+LEVEL2A_TARGETS = [TargetToChild("level4aaa", "level3aa")]
+PATHS = [
+    Path("level1", ["level1"]),
+    Path("level2a", ["level1", "level2a"]),
+    Path("level2b", ["level1", "level2b"]),
+    Path("level3aa", ["level1", "level2a", "level3aa"]),
+    Path("level3ab", ["level1", "level2a", "level3ab"]),
+    Path("level3ba", ["level1", "level2b", "level3ba"]),
+    Path("level4aaa", ["level1", "level2a", "level3aa", "level4aaa"]),
+]
+# routing collections of level4aaa, whose ancestors are all known
+LEVEL4AAA_DIRECTORIES = [
+    NameToURL("master", "http://localhost:5001", "master"),
+    NameToURL("level1", "http://localhost:5001", "ancestor"),
+    NameToURL("level2a", "http://localhost:5002", "ancestor"),
+    NameToURL("level3aa", "http://localhost:5004", "parent"),
+]
+
+
+class FakeCollection(object):
+    """A routing collection, `objects()` returns its documents
+    """
+
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def objects(self):
+        return list(self.documents)
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    """The routing collections of the current directory, by model name
+    """
+    collections = {
+        "DirectoryNameToURL": FakeCollection(list(LEVEL2A_DIRECTORIES)),
+        "TargetToChildName": FakeCollection(list(LEVEL2A_TARGETS)),
+        "DirectoryPath": FakeCollection([]),
+    }
+    for name, collection in collections.items():
+        monkeypatch.setattr(routing, name, collection)
+    return collections
+
+
+@pytest.mark.parametrize("location, expected", [
+    # known directories
+    ("level1", "http://localhost:5001/api/search"),
+    ("level3aa", "http://localhost:5004/api/search"),
+    # descendants are reached through the child they are under
+    ("level4aaa", "http://localhost:5004/api/search"),
+    # other directories are reached through the master directory
+    ("level2b", "http://localhost:5001/api/search"),
+    ("unknown", "http://localhost:5001/api/search"),
+])
+def test_get_target_url(collections, location, expected):
+    assert RoutingTable().get_target_url(location, "/api/search") == expected
+
+
+def test_root_has_no_route_to_unknown_directories(collections):
+    collections["DirectoryNameToURL"].documents = [
+        NameToURL("level2a", "http://localhost:5002", "child"),
+        NameToURL("level2b", "http://localhost:5003", "child"),
+    ]
+    collections["TargetToChildName"].documents = [TargetToChild("level3aa", "level2a")]
+    routing_table = RoutingTable()
+    assert routing_table.get_target_url("level3aa", "/api/search") == "http://localhost:5002/api/search"
+    assert routing_table.get_target_url("unknown", "/api/search") is None
+
+
+def test_instances_are_chosen_by_the_selector(collections):
+    routing_table = RoutingTable()
+    assert routing_table.get_target_url("level3ab") == "http://localhost:5005"
+    routing_table.set_instance_selector(lambda urls: urls[-1])
+    assert routing_table.get_target_url("level3ab", "/api/search") == "http://localhost:6005/api/search"
+    assert routing_table.get_alternate_urls("http://localhost:5005/api/search") == ["http://localhost:6005"]
+
+
+def test_routing_changes_after_refresh(collections):
+    routing_table = RoutingTable()
+    assert routing_table.get_target_url("level3ac") == "http://localhost:5001"
+
+    collections["DirectoryNameToURL"].documents.append(NameToURL("level3ac", "http://localhost:5010", "child"))
+    assert routing_table.get_target_url("level3ac") == "http://localhost:5001"
+    routing_table.refresh()
+    assert routing_table.get_target_url("level3ac") == "http://localhost:5010"
+    assert routing_table.get_child_name("level4aaa") == "level3aa"
+    assert routing_table.get_child_name("level1") is None
+
+
+def test_lookups_are_counted(collections):
+    routing_table = RoutingTable()
+    for location in ("level1", "level4aaa", "unknown"):
+        routing_table.get_target_url(location)
+    metrics = routing_table.get_metrics()
+    assert (metrics["lookups"], metrics["known_directories"], metrics["known_descendants"]) == (3, 4, 1)
+
+
+@pytest.mark.parametrize("location, expected", [
+    # the lowest common ancestor of level4aaa and level3ab is level2a, not the master directory
+    ("level3ab", "http://localhost:5002"),
+    ("level2b", "http://localhost:5001"),
+    ("level3ba", "http://localhost:5001"),
+    ("level3aa", "http://localhost:5004"),
+    # a directory without a known path is still reached through the master directory
+    ("unknown", "http://localhost:5001"),
+])
+def test_other_branches_are_reached_through_the_lowest_common_ancestor(collections, location, expected):
+    collections["DirectoryNameToURL"].documents = list(LEVEL4AAA_DIRECTORIES)
+    collections["TargetToChildName"].documents = []
+    collections["DirectoryPath"].documents = list(PATHS)
+    assert RoutingTable().get_target_url(location) == expected
+
+
+def test_lowest_common_ancestor_of_a_sibling_is_the_parent(collections):
+    collections["DirectoryPath"].documents = list(PATHS)
+    routing_table = RoutingTable()
+    # level2b is a sibling of level2a, their lowest common ancestor is the parent level1
+    assert routing_table.get_target_url("level3ba") == "http://localhost:5001"
+    # descendants are never routed upwards
+    assert routing_table.get_target_url("level4aaa") == "http://localhost:5004"
@@ -0,0 +1,70 @@
+"""
+Tests of the declarative topology: the validation of a topology file and the routing data each directory derives
+from it.
+"""
+import pytest
+
+from Droit.topology import derive_routes, get_descendants, get_path, parse_topology
+
+TREE = {"directories": [
+    {"name": "level1", "url": "http://localhost:5001", "parent": None, "replicas": ["http://localhost:6001"]},
+    {"name": "level2a", "url": "http://localhost:5002", "parent": "level1"},
+    {"name": "level2b", "url": "http://localhost:5003", "parent": "level1"},
+    {"name": "level3aa", "url": "http://localhost:5004", "parent": "level2a"},
+    {"name": "level3ab", "url": "http://localhost:5005", "parent": "level2a"},
+    {"name": "level4aaa", "url": "http://localhost:5006", "parent": "level3aa"},
+]}
+
+
+def tree_with(*entries) -> dict:
+    return {"directories": TREE["directories"] + list(entries)}
+
+
+@pytest.mark.parametrize("data, message", [
+    (tree_with({"name": "level2a", "url": "http://localhost:5010", "parent": "level1"}),
+     "Duplicate directory name: level2a"),
+    (tree_with({"name": "level3ba", "url": "http://localhost:5010", "parent": "level2c"}),
+     "Unknown parent 'level2c' of 'level3ba'"),
+    (tree_with({"name": "other", "url": "http://localhost:5010", "parent": None}),
+     "exactly one root"),
+    ({"directories": []}, "exactly one root"),
+    (tree_with({"name": "level2c", "url": "http://localhost:5010", "parent": "level3ca"},
+               {"name": "level3ca", "url": "http://localhost:5011", "parent": "level2c"}),
+     "Cycle detected"),
+    (tree_with({"name": "self", "url": "http://localhost:5010", "parent": "self"}), "Cycle detected at 'self'"),
+    (tree_with({"name": "level2c", "parent": "level1"}), "Invalid directory entry"),
+    (tree_with({"name": "level2c", "url": "http://localhost:5010", "parent": "level1", "replicas": "bad"}),
+     "Invalid replicas of 'level2c'"),
+])
+def test_invalid_topology_is_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_topology(data)
+
+
+def test_parse_topology():
+    topology = parse_topology(TREE)
+    assert topology["level1"]["urls"] == ["http://localhost:5001", "http://localhost:6001"]
+    assert topology["level3aa"] == {"name": "level3aa", "url": "http://localhost:5004", "parent": "level2a",
+                                    "urls": ["http://localhost:5004"]}
+    assert get_path(topology, "level4aaa") == ["level1", "level2a", "level3aa", "level4aaa"]
+    assert sorted(get_descendants(topology, "level2a")) == ["level3aa", "level3ab", "level4aaa"]
+
+
+def test_derive_routes_of_an_inner_directory():
+    directories, target_to_child, paths = derive_routes(parse_topology(TREE), "level3aa")
+    assert directories == {
+        "master": (["http://localhost:5001", "http://localhost:6001"], "master"),
+        "level1": (["http://localhost:5001", "http://localhost:6001"], "ancestor"),
+        "level2a": (["http://localhost:5002"], "parent"),
+        "level4aaa": (["http://localhost:5006"], "child"),
+    }
+    assert target_to_child == {}
+    assert paths["level3ab"] == ["level1", "level2a", "level3ab"]
+
+
+def test_derive_routes_of_the_root():
+    directories, target_to_child, paths = derive_routes(parse_topology(TREE), "level1")
+    assert {name: relationship for name, (_, relationship) in directories.items()} == {
+        "master": "master", "level2a": "child", "level2b": "child"}
+    assert target_to_child == {"level3aa": "level2a", "level3ab": "level2a", "level4aaa": "level2a"}
+    assert paths["level1"] == ["level1"]